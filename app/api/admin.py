@@ -13,13 +13,18 @@
 # limitations under the License.
 
 import logging
-from typing import List
+from typing import Any, Dict, List
 
+import app.geo as geo
+import app.ingest as ingest
 import app.models as models
+import app.status as status
+import app.tasks as tasks
 import app.repositories.stations as stations
 import app.repositories.users as users
 import bcrypt
 import fastapi
+from app.spool import spool
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
 logger = logging.getLogger(__name__)
@@ -76,7 +81,12 @@ async def station_post(station: models.StationIn) -> models.Station:
     if await stations.get_by_code(station.code):
         raise fastapi.HTTPException(status_code=409, detail="Station already exists")
 
-    return await stations.insert(models.Station(**station.dict()))
+    inserted = await stations.insert(models.Station(**station.dict()))
+    geo.index.invalidate()
+    status.page.invalidate()
+    tasks.invalidate_stations()
+
+    return inserted
 
 
 @stations_router.put(
@@ -94,8 +104,12 @@ async def station_put(
         raise fastapi.HTTPException(status_code=404, detail="Station not found")
 
     existed = existed.copy(update=station.dict(exclude_unset=True))
+    updated = await stations.update(existed)
+    geo.index.invalidate()
+    status.page.invalidate()
+    tasks.invalidate_stations()
 
-    return await stations.update(existed)
+    return updated
 
 
 @stations_router.delete(
@@ -107,7 +121,15 @@ async def station_put(
 async def station_delete(id: models.PyObjectId = fastapi.Path(..., title="Station ID")):
     if await stations.delete(id) == 0:
         raise fastapi.HTTPException(status_code=404, detail="Station not found")
+    geo.index.invalidate()
+    status.page.invalidate()
+    tasks.invalidate_stations()
 
 
 router = fastapi.APIRouter(dependencies=[fastapi.Depends(get_user)], tags=["Admin"])
 router.include_router(stations_router, prefix="/station")
+
+
+@router.get("/ingest", summary="Get ingest state", tags=["Ingest"])
+async def ingest_get() -> Dict[str, Any]:
+    return {"inflight": ingest.admission.inflight, "spool": spool.stats()}
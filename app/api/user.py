@@ -12,22 +12,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import base64
 import enum
-from io import BytesIO
 import logging
-from typing import List, Union
+from datetime import datetime, time, timedelta, timezone
+from typing import Dict, List, Tuple, Union
 
+import app.compression as compression
+import app.database as database
+import app.geo as geo
+import app.invalidation as invalidation
+import app.graphs as graphs
+import app.segments as segments
+import app.series as series
+import app.sketches as sketches
 import app.repositories.stations as stations
 import app.repositories.measurements as measurements
+import bson
 import fastapi
-import starlette.responses as responses
-import matplotlib.pyplot as plt
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 import app.models as models
+from app.settings import Renderer, config
 
 logger = logging.getLogger(__name__)
 
 router = fastapi.APIRouter(tags=["User"])
 
+MAX_COMPARED_STATIONS = 10
+MAX_PAGE_SIZE = 1000
+
 
 class RequestType(str, enum.Enum):
     LAST = "last"
@@ -45,6 +61,197 @@ async def station_select():
     return await stations.select()
 
 
+def _accepts_series(request: fastapi.Request) -> bool:
+    return series.MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def _series_response(
+    timestamps: np.ndarray,
+    columns: Dict[str, np.ndarray],
+    headers: Union[Dict[str, str], None] = None,
+) -> fastapi.Response:
+    return fastapi.Response(
+        series.encode(timestamps, columns),
+        media_type=series.MEDIA_TYPE,
+        headers={**(headers or {}), "Vary": "Accept"},
+    )
+
+
+def _encode_cursor(record: models.WeatherRecord) -> str:
+    ms = int(record.timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return base64.urlsafe_b64encode(
+        ms.to_bytes(8, "big", signed=True) + record.id.binary
+    ).decode()
+
+
+def _decode_cursor(cursor: Union[str, None]) -> Union[measurements.Cursor, None]:
+    """Timestamp and id of a record, cursors of the time only are accepted too"""
+    if cursor is None:
+        return None
+
+    try:
+        data = base64.urlsafe_b64decode(cursor)
+        if len(data) not in (8, 20):
+            raise ValueError("Invalid cursor length")
+        ms = int.from_bytes(data[:8], "big", signed=True)
+        record_id = bson.ObjectId(data[8:]) if len(data) == 20 else None
+        return datetime.utcfromtimestamp(ms / 1000), record_id
+    except (ValueError, OverflowError) as e:
+        raise fastapi.HTTPException(400, "Invalid cursor") from e
+
+
+def _page_links(
+    request: fastapi.Request,
+    page: measurements.Page,
+    after: Union[measurements.Cursor, None],
+    before: Union[measurements.Cursor, None],
+) -> Dict[str, str]:
+    """Links to the neighbouring pages that have records"""
+    if not page.records:
+        return {}
+
+    # the page was reached from the other side of its cursor
+    has_prev = page.more if not page.ascending else after is not None
+    has_next = page.more if page.ascending else before is not None
+
+    url = request.url.remove_query_params(["after", "before"])
+    links = []
+    if has_prev:
+        prev_url = url.include_query_params(before=_encode_cursor(page.records[0]))
+        links.append(f'<{prev_url}>; rel="prev"')
+    if has_next:
+        next_url = url.include_query_params(after=_encode_cursor(page.records[-1]))
+        links.append(f'<{next_url}>; rel="next"')
+
+    return {"Link": ", ".join(links)} if links else {}
+
+
+def _history_json(
+    records: List[models.WeatherRecord],
+    params: Union[List[models.MeasureType], None],
+) -> bytes:
+    if params is not None:
+        include = {"timestamp", *(param.value for param in params)}
+        content = [record.dict(include=include) for record in records]
+    else:
+        content = [
+            models.AnonymousWeatherRecord(**record.dict(by_alias=True))
+            for record in records
+        ]
+
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def _is_final(
+    page: measurements.Page,
+    period: models.Period,
+    before: Union[measurements.Cursor, None],
+) -> bool:
+    """Whether a history page and its links can not change anymore"""
+    if database.unmigrated:
+        return False
+    settled = datetime.utcnow() - timedelta(seconds=config.segments.settle)
+    if before is not None:
+        return before[0] <= settled
+    if period.end is not None:
+        return datetime.combine(period.end, time.max) < settled
+
+    # a page followed by other records ends with its last record
+    return (
+        page.ascending
+        and page.more
+        and page.records[-1].timestamp.replace(tzinfo=None) < settled
+    )
+
+
+def _on_measurement(event: invalidation.Event) -> None:
+    # final history pages change only when old readings are imported
+    settled = datetime.utcnow() - timedelta(seconds=config.segments.settle)
+    if event.key is not None and event.time < settled:
+        compression.cache.evict(str(event.key))
+
+
+invalidation.bus.subscribe(invalidation.MEASUREMENTS, _on_measurement)
+
+
+def _parse_params(params: Union[str, None]) -> Union[List[models.MeasureType], None]:
+    if params is None:
+        return None
+
+    try:
+        return list(
+            dict.fromkeys(
+                models.MeasureType(param.strip()) for param in params.split(",")
+            )
+        )
+    except ValueError as e:
+        raise fastapi.HTTPException(400, "Invalid measure") from e
+
+
+async def _select_weather(
+    station_ids: List[models.PyObjectId],
+) -> Dict[models.PyObjectId, models.AnonymousWeatherRecord]:
+    if not station_ids:
+        return {}
+
+    return {
+        record.station.id: models.AnonymousWeatherRecord(**record.dict(by_alias=True))
+        for record in await measurements.select_last(station_ids)
+    }
+
+
+@router.get(
+    "/station/nearby",
+    response_model=List[models.NearbyStation],
+    summary="Get nearest stations",
+    tags=["Stations"],
+)
+async def station_nearby(
+    lat: float = fastapi.Query(..., title="Latitude", ge=-90, le=90),
+    lon: float = fastapi.Query(..., title="Longitude", ge=-180, le=180),
+    limit: int = fastapi.Query(10, title="Limit", gt=0, le=100),
+    weather: bool = fastapi.Query(False, title="Include last weather record"),
+):
+    nearby = await geo.index.nearby(lat, lon, limit)
+    records = (
+        await _select_weather([station.id for station, _ in nearby]) if weather else {}
+    )
+
+    return [
+        models.NearbyStation(
+            **station.dict(), distance=distance, weather=records.get(station.id)
+        )
+        for station, distance in nearby
+    ]
+
+
+@router.get(
+    "/station/bbox",
+    response_model=List[models.StationWeather],
+    summary="Get stations within a bounding box",
+    tags=["Stations"],
+)
+async def station_bbox(
+    south: float = fastapi.Query(..., title="South latitude", ge=-90, le=90),
+    west: float = fastapi.Query(..., title="West longitude", ge=-180, le=180),
+    north: float = fastapi.Query(..., title="North latitude", ge=-90, le=90),
+    east: float = fastapi.Query(..., title="East longitude", ge=-180, le=180),
+    weather: bool = fastapi.Query(False, title="Include last weather record"),
+):
+    if south > north:
+        raise fastapi.HTTPException(400, "South latitude is greater than north")
+
+    within = await geo.index.within(south, west, north, east)
+    records = (
+        await _select_weather([station.id for station in within]) if weather else {}
+    )
+
+    return [
+        models.StationWeather(**station.dict(), weather=records.get(station.id))
+        for station in within
+    ]
+
+
 # ObjectId("62fa1796810616013f7f7b19")
 @router.get(
     "/station/{id}/weather",
@@ -54,7 +261,8 @@ async def station_select():
         200: {
             "model": Union[
                 models.AnonymousWeatherRecord, List[models.AnonymousWeatherRecord]
-            ]
+            ],
+            "content": {series.MEDIA_TYPE: {}},
         },
         400: {"description": "Invalid request"},
         404: {"description": "Data not found"},
@@ -62,9 +270,19 @@ async def station_select():
     },
 )
 async def weather_get(
+    request: fastapi.Request,
     id: models.PyObjectId = fastapi.Path(..., title="Station ID"),
     type: RequestType = fastapi.Query(RequestType.LAST, title="Request type"),
     period: models.Period = fastapi.Depends(models.Period),
+    limit: int = fastapi.Query(100, title="Page size", gt=0, le=MAX_PAGE_SIZE),
+    after: Union[str, None] = fastapi.Query(None, title="Next page cursor"),
+    before: Union[str, None] = fastapi.Query(None, title="Previous page cursor"),
+    samples: Union[int, None] = fastapi.Query(
+        None, title="Random samples for the period instead of a page", gt=0, le=1920
+    ),
+    params: Union[str, None] = fastapi.Query(
+        None, title="Comma separated measures of history, all by default"
+    ),
 ):
     if type == RequestType.LAST:
         measure = await measurements.get_last(id)
@@ -76,15 +294,86 @@ async def weather_get(
         raise fastapi.HTTPException(501, "Not implemented")
 
     if type == RequestType.HISTORY:
-        records = await measurements.select(id, period, samples=100)
-        return [
-            models.AnonymousWeatherRecord(**record.dict(by_alias=True))
-            for record in records
-        ]
+        selected = _parse_params(params)
+        as_series = _accepts_series(request)
+        key = f"{request.url.path}?{request.url.query}|{as_series}"
+        cached = compression.cache.get(key) if not samples else None
+        if cached is not None:
+            return cached.response(request)
+
+        if samples:
+            records = await measurements.select(
+                id, period, samples=samples, params=selected
+            )
+            links = {}
+        else:
+            after_cursor = _decode_cursor(after)
+            before_cursor = _decode_cursor(before)
+            page = await measurements.select_page(
+                id,
+                period,
+                limit=limit,
+                after=after_cursor,
+                before=before_cursor,
+                params=selected,
+            )
+            records = page.records
+            links = _page_links(request, page, after_cursor, before_cursor)
+
+        if as_series:
+            content = series.encode(
+                series.to_timestamps(records), series.records_columns(records)
+            )
+            media_type = series.MEDIA_TYPE
+        else:
+            content = _history_json(records, selected)
+            media_type = "application/json"
+
+        headers = {**links, "Vary": "Accept"}
+        if not samples and _is_final(page, period, before_cursor):
+            body = compression.CompressedBody(content, media_type, headers)
+            compression.cache.put(key, body, tags=[str(id)])
+            return body.response(request)
+
+        return fastapi.Response(content, media_type=media_type, headers=headers)
 
     raise fastapi.HTTPException(400, "Invalid request type")
 
 
+@router.get(
+    "/station/{id}/stats",
+    response_model=models.QuantileStats,
+    summary="Get percentiles of a parameter for a station",
+    tags=["Stations", "Weather"],
+    responses={400: {"description": "Invalid request"}},
+)
+async def station_stats(
+    id: models.PyObjectId = fastapi.Path(..., title="Station ID"),
+    param: models.MeasureType = fastapi.Query(..., title="Parameter"),
+    field: str = fastapi.Query("avg", title="Value field, `max` for wind gusts"),
+    q: List[float] = fastapi.Query([0.5], title="Quantiles", ge=0, le=1),
+    period: models.Period = fastapi.Depends(models.Period),
+):
+    if (param.value, field) not in sketches.FIELDS:
+        raise fastapi.HTTPException(400, f"No statistics for {param.value}.{field}")
+
+    end = period.end or datetime.utcnow().date()
+    start = period.start or end - measurements.DEFAULT_PERIOD
+    sketch = await sketches.select(id, f"{param.value}.{field}", start, end)
+
+    return models.QuantileStats(
+        param=param,
+        field=field,
+        start=start,
+        end=end,
+        count=sketch.count,
+        quantiles=[
+            models.Quantile(q=quantile, value=sketch.quantile(quantile))
+            for quantile in q
+        ],
+    )
+
+
 @router.get(
     "/station/{id}/{param}/graph",
     summary="Get graph for a station",
@@ -100,23 +389,109 @@ async def weather_graph(
     period: models.Period = fastapi.Depends(models.Period),
     width: int = fastapi.Query(640, title="Width", gt=320, le=1920),
     height: int = fastapi.Query(480, title="Height", gt=240, le=1080),
+    renderer: Union[Renderer, None] = fastapi.Query(
+        None, title="Renderer, from settings by default"
+    ),
+):
+    key = graphs.GraphKey(id, param, width, height, renderer or config.graphs.renderer)
+    if period.start is None and period.end is None:
+        png = await graphs.cache.get(key)
+    else:
+        png = await graphs.render_station(key, period)
+
+    return fastapi.Response(png, media_type="image/png")
+
+
+async def _compare(
+    station_ids: str, param: models.MeasureType, period: models.Period, points: int
+) -> Tuple[List[models.Station], np.ndarray, np.ndarray]:
+    try:
+        ids = list(
+            dict.fromkeys(
+                models.PyObjectId.validate(id.strip()) for id in station_ids.split(",")
+            )
+        )
+    except ValueError as e:
+        raise fastapi.HTTPException(400, "Invalid station id") from e
+    if len(ids) > MAX_COMPARED_STATIONS:
+        raise fastapi.HTTPException(
+            400, f"No more than {MAX_COMPARED_STATIONS} stations can be compared"
+        )
+
+    compared = await stations.select_many(ids)
+    if len(compared) != len(ids):
+        raise fastapi.HTTPException(404, "Station not found")
+
+    selected = await asyncio.gather(
+        *(segments.cache.select(id, param, period) for id in ids)
+    )
+    grid, matrix = series.resample(list(selected), points)
+
+    return compared, grid.astype("datetime64[ms]"), matrix
+
+
+@router.get(
+    "/weather/compare",
+    response_model=models.ComparedSeries,
+    summary="Compare a parameter across stations",
+    tags=["Weather"],
+    responses={
+        200: {"content": {series.MEDIA_TYPE: {}}},
+        400: {"description": "Invalid request"},
+        404: {"description": "Station not found"},
+    },
+)
+async def weather_compare(
+    request: fastapi.Request,
+    response: fastapi.Response,
+    station_ids: str = fastapi.Query(
+        ..., alias="stations", title="Comma separated station IDs"
+    ),
+    param: models.MeasureType = fastapi.Query(..., title="Parameter"),
+    period: models.Period = fastapi.Depends(models.Period),
+    points: int = fastapi.Query(100, title="Points", gt=1, le=1920),
+):
+    compared, grid, matrix = await _compare(station_ids, param, period, points)
+    if _accepts_series(request):
+        return _series_response(
+            grid.astype(np.int64),
+            {str(station.id): row for station, row in zip(compared, matrix)},
+        )
+
+    response.headers["Vary"] = "Accept"
+    values = matrix.astype(object)
+    values[np.isnan(matrix)] = None
+
+    return models.ComparedSeries(
+        stations=compared,
+        param=param,
+        timestamps=grid.tolist(),
+        values=values.tolist(),
+    )
+
+
+@router.get(
+    "/weather/compare/graph",
+    summary="Get comparison graph for stations",
+    tags=["Weather"],
+    responses={
+        200: {"content": {"image/png": {}}, "description": "OK"},
+        400: {"description": "Invalid request"},
+        404: {"description": "Station not found"},
+    },
+)
+async def weather_compare_graph(
+    station_ids: str = fastapi.Query(
+        ..., alias="stations", title="Comma separated station IDs"
+    ),
+    param: models.MeasureType = fastapi.Query(..., title="Parameter"),
+    period: models.Period = fastapi.Depends(models.Period),
+    width: int = fastapi.Query(640, title="Width", gt=320, le=1920),
+    height: int = fastapi.Query(480, title="Height", gt=240, le=1080),
 ):
-    records = await measurements.select(id, period, samples=width)
-    x = [record.timestamp for record in records]
-    y = [getattr(record, param.value).avg for record in records]
-
-    fig, ax = plt.subplots()
-    ax.plot(x, y)
-    # ax.set_title(str(param))
-    # ax.set_xlabel("Time")
-    # ax.set_ylabel(str(param))
-    fig.set_size_inches(width / 100, height / 100)
-    fig.set_dpi(100)
-    fig.tight_layout()
-    fig.canvas.draw()
-    buf = BytesIO()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
-    plt.close(fig)
-
-    return responses.StreamingResponse(buf, media_type="image/png")
+    compared, grid, matrix = await _compare(station_ids, param, period, width)
+    lines = [(grid, row, station.name) for station, row in zip(compared, matrix)]
+
+    png = await graphs.pool.run(graphs.render, width, height, lines)
+
+    return fastapi.Response(png, media_type="image/png")
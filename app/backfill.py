@@ -0,0 +1,362 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import contextlib
+import csv
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+import bson
+import pymongo.errors
+from bson.raw_bson import RawBSONDocument
+
+import app.models as models
+import app.repositories.measurements as measurements
+import app.repositories.stations as stations
+import app.segments as segments
+import app.sketches as sketches
+from app.tasks import normalize_wind
+
+logger = logging.getLogger(__name__)
+
+# line in the file, station code, timestamp, values of measures
+Row = Tuple[int, Union[str, None], datetime, Dict[str, Dict[str, Any]]]
+# line in the file and its text
+Line = Tuple[int, str]
+Parser = Callable[[List[Line]], Iterator[Row]]
+# columns of timestamp, station and values of measures in a CSV file
+Layout = Tuple[int, Union[int, None], List[Tuple[str, str, int]]]
+
+VALUE_FIELDS = ("avg", "min", "max")
+WIND_FIELDS = VALUE_FIELDS + ("azimuth", "direction")
+FIELDS = {
+    param.value: WIND_FIELDS if param == models.MeasureType.wind else VALUE_FIELDS
+    for param in models.MeasureType
+}
+CONVERTERS = {
+    "azimuth": lambda v: int(float(v)),
+    "direction": models.WindDirection.validate,
+}
+
+
+def _parse_timestamp(value: str) -> datetime:
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
+
+
+def _parse_values(items: Iterable[Tuple[str, str, Any]]) -> Dict[str, Dict[str, Any]]:
+    values: Dict[str, Dict[str, Any]] = {}
+    for param, field, v in items:
+        if v is None or v == "":
+            continue
+        values.setdefault(param, {})[field] = CONVERTERS.get(field, float)(v)
+
+    values = {param: value for param, value in values.items() if "avg" in value}
+    wind = values.get("wind")
+    if wind is None:
+        raise ValueError("Wind speed is required")
+    wind["azimuth"], wind["direction"] = normalize_wind(
+        wind["avg"], wind.get("azimuth"), wind.get("direction")
+    )
+
+    return values
+
+
+def _csv_layout(path: str, header: List[str]) -> Layout:
+    if "timestamp" not in header:
+        raise ValueError(f"{path}: `timestamp` column is required")
+    columns = [
+        (param, field, header.index(f"{param}.{field}"))
+        for param, fields in FIELDS.items()
+        for field in fields
+        if f"{param}.{field}" in header
+    ]
+
+    return (
+        header.index("timestamp"),
+        header.index("station") if "station" in header else None,
+        columns,
+    )
+
+
+def _parse_csv(path: str, layout: Layout, lines: List[Line]) -> Iterator[Row]:
+    """Rows with `station`, `timestamp` and `<measure>.<field>` columns"""
+    timestamp, station, columns = layout
+    reader = csv.reader(text for _, text in lines)
+    for row in reader:
+        line = lines[reader.line_num - 1][0]
+        try:
+            parsed = (
+                row[station] or None if station is not None else None,
+                _parse_timestamp(row[timestamp]),
+                _parse_values((param, field, row[i]) for param, field, i in columns),
+            )
+        except (IndexError, ValueError) as e:
+            raise ValueError(f"{path}:{line}: {e}") from e
+        yield (line, *parsed)
+
+
+def _parse_ndjson(path: str, lines: List[Line]) -> Iterator[Row]:
+    """Lines of weather records as returned by the API with optional `station`"""
+    for line, text in lines:
+        try:
+            row = json.loads(text)
+            parsed = (
+                row.get("station"),
+                _parse_timestamp(row["timestamp"]),
+                _parse_values(
+                    (param, field, v)
+                    for param in FIELDS
+                    for field, v in (row.get(param) or {}).items()
+                    if field in FIELDS[param]
+                ),
+            )
+        except (KeyError, ValueError) as e:
+            raise ValueError(f"{path}:{line}: {e}") from e
+        yield (line, *parsed)
+
+
+def _lines(f: TextIO, start: int, skip: int) -> Iterator[Line]:
+    """Non-blank lines of a file after `skip` ones, numbered from `start`"""
+    lines = ((n, text) for n, text in enumerate(f, start=start) if text.strip())
+    return itertools.islice(lines, skip, None)
+
+
+@contextlib.contextmanager
+def _open(path: str, skip: int) -> Iterator[Tuple[Parser, Iterator[Line]]]:
+    """Parser of the file format and lines of its records after `skip` ones.
+
+    Records are split by lines, so CSV values can't have line breaks.
+    """
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            header = next(csv.reader([f.readline()]), [])
+            parse = functools.partial(_parse_csv, path, _csv_layout(path, header))
+            yield parse, _lines(f, 2, skip)
+    elif path.endswith((".ndjson", ".jsonl")):
+        with open(path, encoding="utf-8") as f:
+            yield functools.partial(_parse_ndjson, path), _lines(f, 1, skip)
+    else:
+        raise ValueError(f"Unknown format of {path}, expected .csv or .ndjson")
+
+
+def _batches(lines: Iterator[Line], size: int) -> Iterator[List[Line]]:
+    while True:
+        batch = list(itertools.islice(lines, size))
+        if not batch:
+            return
+        yield batch
+
+
+def read(path: str, skip: int = 0) -> Iterator[Row]:
+    """Rows of a CSV or NDJSON file after `skip` ones"""
+    with _open(path, skip) as (parse, lines):
+        for batch in _batches(lines, 10_000):
+            yield from parse(batch)
+
+
+class Chunk(NamedTuple):
+    # encoded documents, readings are inserted as they are
+    documents: List[bytes]
+    sketches: sketches.SketchBuffer
+    # codes of stations without ids and their first lines, nothing is encoded
+    unknown: Dict[Union[str, None], int]
+
+
+def _pack(
+    parse: Parser,
+    lines: List[Line],
+    station_ids: Dict[Union[str, None], bson.ObjectId],
+) -> Chunk:
+    """Parse, encode and sketch a batch, runs in worker processes"""
+    rows = list(parse(lines))
+    unknown: Dict[Union[str, None], int] = {}
+    for line, code, _, _ in rows:
+        if code not in station_ids:
+            unknown.setdefault(code, line)
+    if unknown:
+        return Chunk([], sketches.SketchBuffer(), unknown)
+
+    buffer = sketches.SketchBuffer()
+    documents = []
+    for _, code, timestamp, values in rows:
+        id = station_ids[code]
+        # ids tell the write order, readings are polled by them
+        document = measurements.pack_document(bson.ObjectId(), id, timestamp, values)
+        documents.append(bson.encode(document))
+        buffer.add(id, timestamp, values)
+
+    return Chunk(documents, buffer, {})
+
+
+def _load_checkpoint(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["rows"]
+
+
+def _save_checkpoint(path: str, rows: int) -> None:
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"rows": rows}, f)
+    os.replace(path + ".tmp", path)
+
+
+async def backfill(
+    path: str,
+    *,
+    station: Union[str, None] = None,
+    batch_size: int = 10_000,
+    concurrency: int = 4,
+    processes: int = 0,
+) -> AsyncIterator[int]:
+    """Import a file of historical measurements.
+
+    Batches are parsed and encoded by `processes` worker processes (0 for the
+    number of cores), then written concurrently and unordered. The number of
+    rows written in a row from the start of the file is kept in
+    `<path>.checkpoint` and yielded at start and after every batch, an
+    interrupted import continues from it. Up to `concurrency` batches after
+    the checkpoint may be written already, so the first batches of a resumed
+    import skip readings of a station and time that exist. Quantile sketches
+    of those batches may be counted twice.
+    """
+    checkpoint = path + ".checkpoint"
+    committed = skip = _load_checkpoint(checkpoint)
+    station_ids: Dict[Union[str, None], bson.ObjectId] = {}
+
+    async def station_id(code: Union[str, None]) -> bson.ObjectId:
+        if code not in station_ids:
+            if (code or station) is None:
+                raise ValueError("Station code is required")
+            found = await stations.get_by_code(code or station)
+            if found is None:
+                raise ValueError(f"Station {code or station} not found")
+            station_ids[code] = found.id
+        return station_ids[code]
+
+    async def write(batch, end: int, resumed: bool) -> int:
+        if resumed:
+            batch = await measurements.exclude_existing(batch, by_time=True)
+        if batch:
+            await measurements.insert_many(batch)
+        return end
+
+    pending: Dict[asyncio.Task, int] = {}
+    finished: Dict[int, int] = {}
+    batches = committed_batches = 0
+
+    async def wait(return_when) -> None:
+        nonlocal committed, committed_batches
+        done, _ = await asyncio.wait(pending, return_when=return_when)
+        for task in done:
+            try:
+                finished[pending.pop(task)] = task.result()
+            except pymongo.errors.BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                message = errors[0]["errmsg"] if errors else str(e)
+                raise ValueError(
+                    f"{path}: {len(errors)} readings are not written: {message}"
+                ) from e
+        while committed_batches in finished:
+            committed = finished.pop(committed_batches)
+            committed_batches += 1
+        await sketches.buffer.flush()
+        _save_checkpoint(checkpoint, committed)
+
+    yield committed
+
+    loop = asyncio.get_running_loop()
+    processes = processes or os.cpu_count() or 1
+    # batches parsed ahead, so the workers do not wait for writes
+    parsing: "collections.deque[Tuple[List[Line], asyncio.Future]]" = (
+        collections.deque()
+    )
+    rows = skip
+    # workers are spawned: the event loop and driver threads are not forked
+    with _open(path, skip) as (parse, lines), ProcessPoolExecutor(
+        processes, multiprocessing.get_context("spawn")
+    ) as pool:
+
+        def parse_next() -> None:
+            for batch in itertools.islice(read_ahead, 1):
+                future = loop.run_in_executor(
+                    pool, _pack, parse, batch, dict(station_ids)
+                )
+                parsing.append((batch, future))
+
+        read_ahead = _batches(lines, batch_size)
+        try:
+            for _ in range(2 * processes):
+                parse_next()
+
+            while parsing:
+                batch, future = parsing.popleft()
+                chunk = await future
+                while chunk.unknown:
+                    for code, line in chunk.unknown.items():
+                        try:
+                            await station_id(code)
+                        except ValueError as e:
+                            raise ValueError(f"{path}:{line}: {e}") from e
+                    chunk = await loop.run_in_executor(
+                        pool, _pack, parse, batch, dict(station_ids)
+                    )
+                parse_next()
+
+                sketches.buffer.merge(chunk.sketches)
+                rows += len(chunk.documents)
+                documents = [RawBSONDocument(data) for data in chunk.documents]
+                if len(pending) >= concurrency:
+                    await wait(asyncio.FIRST_COMPLETED)
+                    yield committed
+                resumed = skip > 0 and batches < concurrency
+                pending[asyncio.create_task(write(documents, rows, resumed))] = batches
+                batches += 1
+
+            if pending:
+                await wait(asyncio.ALL_COMPLETED)
+        except ValueError:
+            for _, future in parsing:
+                future.cancel()
+            for task in pending:
+                task.cancel()
+            raise
+
+    # cached day segments on disk do not have the imported readings
+    for id in station_ids.values():
+        segments.cache.invalidate(id)
+    yield committed
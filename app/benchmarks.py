@@ -0,0 +1,269 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+import bson
+import numpy as np
+import pytz
+from fastapi.encoders import jsonable_encoder
+
+import app.models as models
+
+
+def sample_record() -> models.WeatherRecord:
+    """A typical record as it is imported from a PWS station"""
+    wind = models.WindValue(avg=12.8, min=None, max=14.3, azimuth=73, direction=None)
+    wind.direction = models.WindDirection.from_azimuth(wind.azimuth)
+
+    return models.WeatherRecord(
+        station=models.Station(
+            code="IKRASN19", name="Krasnoyarsk, Oktyabrsky", lat=56.0184, lon=92.8672
+        ),
+        timestamp=datetime(2022, 8, 15, 10, 59, 8, tzinfo=pytz.utc),
+        wind=wind,
+        temperature=models.MeasureValue(avg=17.7, min=None, max=None),
+        humidity=models.MeasureValue(avg=50, min=None, max=None),
+        pressure=models.MeasureValue(avg=755.7, min=None, max=None),
+        light=models.MeasureValue(avg=157.7, min=None, max=None),
+        rain=models.MeasureValue(avg=0.0, min=None, max=None),
+    )
+
+
+def storage() -> Dict[str, int]:
+    """BSON size of a record in the embedded and compact layouts"""
+    import app.repositories.measurements as measurements
+
+    record = sample_record()
+
+    return {
+        "embedded": len(bson.encode(record.dict(by_alias=True))),
+        "compact": len(bson.encode(measurements.to_document(record))),
+    }
+
+
+def sample_records(count: int, step: timedelta) -> List[models.WeatherRecord]:
+    """Records with random walk values"""
+    rng = np.random.default_rng(0)
+    record = sample_record()
+    walk = np.cumsum(rng.normal(0, 0.3, size=(count, 5)), axis=0)
+
+    records = []
+    for i, (wind, azimuth, temperature, humidity, pressure) in enumerate(walk):
+        speed = round(abs(record.wind.avg + wind), 1)
+        azimuth = int(record.wind.azimuth + azimuth * 10) % 360
+        records.append(
+            record.copy(
+                update={
+                    "id": bson.ObjectId(),
+                    "timestamp": record.timestamp + step * i,
+                    "wind": models.WindValue(
+                        avg=speed,
+                        max=round(speed * 1.3, 1),
+                        azimuth=azimuth,
+                        direction=models.WindDirection.from_azimuth(azimuth),
+                    ),
+                    "temperature": models.MeasureValue(
+                        avg=round(record.temperature.avg + temperature, 1)
+                    ),
+                    "humidity": models.MeasureValue(
+                        avg=round(record.humidity.avg + humidity)
+                    ),
+                    "pressure": models.MeasureValue(
+                        avg=(1007.5 + pressure) * 0.750061561303
+                    ),
+                }
+            )
+        )
+
+    return records
+
+
+def _render_peak(width: int, height: int, lines: List, renderer: Any) -> int:
+    """Peak RSS in bytes of a process that renders a graph once"""
+    import app.graphs as graphs
+
+    graphs.render(width, height, lines, renderer)
+
+    # unlike ru_maxrss, the high water mark is not inherited through exec
+    with open("/proc/self/status") as f:
+        fields = dict(line.split(":", 1) for line in f if ":" in line)
+    return int(fields["VmHWM"].split()[0]) * 1024
+
+
+def graphs(
+    records: List[models.WeatherRecord], width: int, height: int, repeat: int = 5
+) -> Dict[str, Dict[str, float]]:
+    """Render time in ms, PNG size in bytes and peak RSS in bytes of a process
+    rendering a temperature graph (with imports) by every renderer"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    import app.graphs as graphs
+    import app.series as series
+    from app.settings import Renderer
+
+    timestamps, values = series.to_arrays(records, models.MeasureType.temperature)
+    lines = [(timestamps.astype("datetime64[ms]"), values, None)]
+
+    result = {}
+    for renderer in Renderer:
+        # imports and font caches are not timed
+        graphs.render(width, height, lines, renderer)
+
+        started = time.perf_counter()
+        for _ in range(repeat):
+            png = graphs.render(width, height, lines, renderer)
+        elapsed = (time.perf_counter() - started) / repeat
+
+        with ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            peak = executor.submit(
+                _render_peak, width, height, lines, renderer
+            ).result()
+
+        result[renderer.value] = {"ms": elapsed * 1000, "bytes": len(png), "peak": peak}
+
+    return result
+
+
+def series(records: List[models.WeatherRecord]) -> Dict[str, Dict[str, float]]:
+    """Size in bytes and encoding time in ms of a history response"""
+    import app.series as series
+
+    started = time.perf_counter()
+    body = json.dumps(
+        jsonable_encoder(
+            [
+                models.AnonymousWeatherRecord(**record.dict(by_alias=True))
+                for record in records
+            ]
+        )
+    ).encode()
+    json_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    binary = series.encode(
+        series.to_timestamps(records), series.records_columns(records)
+    )
+    binary_time = time.perf_counter() - started
+
+    return {
+        "json": {"bytes": len(body), "ms": json_time * 1000},
+        "binary": {"bytes": len(binary), "ms": binary_time * 1000},
+    }
+
+
+async def buckets(
+    records: List[models.WeatherRecord], window: timedelta, queries: int
+) -> Dict[str, Dict[str, float]]:
+    """Collection size in bytes, range and last readings query latency in ms
+    of storage layouts.
+
+    Temporary collections are created in the configured database and dropped
+    afterwards.
+    """
+    from app.database import create_measurements, db
+    from app.repositories.measurements import to_document
+    from app.repositories.storage import STORAGES
+    from app.settings import StorageType
+
+    server_info = await db.client.server_info()
+    documents = [to_document(record) for record in records]
+    station_id = documents[0]["s"]
+    start, end = records[0].timestamp, records[-1].timestamp - window
+    starts = [start + (end - start) * i / queries for i in range(queries)]
+
+    result = {}
+    for storage_type in StorageType:
+        name = f"bench_{storage_type.value}"
+        await db.drop_collection(name)
+        await create_measurements(
+            name,
+            timeseries=int(server_info["version"].split(".")[0]) >= 5,
+            storage=storage_type,
+        )
+        storage = STORAGES[storage_type](db[name])
+        try:
+            started = time.perf_counter()
+            await storage.insert_many(documents)
+            insert_time = time.perf_counter() - started
+
+            stats = await db.command("collStats", name)
+
+            started = time.perf_counter()
+            for since in starts:
+                await storage.select(
+                    station_id, {"$gte": since, "$lte": since + window}, None
+                )
+            query_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for _ in range(queries):
+                await storage.last()
+            last_time = time.perf_counter() - started
+        finally:
+            await db.drop_collection(name)
+
+        result[storage_type.value] = {
+            "size": stats["size"],
+            "storage": stats["storageSize"],
+            "indexes": stats["totalIndexSize"],
+            "insert_ms": insert_time * 1000,
+            "query_ms": query_time * 1000 / queries,
+            "last_ms": last_time * 1000 / queries,
+        }
+
+    return result
+
+
+def compression(
+    records: List[models.WeatherRecord], repeat: int = 20
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Compressed size in bytes and CPU time in ms of history responses
+    by every available encoding"""
+    import app.compression as compression
+    import app.series as series
+
+    bodies = {
+        "json": json.dumps(
+            jsonable_encoder(
+                [
+                    models.AnonymousWeatherRecord(**record.dict(by_alias=True))
+                    for record in records
+                ]
+            )
+        ).encode(),
+        "binary": series.encode(
+            series.to_timestamps(records), series.records_columns(records)
+        ),
+    }
+
+    result: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for name, body in bodies.items():
+        result[name] = {"identity": {"bytes": len(body), "ms": 0}}
+        for encoding in compression.ENCODINGS:
+            started = time.process_time()
+            for _ in range(repeat):
+                compressed = compression.compress(body, encoding)
+            result[name][encoding] = {
+                "bytes": len(compressed),
+                "ms": (time.process_time() - started) * 1000 / repeat,
+            }
+
+    return result
@@ -15,6 +15,7 @@
 import asyncio
 import functools
 import os
+import time
 
 import click
 
@@ -48,6 +49,28 @@ def start(host: str, port: int):
     uvicorn.run("app.server:app", host=host, port=port, reload=True)
 
 
+@cli.command(context_settings={"ignore_unknown_options": True})
+@click.option("--host", help="Hostname to listen on")
+@click.option("--port", type=int, help="Port to listen on")
+@click.option("--workers", type=int, help="Worker processes, 0 for the number of cores")
+@click.argument("gunicorn_args", nargs=-1, type=click.UNPROCESSED)
+def serve(host: str, port: int, workers: int, gunicorn_args):
+    """Start the production server
+
+    Options default to the `server` section of the settings, other arguments
+    are passed to gunicorn, e.g. `--log-level=debug`.
+    """
+    from app.serve import Application
+    from app.settings import config
+
+    overrides = {"host": host, "port": port, "workers": workers}
+    settings = config.server.copy(
+        update={key: value for key, value in overrides.items() if value is not None}
+    )
+
+    Application(settings, gunicorn_args).run()
+
+
 @cli.command()
 def ping():
     """Ping the server"""
@@ -56,7 +79,7 @@ def ping():
     port = os.environ.get("PORT", "8000")
 
     try:
-        response = requests.get(f"http://localhost:{port}", timeout=1)
+        response = requests.get(f"http://localhost:{port}/healthz", timeout=1)
         if response.status_code == 200:
             click.echo("Server is up")
         else:
@@ -78,6 +101,146 @@ async def db_init():
     click.echo("Database initialized")
 
 
+def _measurements_collection() -> str:
+    from app.settings import config
+
+    return config.database.measurements
+
+
+@cli.command()
+@click.option(
+    "--source",
+    default="measurements",
+    show_default=True,
+    help="Collection with embedded stations",
+)
+@click.option(
+    "--target",
+    default=_measurements_collection,
+    show_default="database.measurements",
+    help="Collection with compact layout",
+)
+@click.option(
+    "--batch-size", default=10_000, show_default=True, help="Records per batch"
+)
+@make_sync
+async def db_migrate(source: str, target: str, batch_size: int):
+    """Migrate measurements to the compact layout
+
+    The migration can be interrupted and started again, it continues from the
+    last copied record of every station.
+    """
+    from app.migrations import compact_measurements
+    from app.settings import config
+
+    started = time.monotonic()
+    total = 0
+    async for station_id, count in compact_measurements(
+        source, target, batch_size=batch_size
+    ):
+        total += count
+        click.echo(
+            f"{station_id}: +{count}, total {total}, "
+            f"{total / (time.monotonic() - started):.0f} records/s"
+        )
+
+    click.echo(f"Migrated {total} records in {time.monotonic() - started:.1f}s")
+    if target != config.database.measurements:
+        click.echo(f"Set DATABASE__MEASUREMENTS={target} to use the compact collection")
+
+
+@cli.command()
+@click.argument(
+    "files", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False)
+)
+@click.option("--station", help="Station code for rows without a station column")
+@click.option(
+    "--batch-size", default=10_000, show_default=True, help="Records per batch"
+)
+@click.option(
+    "--concurrency", default=4, show_default=True, help="Batches written at once"
+)
+@click.option(
+    "--processes",
+    default=0,
+    show_default=True,
+    help="Processes parsing batches, 0 for the number of cores",
+)
+@make_sync
+async def backfill(
+    files, station: str, batch_size: int, concurrency: int, processes: int
+):
+    """Import historical measurements from CSV or NDJSON files
+
+    CSV files have `timestamp`, `<measure>.<field>` (e.g. `wind.avg`) and
+    optional `station` columns, NDJSON lines are weather records as returned
+    by the API. An interrupted import continues from `<file>.checkpoint`.
+    """
+    from app.backfill import backfill
+
+    for path in files:
+        started = reported = time.monotonic()
+        first = rows = None
+        try:
+            async for rows in backfill(
+                path,
+                station=station,
+                batch_size=batch_size,
+                concurrency=concurrency,
+                processes=processes,
+            ):
+                if first is None:
+                    first = rows
+                if time.monotonic() - reported >= 1:
+                    reported = time.monotonic()
+                    click.echo(
+                        f"{path}: {rows} rows, "
+                        f"{(rows - first) / (reported - started):.0f} rows/s"
+                    )
+        except ValueError as e:
+            raise click.ClickException(str(e)) from e
+
+        elapsed = time.monotonic() - started
+        click.echo(
+            f"{path}: done, {rows} rows in {elapsed:.1f}s, "
+            f"{(rows - first) / elapsed:.0f} rows/s"
+        )
+
+
+@cli.command()
+@click.option("--station", help="Station ID", required=True)
+@click.option("--limit", default=100, show_default=True, help="Page size")
+@make_sync
+async def db_explain(station: str, limit: int):
+    """Check that history pages use the index without sorting in memory"""
+    import app.repositories.measurements as measurements
+    from app.models import PyObjectId
+
+    def stages(plan):
+        if isinstance(plan, dict):
+            for key, value in plan.items():
+                if key == "rejectedPlans":
+                    continue
+                if key == "stage" or key.startswith("$"):
+                    yield value if key == "stage" else key
+                yield from stages(value)
+        elif isinstance(plan, list):
+            for value in plan:
+                yield from stages(value)
+
+    explain = await measurements.explain_page(PyObjectId.validate(station), limit)
+    found = set(stages(explain.get("stages", explain.get("queryPlanner"))))
+    click.echo(f"Stages: {', '.join(sorted(found))}")
+
+    if "IXSCAN" not in found:
+        click.echo("Index is not used")
+        exit(1)
+    if found & {"SORT", "$sort"}:
+        click.echo("Records are sorted in memory")
+        exit(1)
+    click.echo("OK")
+
+
 @cli.command()
 @click.option("--name", help="Name of the user", required=True)
 @make_sync
@@ -109,3 +272,103 @@ async def user_add(name: str):
     await users.insert(user)
 
     click.echo(f"User {name} added with id {user.id}")
+
+
+@cli.group()
+def bench():
+    """Run benchmarks"""
+    pass
+
+
+@bench.command()
+def storage():
+    """Bytes per measurement document"""
+    from app.benchmarks import storage
+
+    sizes = storage()
+    for layout, size in sizes.items():
+        click.echo(f"{layout}: {size} bytes")
+    click.echo(f"saved: {1 - sizes['compact'] / sizes['embedded']:.0%}")
+
+
+@bench.command()
+def series():
+    """Size and encoding time of history responses"""
+    from datetime import timedelta
+
+    from app.benchmarks import sample_records, series
+
+    periods = {
+        "day": (288, timedelta(minutes=5)),
+        "week": (2016, timedelta(minutes=5)),
+        "month": (8640, timedelta(minutes=5)),
+    }
+    for period, (count, step) in periods.items():
+        result = series(sample_records(count, step))
+        click.echo(
+            f"{period} ({count} records): "
+            + ", ".join(
+                f"{format} {value['bytes']} bytes {value['ms']:.1f} ms"
+                for format, value in result.items()
+            )
+            + f", {result['binary']['bytes'] / result['json']['bytes']:.1%} of JSON"
+        )
+
+
+@bench.command()
+def compression():
+    """Bytes saved and CPU time per response by encodings
+
+    Stored variants of immutable responses are sent without CPU time.
+    """
+    from datetime import timedelta
+
+    from app.benchmarks import compression, sample_records
+
+    result = compression(sample_records(2016, timedelta(minutes=5)))
+    for format, encodings in result.items():
+        identity = encodings["identity"]["bytes"]
+        for encoding, value in encodings.items():
+            click.echo(
+                f"{format} {encoding}: {value['bytes']} bytes "
+                f"(saved {1 - value['bytes'] / identity:.0%}), "
+                f"{value['ms']:.2f} ms CPU"
+            )
+
+
+@bench.command()
+def graphs():
+    """Render time, size and peak memory of a week graph by renderers"""
+    from datetime import timedelta
+
+    from app.benchmarks import graphs, sample_records
+
+    records = sample_records(2016, timedelta(minutes=5))
+    for width, height in ((640, 480), (1920, 1080)):
+        for renderer, value in graphs(records, width, height).items():
+            click.echo(
+                f"{width}x{height} {renderer}: {value['ms']:.1f} ms, "
+                f"{value['bytes']} bytes, peak {value['peak'] / 2**20:.1f} MiB"
+            )
+
+
+@bench.command()
+@click.option("--count", default=105_120, show_default=True, help="Records count")
+@click.option("--queries", default=100, show_default=True, help="Range queries count")
+@make_sync
+async def buckets(count: int, queries: int):
+    """Size, day and last readings query latency of storages (needs MongoDB)"""
+    from datetime import timedelta
+
+    from app.benchmarks import buckets, sample_records
+
+    result = await buckets(
+        sample_records(count, timedelta(minutes=5)), timedelta(days=1), queries
+    )
+    for layout, value in result.items():
+        click.echo(
+            f"{layout}: {value['size']} bytes, {value['storage']} on disk, "
+            f"indexes {value['indexes']} bytes, insert {value['insert_ms']:.0f} ms, "
+            f"day query {value['query_ms']:.1f} ms, "
+            f"last readings {value['last_ms']:.1f} ms"
+        )
@@ -0,0 +1,275 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import zlib
+from typing import Dict, Sequence, Set, Union
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.settings import config
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# Response compression depends on the media type: text and JSON are
+# compressed with the best encoding the client accepts, images and other
+# compressed formats are sent as is.
+
+# in order of preference
+ENCODINGS = [
+    encoding
+    for encoding, available in (
+        ("zstd", zstandard is not None),
+        ("br", brotli is not None),
+        ("gzip", True),
+    )
+    if available
+]
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+    "application/vnd.wind.series",
+)
+
+
+def is_compressible(media_type: Union[str, None]) -> bool:
+    return media_type is not None and media_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def negotiate(accept_encoding: Union[str, None]) -> Union[str, None]:
+    """The preferred encoding from `Accept-Encoding`, `None` for identity"""
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+
+    return None
+
+
+class Compressor:
+    """Streaming compressor of an encoding"""
+
+    def __init__(self, encoding: str) -> None:
+        settings = config.compression
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._zstd = zstandard.ZstdCompressor(
+                level=settings.zstd_level
+            ).compressobj()
+        elif encoding == "br":
+            self._brotli = brotli.Compressor(quality=settings.brotli_quality)
+        else:
+            # gzip container
+            self._zlib = zlib.compressobj(settings.gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "zstd":
+            return self._zstd.compress(data)
+        if self.encoding == "br":
+            return self._brotli.process(data)
+        return self._zlib.compress(data)
+
+    def finish(self) -> bytes:
+        if self.encoding == "zstd":
+            return self._zstd.flush()
+        if self.encoding == "br":
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+class CompressionMiddleware:
+    """Compress responses of compressible media types at least `minimum_size`
+    bytes long, responses with `Content-Encoding` are sent as is"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("Accept-Encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Message = {}
+        compressor: Union[Compressor, None] = None
+        passthrough = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start["headers"])
+                if (
+                    "Content-Encoding" in headers
+                    or not is_compressible(headers.get("Content-Type"))
+                    or (len(body) < self.minimum_size and not more_body)
+                ):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+
+                compressor = Compressor(encoding)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    body = compressor.compress(body) + compressor.finish()
+                    headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({**message, "body": body})
+                    return
+                await send(start)
+
+            body = compressor.compress(body)
+            if not more_body:
+                body += compressor.finish()
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+class CompressedBody:
+    """A response body stored along with its variants in every encoding,
+    so it is sent again without compressing"""
+
+    def __init__(
+        self,
+        body: bytes,
+        media_type: str,
+        headers: Union[Dict[str, str], None] = None,
+    ) -> None:
+        self.body = body
+        self.media_type = media_type
+        self.headers = headers or {}
+        self.variants: Dict[str, bytes] = (
+            {encoding: compress(body, encoding) for encoding in ENCODINGS}
+            if is_compressible(media_type)
+            and len(body) >= config.compression.minimum_size
+            else {}
+        )
+        self.size = len(body) + sum(len(variant) for variant in self.variants.values())
+
+    def response(self, request: Request) -> Response:
+        headers = dict(self.headers)
+        if self.variants:
+            headers["Vary"] = ", ".join(
+                value for value in (headers.get("Vary"), "Accept-Encoding") if value
+            )
+
+        encoding = negotiate(request.headers.get("Accept-Encoding"))
+        if encoding not in self.variants:
+            return Response(self.body, media_type=self.media_type, headers=headers)
+
+        return Response(
+            self.variants[encoding],
+            media_type=self.media_type,
+            headers={**headers, "Content-Encoding": encoding},
+        )
+
+
+class BodyCache:
+    """Immutable responses with their compressed variants, LRU within
+    `cache_size` bytes. Responses may be tagged to be evicted together."""
+
+    def __init__(self) -> None:
+        self.settings = config.compression
+        self._bodies: "collections.OrderedDict[str, CompressedBody]" = (
+            collections.OrderedDict()
+        )
+        self._size = 0
+        self._tags: Dict[str, Set[str]] = {}
+        self._tagged: Dict[str, Sequence[str]] = {}
+
+    def get(self, key: str) -> Union[CompressedBody, None]:
+        body = self._bodies.get(key)
+        if body is not None:
+            self._bodies.move_to_end(key)
+
+        return body
+
+    def put(self, key: str, body: CompressedBody, tags: Sequence[str] = ()) -> None:
+        self._discard(key)
+        self._bodies[key] = body
+        self._size += body.size
+        if tags:
+            self._tagged[key] = tags
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while self._size > self.settings.cache_size and self._bodies:
+            self._discard(next(iter(self._bodies)))
+
+    def evict(self, tag: str) -> None:
+        """Drop responses with a tag"""
+        for key in list(self._tags.get(tag, ())):
+            self._discard(key)
+
+    def _discard(self, key: str) -> None:
+        body = self._bodies.pop(key, None)
+        if body is not None:
+            self._size -= body.size
+        for tag in self._tagged.pop(key, ()):
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+cache = BodyCache()
@@ -12,14 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
+from typing import Container, Union
+
 import motor.motor_asyncio as motor
-from app.settings import config
+import pymongo
+from app.settings import StorageType, config
 
 logger = logging.getLogger(__name__)
 
-client = motor.AsyncIOMotorClient(config.database.dsn)
+# connect on first use, so the client can be created before workers are forked
+client = motor.AsyncIOMotorClient(config.database.dsn, connect=False)
 db = client[config.database.database]
+# readings of the legacy collection are not migrated yet, so past days of
+# stations may still change, servers check it in background
+unmigrated = False
+_migration_check: Union[asyncio.Task, None] = None
 
 
 async def init():
@@ -37,17 +46,114 @@ async def init():
         await db.create_collection("stations")
         await db.stations.create_index([("code", 1)], unique=True)
 
-    if "measurements" not in collections:
-        options = (
-            {
-                "timeseries": {
-                    "timeField": "timestamp",
-                    "metaField": "station",
-                    "granularity": "minutes",
-                }
-            }
-            if int(server_version[0]) >= 5
-            else {}
+    # stations added before the geospatial index have no location
+    await db.stations.update_many(
+        {"location": {"$exists": False}},
+        [{"$set": {"location": {"type": "Point", "coordinates": ["$lon", "$lat"]}}}],
+    )
+    await db.stations.create_index([("location", pymongo.GEOSPHERE)])
+
+    if "sketches" not in collections:
+        await db.create_collection("sketches")
+        await db.sketches.create_index([("s", 1), ("f", 1), ("d", 1)], unique=True)
+
+    if await _has_unmigrated(collections):
+        logger.warning(
+            "Measurements with embedded stations are not migrated, past days are "
+            "not cached until then, run: "
+            f"python -m app db-migrate --target {config.database.measurements}"
+        )
+
+    if config.database.measurements not in collections:
+        await create_measurements(
+            config.database.measurements, timeseries=int(server_version[0]) >= 5
+        )
+
+    # new readings are polled by write order when change streams are unavailable
+    measurements = db[config.database.measurements]
+    if config.database.storage == StorageType.buckets:
+        # the last bucket of a station is found by hour and insertion order,
+        # collections created before have an index by hour only
+        await measurements.create_index([("s", 1), ("h", -1), ("_id", -1)])
+        await measurements.create_index([("u", -1)])
+    elif "timeseries" in await measurements.options():
+        # other collections have an index by id already
+        try:
+            await measurements.create_index([("_id", 1)])
+        except pymongo.errors.OperationFailure as e:
+            logger.warning(f"Measurements are not polled without an index by id: {e}")
+
+
+async def _has_unmigrated(collections: Container[str]) -> bool:
+    # imported here, migrations use this module
+    from app.migrations import LEGACY_MEASUREMENTS, is_migrated
+
+    # readings of the releases before the compact layout stay in the legacy
+    # collection until they are migrated
+    return bool(
+        LEGACY_MEASUREMENTS in collections
+        and config.database.measurements != LEGACY_MEASUREMENTS
+        and await db[LEGACY_MEASUREMENTS].find_one(
+            {"station": {"$exists": True}}, {"_id": 1}
         )
-        await db.create_collection("measurements", **options)
-        await db.measurements.create_index([("station._id", 1), ("timestamp", -1)])
+        and not await is_migrated(LEGACY_MEASUREMENTS, config.database.measurements)
+    )
+
+
+def start_migration_check(interval: float = 60) -> None:
+    """Keep `unmigrated` up to date until legacy readings are migrated"""
+    global _migration_check, unmigrated
+    if _migration_check is None:
+        # nothing is cached as final before the first check
+        unmigrated = True
+        _migration_check = asyncio.create_task(_check_migration(interval))
+
+
+async def stop_migration_check() -> None:
+    global _migration_check
+    if _migration_check is not None:
+        _migration_check.cancel()
+        _migration_check = None
+
+
+async def _check_migration(interval: float) -> None:
+    global unmigrated
+    while True:
+        try:
+            unmigrated = await _has_unmigrated(await db.list_collection_names())
+        except pymongo.errors.PyMongoError as e:
+            logger.warning(f"Failed to check the migration of measurements: {e!r}")
+        else:
+            if not unmigrated:
+                return
+        await asyncio.sleep(interval)
+
+
+async def create_measurements(
+    name: str,
+    *,
+    timeseries: bool = True,
+    storage: StorageType = config.database.storage,
+    database: Union[motor.AsyncIOMotorDatabase, None] = None,
+):
+    if database is None:
+        database = db
+
+    if storage == StorageType.buckets:
+        await database.create_collection(name)
+        await database[name].create_index([("s", 1), ("h", -1), ("_id", -1)])
+        return
+
+    options = (
+        {
+            "timeseries": {
+                "timeField": "t",
+                "metaField": "s",
+                "granularity": "minutes",
+            }
+        }
+        if timeseries
+        else {}
+    )
+    await database.create_collection(name, **options)
+    await database[name].create_index([("s", 1), ("t", -1)])
@@ -13,10 +13,12 @@
 # limitations under the License.
 
 from datetime import datetime, tzinfo
+import functools
 import pytz
 import pydantic
 import fastapi
 
+import app.ingest as ingest
 from app.models import AnonymousWeatherRecord, WindValue, MeasureValue
 from app.tasks import import_data
 
@@ -81,7 +83,15 @@ class RawData(pydantic.BaseModel):
     realtime: int
 
 
-@router.get("", status_code=201, description="Process data in PWS format")
+@router.get(
+    "",
+    status_code=201,
+    description="Process data in PWS format",
+    responses={
+        202: {"description": "Station sends too often, reading is coalesced"},
+        503: {"description": "Too many readings in progress"},
+    },
+)
 async def process(data: RawData = fastapi.Depends(RawData)):
     record = AnonymousWeatherRecord(
         timestamp=data.dateutc.replace(tzinfo=pytz.utc),
@@ -100,8 +110,16 @@ async def process(data: RawData = fastapi.Depends(RawData)):
     )
 
     try:
-        await import_data(data.ID, record)
+        written = await ingest.admission.submit(
+            data.ID, functools.partial(import_data, data.ID, record)
+        )
     except ValueError as e:
         raise fastapi.HTTPException(status_code=400, detail=str(e)) from e
+    except ingest.Overloaded as e:
+        raise fastapi.HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        ) from e
 
-    return fastapi.Response(status_code=201)
+    return fastapi.Response(status_code=201 if written else 202)
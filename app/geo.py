@@ -0,0 +1,116 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from typing import List, Tuple, Union
+
+import numpy as np
+
+import app.invalidation as invalidation
+import app.models as models
+import app.repositories.stations as stations
+
+EARTH_RADIUS = 6371.0088  # km
+
+
+def _to_xyz(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1
+    )
+
+
+class StationIndex:
+    """In-memory index of station coordinates.
+
+    Stations are kept as unit vectors in a NumPy array, so a nearest or
+    bounding box search is a single vectorized pass, which takes a few
+    microseconds for thousands of stations. The index is reloaded after
+    `invalidate` or when it is older than `ttl` seconds, the latter picks up
+    changes made by other processes.
+    """
+
+    def __init__(self, ttl: float = 60.0) -> None:
+        self.ttl = ttl
+        self._lock: Union[asyncio.Lock, None] = None
+        self.load([])
+        self._loaded_at: Union[float, None] = None
+
+    def load(self, items: List[models.Station]) -> None:
+        self._stations = items
+        self._lat = np.array([station.lat for station in items], dtype=np.float64)
+        self._lon = np.array([station.lon for station in items], dtype=np.float64)
+        self._xyz = _to_xyz(self._lat, self._lon).reshape(-1, 3)
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+
+    def is_fresh(self) -> bool:
+        return (
+            self._loaded_at is not None
+            and time.monotonic() - self._loaded_at < self.ttl
+        )
+
+    async def refresh(self) -> None:
+        if self.is_fresh():
+            return
+
+        # created on first use to bind to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if not self.is_fresh():
+                self.load(await stations.select())
+
+    async def nearby(
+        self, lat: float, lon: float, limit: int
+    ) -> List[Tuple[models.Station, float]]:
+        """Nearest stations with distances in kilometers"""
+        await self.refresh()
+        if not self._stations:
+            return []
+
+        dot = self._xyz @ _to_xyz(np.float64(lat), np.float64(lon))
+        limit = min(limit, len(self._stations))
+        nearest = np.argpartition(-dot, limit - 1)[:limit]
+        nearest = nearest[np.argsort(-dot[nearest])]
+        distances = EARTH_RADIUS * np.arccos(np.clip(dot[nearest], -1.0, 1.0))
+
+        return [
+            (self._stations[i], float(distance))
+            for i, distance in zip(nearest, distances)
+        ]
+
+    async def within(
+        self, south: float, west: float, north: float, east: float
+    ) -> List[models.Station]:
+        """Stations inside a bounding box, `west > east` crosses the antimeridian"""
+        await self.refresh()
+
+        mask = (self._lat >= south) & (self._lat <= north)
+        if west <= east:
+            mask &= (self._lon >= west) & (self._lon <= east)
+        else:
+            mask &= (self._lon >= west) | (self._lon <= east)
+
+        return [self._stations[i] for i in np.flatnonzero(mask)]
+
+
+index = StationIndex()
+
+invalidation.bus.subscribe(invalidation.STATIONS, lambda event: index.invalidate())
@@ -0,0 +1,241 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, Tuple, Union
+
+import app.invalidation as invalidation
+import app.models as models
+import app.raster as raster
+import app.segments as segments
+from app.settings import Renderer, config
+
+logger = logging.getLogger(__name__)
+
+
+class GraphKey(NamedTuple):
+    station_id: models.PyObjectId
+    param: models.MeasureType
+    width: int
+    height: int
+    renderer: Renderer
+
+
+class Graph(NamedTuple):
+    png: bytes
+    rendered_at: float
+
+
+def render(
+    width: int,
+    height: int,
+    lines: List[Tuple[Sequence, Sequence, Union[str, None]]],
+    renderer: Union[Renderer, None] = None,
+) -> bytes:
+    """Render lines to PNG, safe to call from worker threads.
+
+    Graphs with labeled lines need a legend, so they are rendered by matplotlib.
+    """
+    if (renderer or config.graphs.renderer) == Renderer.raster and not any(
+        label for _, _, label in lines
+    ):
+        return raster.render(width, height, lines)
+
+    return _render_matplotlib(width, height, lines)
+
+
+def _render_matplotlib(
+    width: int, height: int, lines: List[Tuple[Sequence, Sequence, Union[str, None]]]
+) -> bytes:
+    # matplotlib takes a while to import and tens of megabytes of memory
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(width / 100, height / 100), dpi=100)
+    ax = fig.subplots()
+    for x, y, label in lines:
+        ax.plot(x, y, label=label)
+    if any(label for _, _, label in lines):
+        ax.legend()
+    # ax.set_title(str(param))
+    # ax.set_xlabel("Time")
+    # ax.set_ylabel(str(param))
+    fig.tight_layout()
+    buf = BytesIO()
+    fig.savefig(buf, format="png")
+
+    return buf.getvalue()
+
+
+class RenderPool:
+    """Threads rendering graphs, renders in progress are counted to report
+    saturation of the pool"""
+
+    def __init__(self) -> None:
+        self.threads = config.graphs.render_threads or os.cpu_count() or 1
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(self.threads, "render")
+
+    @property
+    def saturation(self) -> float:
+        """Renders in progress or queued per thread"""
+        return self.pending / self.threads
+
+    async def run(self, func: Callable[..., bytes], *args: Any) -> bytes:
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, func, *args
+            )
+        finally:
+            self.pending -= 1
+
+
+pool = RenderPool()
+
+
+async def render_station(key: GraphKey, period: models.Period) -> bytes:
+    """Render a graph of a station parameter for a period"""
+    timestamps, y = await segments.cache.select(key.station_id, key.param, period)
+    x = timestamps.astype("datetime64[ms]")
+
+    return await pool.run(render, key.width, key.height, [(x, y, None)], key.renderer)
+
+
+class GraphCache:
+    """Graphs for the default period of the most requested stations.
+
+    A cached graph is served until its station gets new readings and then for
+    at most `max_age` seconds more, while the warmer renders it again in the
+    background. The warmer sleeps between renders to stay within its CPU share,
+    which is split between the worker processes.
+    """
+
+    def __init__(self) -> None:
+        self.settings = config.graphs
+        self._graphs: "collections.OrderedDict[GraphKey, Graph]" = (
+            collections.OrderedDict()
+        )
+        self._requests: "collections.Counter[GraphKey]" = collections.Counter()
+        self._updated_at: Dict[models.PyObjectId, float] = {}
+        self._task: Union[asyncio.Task, None] = None
+        # worker processes of the server, they share the CPU of the warmer
+        self.workers = 1
+
+    async def get(self, key: GraphKey) -> bytes:
+        self._requests[key] += 1
+
+        graph = self._graphs.get(key)
+        if graph is not None and not self._is_expired(key, graph):
+            self._graphs.move_to_end(key)
+            return graph.png
+
+        return await self._refresh(key)
+
+    def notify(self, station_id: Union[models.PyObjectId, None]) -> None:
+        """Mark graphs of a station, or of all stations, as outdated after new
+        readings"""
+        updated_at = time.monotonic()
+        if station_id is None:
+            for key in self._graphs:
+                self._updated_at[key.station_id] = updated_at
+        else:
+            self._updated_at[station_id] = updated_at
+
+    def start(self) -> None:
+        if self._task is None and self.settings.warmer_cpu > 0:
+            self._task = asyncio.create_task(self._warm())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _is_outdated(self, key: GraphKey, graph: Graph) -> bool:
+        if invalidation.MEASUREMENTS in invalidation.bus.degraded:
+            # new readings are not delivered, any graph may be outdated
+            return True
+        return self._updated_at.get(key.station_id, 0) > graph.rendered_at
+
+    def _is_expired(self, key: GraphKey, graph: Graph) -> bool:
+        return (
+            self._is_outdated(key, graph)
+            and time.monotonic() - graph.rendered_at > self.settings.max_age
+        )
+
+    async def _refresh(self, key: GraphKey) -> bytes:
+        rendered_at = time.monotonic()
+        png = await render_station(key, models.Period(start=None, end=None))
+
+        self._graphs[key] = Graph(png, rendered_at)
+        self._graphs.move_to_end(key)
+        while len(self._graphs) > self.settings.cache_size:
+            self._graphs.popitem(last=False)
+
+        return png
+
+    async def _warm(self) -> None:
+        decayed_at = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+
+            if time.monotonic() - decayed_at > self.settings.warmer_window:
+                self._decay()
+                decayed_at = time.monotonic()
+
+            for key in self._stale():
+                started = time.monotonic()
+                try:
+                    await self._refresh(key)
+                except Exception:
+                    logger.exception(f"Failed to render graph {key}")
+
+                await asyncio.sleep(self._pause(time.monotonic() - started))
+
+    def _decay(self) -> None:
+        # keep recent popularity only
+        self._requests = collections.Counter(
+            {key: count // 2 for key, count in self._requests.items() if count > 1}
+        )
+
+    def _stale(self) -> List[GraphKey]:
+        """Most requested graphs to render again"""
+        stale = []
+        for key, _ in self._requests.most_common(self.settings.warmer_top):
+            graph = self._graphs.get(key)
+            if graph is None or (
+                self._is_outdated(key, graph)
+                and time.monotonic() - graph.rendered_at >= self.settings.max_age / 2
+            ):
+                stale.append(key)
+
+        return stale
+
+    def _pause(self, elapsed: float) -> float:
+        """Seconds to sleep after a render of `elapsed` seconds"""
+        # every worker process runs its own warmer
+        cpu = self.settings.warmer_cpu / self.workers
+        return elapsed * (1 - cpu) / cpu
+
+
+cache = GraphCache()
+
+invalidation.bus.subscribe(
+    invalidation.MEASUREMENTS, lambda event: cache.notify(event.key)
+)
@@ -0,0 +1,114 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Tuple, Union
+
+import app.graphs as graphs
+import app.ingest as ingest
+import app.invalidation as invalidation
+from app.database import client
+from app.settings import config
+from app.spool import spool
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseCheck:
+    """Database is pinged in background, so readiness is checked without I/O"""
+
+    def __init__(self) -> None:
+        self.settings = config.health
+        self.ok = False
+        self.latency: Union[float, None] = None
+        self.error: Union[str, None] = None
+        self.checked_at: Union[float, None] = None
+        self._task: Union[asyncio.Task, None] = None
+
+    @property
+    def age(self) -> Union[float, None]:
+        """Seconds since the last ping"""
+        if self.checked_at is None:
+            return None
+        return time.monotonic() - self.checked_at
+
+    @property
+    def is_available(self) -> bool:
+        age = self.age
+        return self.ok and age is not None and age < 3 * self.settings.interval
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def check(self) -> None:
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(client.admin.command("ping"), self.settings.timeout)
+        except Exception as e:
+            if self.ok:
+                logger.warning(f"Database is not available: {e!r}")
+            self.ok, self.error = False, repr(e)
+        else:
+            self.ok, self.error = True, None
+        self.checked_at = time.monotonic()
+        self.latency = self.checked_at - started
+
+    async def _run(self) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(self.settings.interval)
+
+
+database = DatabaseCheck()
+
+
+def readiness() -> Tuple[bool, Dict[str, Any]]:
+    """Whether the server can take traffic and the state of its dependencies"""
+    settings = config.health
+    spool_stats = spool.stats() if spool.running else None
+    checks = {
+        "database": {
+            "ok": database.is_available,
+            "latency": database.latency,
+            "age": database.age,
+            "error": database.error,
+        },
+        "ingest": {
+            "ok": ingest.admission.inflight < ingest.admission.max_inflight
+            and (spool_stats is None or spool_stats["lag"] <= settings.max_spool_lag),
+            "inflight": ingest.admission.inflight,
+            "spool": spool_stats,
+        },
+        "invalidation": {
+            "ok": not config.invalidation.enabled or invalidation.bus.is_running,
+            "degraded": invalidation.bus.degraded,
+            **invalidation.bus.stats(),
+        },
+        "render": {
+            "ok": graphs.pool.saturation <= settings.max_render_saturation,
+            "threads": graphs.pool.threads,
+            "pending": graphs.pool.pending,
+            "saturation": graphs.pool.saturation,
+        },
+    }
+
+    return all(check["ok"] for check in checks.values()), checks
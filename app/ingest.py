@@ -0,0 +1,145 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import math
+import time
+from typing import Awaitable, Callable, Dict, Set
+
+from app.settings import config
+
+logger = logging.getLogger(__name__)
+
+Write = Callable[[], Awaitable[None]]
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Too many readings in progress")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, capacity: float) -> None:
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, rate: float, capacity: float) -> None:
+        now = time.monotonic()
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+    def take(self, rate: float, capacity: float) -> float:
+        """Take a token, returns 0 or seconds until a token is available"""
+        self.refill(rate, capacity)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+
+class Admission:
+    """Admission control of incoming readings.
+
+    Every station has a token bucket, readings above its rate are coalesced:
+    only the newest one is kept and written when the next token is available.
+    When too many writes are in progress (the database falls behind) new
+    readings are rejected with `Overloaded`.
+
+    The limits of the settings are for the whole server, every worker process
+    admits its part of them. Readings of a station are spread over the
+    workers, so its burst is kept per worker when it is less than their count.
+    """
+
+    MAX_BUCKETS = 10_000
+
+    def __init__(self) -> None:
+        self.settings = config.ingest
+        self.inflight = 0
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._pending: Dict[str, Write] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        # worker processes of the server, they share the limits
+        self.workers = 1
+
+    @property
+    def max_inflight(self) -> int:
+        return math.ceil(self.settings.max_inflight / self.workers)
+
+    @property
+    def rate(self) -> float:
+        return self.settings.rate / self.workers
+
+    @property
+    def burst(self) -> float:
+        # a token bucket of less than a token never admits a reading
+        return max(1, self.settings.burst / self.workers)
+
+    async def submit(self, key: str, write: Write) -> bool:
+        """Write a reading, returns False if it is coalesced"""
+        if self.inflight >= self.max_inflight:
+            raise Overloaded(self.settings.retry_after)
+
+        wait = self._bucket(key).take(self.rate, self.burst)
+        if wait > 0:
+            if key not in self._pending:
+                task = asyncio.create_task(self._flush(key, wait))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            self._pending[key] = write
+            return False
+
+        await self._write(write)
+        return True
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(self.burst)
+
+        return bucket
+
+    def _prune(self) -> None:
+        # full buckets are the same as new ones
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(self.rate, self.burst)
+            if bucket.tokens >= self.burst and key not in self._pending:
+                del self._buckets[key]
+
+    async def _write(self, write: Write) -> None:
+        self.inflight += 1
+        try:
+            await write()
+        finally:
+            self.inflight -= 1
+
+    async def _flush(self, key: str, delay: float) -> None:
+        await asyncio.sleep(delay)
+
+        write = self._pending.pop(key)
+        self._buckets[key].take(self.rate, self.burst)
+        try:
+            await self._write(write)
+        except ValueError as e:
+            logger.warning(f"Coalesced reading of {key} is rejected: {e}")
+        except Exception:
+            logger.exception(f"Failed to write coalesced reading of {key}")
+
+
+admission = Admission()
@@ -0,0 +1,321 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, NamedTuple, Union
+
+import bson
+import pymongo.errors
+
+import app.models as models
+import app.repositories.measurements as measurements
+import app.repositories.stations as stations
+from app.settings import InvalidationSource, config
+
+logger = logging.getLogger(__name__)
+
+STATIONS = "stations"
+MEASUREMENTS = "measurements"
+
+# source of a topic that is not delivered, caches expire by their age only
+EXPIRY = "expiry"
+# recent deliveries the lag is reported for
+LAG_WINDOW = 100
+
+
+class Event(NamedTuple):
+    topic: str
+    # changed station, None when any station may have changed
+    key: Union[models.PyObjectId, None]
+    # time of the newest changed reading if known, otherwise of the write, UTC
+    time: datetime
+
+
+Handler = Callable[[Event], None]
+
+
+def _naive(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _written_at(change: Dict[str, Any]) -> datetime:
+    # wall time is reported by MongoDB 6.0+, cluster time has second precision
+    if "wallTime" in change:
+        return _naive(change["wallTime"])
+    return _naive(change["clusterTime"].as_datetime())
+
+
+def _reading_time(change: Dict[str, Any]) -> Union[datetime, None]:
+    """Time of the newest reading in a change of measurements"""
+    document = change.get("fullDocument") or {}
+    if "t" in document:
+        return document["t"]
+
+    # readings pushed to a bucket, or the hour of a new bucket
+    pushed = []
+    for value in change.get("updateDescription", {}).get("updatedFields", {}).values():
+        for reading in value if isinstance(value, list) else [value]:
+            if isinstance(reading, dict) and "t" in reading:
+                pushed.append(reading["t"])
+    if pushed:
+        return max(pushed)
+
+    return document.get("h")
+
+
+PIPELINES = {
+    STATIONS: [
+        {
+            "$project": {
+                "operationType": 1,
+                "clusterTime": 1,
+                "wallTime": 1,
+                "documentKey": 1,
+            }
+        }
+    ],
+    MEASUREMENTS: [
+        {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}},
+        {
+            "$project": {
+                "operationType": 1,
+                "clusterTime": 1,
+                "wallTime": 1,
+                "fullDocument.s": 1,
+                "fullDocument.t": 1,
+                "fullDocument.h": 1,
+                "updateDescription.updatedFields": 1,
+            }
+        },
+    ],
+}
+
+
+class Topic:
+    def __init__(self) -> None:
+        self.handlers: List[Handler] = []
+        self.source: Union[str, None] = None
+        self.events = 0
+        self.lags: "collections.deque[float]" = collections.deque(maxlen=LAG_WINDOW)
+
+
+class InvalidationBus:
+    """Delivers writes of stations and measurements made by any process to
+    the in-process caches.
+
+    Changes come from MongoDB change streams, or from polling where those are
+    unavailable: on a standalone server and for time series collections.
+    Modules subscribe to a topic and evict the station of an event, or
+    everything when the station is None, e.g. after a change stream was
+    reopened and changes might be lost. Lag is the time from a write to its
+    delivery, for polled measurements it is counted from the creation of the
+    reading id.
+    """
+
+    def __init__(self) -> None:
+        self.settings = config.invalidation
+        self._topics = {STATIONS: Topic(), MEASUREMENTS: Topic()}
+        self._tasks: List[asyncio.Task] = []
+
+    def subscribe(self, topic: str, handler: Handler) -> None:
+        self._topics[topic].handlers.append(handler)
+
+    def publish(self, event: Event, written_at: Union[datetime, None] = None) -> None:
+        topic = self._topics[event.topic]
+        topic.events += 1
+        lag = datetime.utcnow() - (written_at or _naive(event.time))
+        topic.lags.append(max(lag.total_seconds(), 0.0))
+
+        for handler in topic.handlers:
+            try:
+                handler(event)
+            except Exception:
+                logger.exception(f"Failed to handle {event}")
+
+    def start(self) -> None:
+        if self._tasks or not self.settings.enabled:
+            return
+
+        self._tasks = [
+            asyncio.create_task(
+                self._run(STATIONS, stations.collection, self._poll_stations)
+            ),
+            asyncio.create_task(
+                self._run(
+                    MEASUREMENTS, measurements.collection, self._poll_measurements
+                )
+            ),
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        """Source, delivered events and lag in seconds over recent events"""
+        return {
+            name: {
+                "source": topic.source,
+                "events": topic.events,
+                "lag": topic.lags[-1] if topic.lags else None,
+                "max_lag": max(topic.lags, default=None),
+            }
+            for name, topic in self._topics.items()
+        }
+
+    @property
+    def degraded(self) -> List[str]:
+        """Topics that are not delivered"""
+        return [name for name, topic in self._topics.items() if topic.source == EXPIRY]
+
+    @property
+    def is_running(self) -> bool:
+        return all(topic.source is not None for topic in self._topics.values())
+
+    async def _run(self, name: str, collection, poll) -> None:
+        if self.settings.source != InvalidationSource.polling:
+            try:
+                return await self._watch(name, collection)
+            except pymongo.errors.OperationFailure as e:
+                if self.settings.source == InvalidationSource.change_streams:
+                    logger.error(f"Change streams on {name} are unavailable: {e}")
+                    return
+                logger.info(f"Polling {name}, change streams are unavailable: {e}")
+
+        self._topics[name].source = "polling"
+        await poll()
+
+    async def _watch(self, name: str, collection) -> None:
+        """Deliver a change stream, it is resumed after errors and reopened
+        when it can not be resumed"""
+        resume_token = None
+        opened = False
+        while True:
+            try:
+                async with collection.watch(
+                    PIPELINES[name],
+                    resume_after=resume_token,
+                    # updates of buckets do not include the station
+                    full_document="updateLookup" if name == MEASUREMENTS else None,
+                ) as stream:
+                    if opened and resume_token is None:
+                        self.publish(Event(name, None, datetime.utcnow()))
+                    opened = True
+                    resume_token = stream.resume_token
+                    self._topics[name].source = "change_stream"
+
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        self._deliver(name, change)
+
+                # the collection is dropped or renamed
+                resume_token = None
+            except pymongo.errors.OperationFailure:
+                if not opened:
+                    raise
+                logger.exception(f"Change stream on {name} can not be resumed")
+                resume_token = None
+                await asyncio.sleep(self.settings.retry_interval)
+            except pymongo.errors.PyMongoError:
+                logger.exception(f"Change stream on {name} failed")
+                await asyncio.sleep(self.settings.retry_interval)
+
+    def _deliver(self, name: str, change: Dict[str, Any]) -> None:
+        written_at = _written_at(change)
+        if name == STATIONS:
+            key = change.get("documentKey", {}).get("_id")
+            self.publish(Event(name, key, written_at), written_at)
+            return
+
+        station_id = (change.get("fullDocument") or {}).get("s")
+        if station_id is not None:
+            timestamp = _reading_time(change) or written_at
+            self.publish(Event(name, station_id, timestamp), written_at)
+
+    async def _poll_stations(self) -> None:
+        known: Union[Dict[models.PyObjectId, models.Station], None] = None
+        polled_at = datetime.utcnow()
+        while True:
+            try:
+                current = {station.id: station for station in await stations.select()}
+            except pymongo.errors.PyMongoError:
+                logger.exception("Failed to poll stations")
+            else:
+                # a change is written after the previous poll at the earliest
+                if known is not None:
+                    for key in known.keys() | current.keys():
+                        if known.get(key) != current.get(key):
+                            self.publish(Event(STATIONS, key, polled_at))
+                known = current
+                polled_at = datetime.utcnow()
+
+            await asyncio.sleep(self.settings.poll_interval)
+
+    async def _poll_measurements(self) -> None:
+        while True:
+            try:
+                indexed = await measurements.can_poll()
+                break
+            except pymongo.errors.PyMongoError:
+                logger.exception("Failed to check the index of measurements")
+                await asyncio.sleep(self.settings.retry_interval)
+        if not indexed:
+            # a scan of all readings every poll costs more than the caches save
+            logger.warning(
+                "Measurements are not polled without an index by write order, "
+                "caches are refreshed by their age only"
+            )
+            self._topics[MEASUREMENTS].source = EXPIRY
+            return
+
+        # readings are polled by their ids, which are created shortly before
+        # they are written, e.g. the spool replays them later: the overlap of
+        # polls catches those and the newest delivered id skips repeats
+        delivered: Dict[models.PyObjectId, bson.ObjectId] = {}
+        since = datetime.utcnow()
+        while True:
+            await asyncio.sleep(self.settings.poll_interval)
+            polled_at = datetime.utcnow()
+            try:
+                updates = await measurements.select_updated(since)
+            except pymongo.errors.PyMongoError:
+                logger.exception("Failed to poll measurements")
+                continue
+
+            for update in updates:
+                last_id = delivered.get(update.station_id)
+                if last_id is not None and update.last_id <= last_id:
+                    continue
+                delivered[update.station_id] = update.last_id
+                written_at = _naive(update.last_id.generation_time)
+                self.publish(
+                    Event(MEASUREMENTS, update.station_id, update.last), written_at
+                )
+                # imported readings may change past days behind the newest one
+                if update.first < update.last:
+                    self.publish(
+                        Event(MEASUREMENTS, update.station_id, update.first),
+                        written_at,
+                    )
+            since = polled_at - timedelta(seconds=self.settings.poll_overlap)
+
+
+bus = InvalidationBus()
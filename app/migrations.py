@@ -0,0 +1,117 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from datetime import datetime
+from typing import AsyncIterator, List, Tuple, Union
+
+import app.models as models
+import app.repositories.measurements as measurements
+import app.segments as segments
+import pymongo
+from app.database import client, create_measurements, db
+from app.repositories.storage import STORAGES, Document
+from app.settings import config
+
+logger = logging.getLogger(__name__)
+
+# collection with embedded stations written before the compact layout
+LEGACY_MEASUREMENTS = "measurements"
+
+
+def _checkpoint_id(
+    source: str, target: str, station_id: Union[models.PyObjectId, None] = None
+) -> Document:
+    checkpoint: Document = {"source": source, "target": target}
+    if station_id is not None:
+        checkpoint["station"] = station_id
+    return checkpoint
+
+
+async def is_migrated(source: str, target: str) -> bool:
+    """Whether a migration from `source` to `target` has finished"""
+    return (
+        await db.migrations.find_one({"_id": _checkpoint_id(source, target)})
+        is not None
+    )
+
+
+async def compact_measurements(
+    source: str, target: str, *, batch_size: int = 10_000
+) -> AsyncIterator[Tuple[models.PyObjectId, int]]:
+    """Copy measurements stored with embedded stations to the compact layout.
+
+    Yields a station id and the number of records copied for each batch.
+    The time of the last copied batch of a station is saved as a checkpoint,
+    so an interrupted migration continues where it stopped. The target may
+    already get new readings, so checkpoints are kept in the `migrations`
+    collection and the batch after a checkpoint is copied without readings
+    that are already there.
+    """
+    if target not in await db.list_collection_names():
+        server_info = await client.server_info()
+        await create_measurements(
+            target, timeseries=int(server_info["version"].split(".")[0]) >= 5
+        )
+
+    source_collection = db[source]
+    target_storage = STORAGES[config.database.storage](db[target])
+
+    for station_id in await source_collection.distinct("station._id"):
+        checkpoint_id = _checkpoint_id(source, target, station_id)
+        checkpoint = await db.migrations.find_one({"_id": checkpoint_id})
+        since = checkpoint["t"] if checkpoint else datetime.min
+        # the batch after the checkpoint may be written already
+        resumed = True
+        logger.info(f"Migrating station {station_id} since {since}")
+
+        cursor = source_collection.find(
+            {"station._id": station_id, "timestamp": {"$gt": since}},
+            sort=[("timestamp", pymongo.ASCENDING)],
+            batch_size=batch_size,
+        )
+        batch = []
+        async for doc in cursor:
+            batch.append(measurements.to_document(models.WeatherRecord(**doc)))
+            if len(batch) >= batch_size:
+                yield station_id, await _copy(
+                    target_storage, checkpoint_id, batch, resumed
+                )
+                resumed = False
+                batch = []
+
+        if batch:
+            yield station_id, await _copy(target_storage, checkpoint_id, batch, resumed)
+        # cached days of the station on disk miss the migrated readings
+        segments.cache.invalidate(station_id)
+
+    await db.migrations.replace_one(
+        {"_id": _checkpoint_id(source, target)},
+        {"finished": datetime.utcnow()},
+        upsert=True,
+    )
+
+
+async def _copy(
+    target_storage, checkpoint_id: Document, batch: List[Document], resumed: bool
+) -> int:
+    """Insert a batch and save its last time as the checkpoint"""
+    last = batch[-1][measurements.TIME_FIELD]
+    if resumed:
+        batch = await target_storage.exclude_existing(batch)
+    if batch:
+        await target_storage.insert_many(batch, ordered=True)
+    await db.migrations.replace_one({"_id": checkpoint_id}, {"t": last}, upsert=True)
+
+    return len(batch)
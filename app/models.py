@@ -14,7 +14,7 @@
 
 from datetime import datetime, date
 from enum import Enum
-from typing import Union
+from typing import List, Union
 import pydantic
 import bson
 
@@ -62,8 +62,8 @@ class User(BaseModel):
 class StationIn(pydantic.BaseModel):
     code: str = pydantic.Field(..., description="Код станции")
     name: str = pydantic.Field(..., description="Название станции")
-    lat: float = pydantic.Field(..., description="Широта")
-    lon: float = pydantic.Field(..., description="Долгота")
+    lat: float = pydantic.Field(..., ge=-90, le=90, description="Широта")
+    lon: float = pydantic.Field(..., ge=-180, le=180, description="Долгота")
 
 
 class Station(BaseModel, StationIn):
@@ -164,8 +164,10 @@ class MeasureType(Enum):
 
 class AnonymousWeatherRecord(pydantic.BaseModel):
     timestamp: datetime = pydantic.Field(..., description="Дата и время")
-    wind: WindValue = pydantic.Field(..., description="Ветер")
-    temperature: MeasureValue = pydantic.Field(..., description="Температура")
+    wind: Union[WindValue, None] = pydantic.Field(..., description="Ветер")
+    temperature: Union[MeasureValue, None] = pydantic.Field(
+        ..., description="Температура"
+    )
     humidity: Union[MeasureValue, None] = pydantic.Field(..., description="Влажность")
     pressure: Union[MeasureValue, None] = pydantic.Field(..., description="Давление")
     light: Union[MeasureValue, None] = pydantic.Field(..., description="Освещенность")
@@ -174,3 +176,40 @@ class AnonymousWeatherRecord(pydantic.BaseModel):
 
 class WeatherRecord(BaseModel, AnonymousWeatherRecord):
     station: Station = pydantic.Field(..., description="Станция")
+
+
+class StationWeather(Station):
+    weather: Union[AnonymousWeatherRecord, None] = pydantic.Field(
+        None, description="Последние погодные данные"
+    )
+
+
+class NearbyStation(StationWeather):
+    distance: float = pydantic.Field(..., description="Расстояние, км")
+
+
+class ComparedSeries(pydantic.BaseModel):
+    stations: List[Station] = pydantic.Field(..., description="Станции")
+    param: MeasureType = pydantic.Field(..., description="Измерение")
+    timestamps: List[datetime] = pydantic.Field(..., description="Общая шкала времени")
+    values: List[List[Union[float, None]]] = pydantic.Field(
+        ..., description="Средние значения, строка на каждую станцию"
+    )
+
+    class Config:
+        # stations are encoded by the encoders of the outer model
+        json_encoders = {bson.ObjectId: str}
+
+
+class Quantile(pydantic.BaseModel):
+    q: float = pydantic.Field(..., description="Квантиль")
+    value: Union[float, None] = pydantic.Field(..., description="Значение")
+
+
+class QuantileStats(pydantic.BaseModel):
+    param: MeasureType = pydantic.Field(..., description="Измерение")
+    field: str = pydantic.Field(..., description="Поле значения")
+    start: date = pydantic.Field(..., description="Начало периода")
+    end: date = pydantic.Field(..., description="Конец периода")
+    count: int = pydantic.Field(..., description="Количество измерений")
+    quantiles: List[Quantile] = pydantic.Field(..., description="Квантили")
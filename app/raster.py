@@ -0,0 +1,318 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import struct
+import zlib
+from datetime import datetime, timezone
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+
+# Line graphs rasterized with NumPy and encoded to PNG with zlib, without
+# matplotlib. There are no legends: labels are limited to the digits font.
+
+BACKGROUND = (255, 255, 255)
+FOREGROUND = (64, 64, 64)
+GRID = (232, 232, 232)
+# matplotlib "tab10" colors
+COLORS = [
+    (31, 119, 180),
+    (255, 127, 14),
+    (44, 160, 44),
+    (214, 39, 40),
+    (148, 103, 189),
+    (140, 86, 75),
+    (227, 119, 194),
+    (127, 127, 127),
+    (188, 189, 34),
+    (23, 190, 207),
+]
+
+# 3x5 glyphs, "#" is a set pixel
+FONT = {
+    "0": ["###", "#.#", "#.#", "#.#", "###"],
+    "1": [".#.", "##.", ".#.", ".#.", "###"],
+    "2": ["###", "..#", "###", "#..", "###"],
+    "3": ["###", "..#", ".##", "..#", "###"],
+    "4": ["#.#", "#.#", "###", "..#", "..#"],
+    "5": ["###", "#..", "###", "..#", "###"],
+    "6": ["###", "#..", "###", "#.#", "###"],
+    "7": ["###", "..#", ".#.", ".#.", ".#."],
+    "8": ["###", "#.#", "###", "#.#", "###"],
+    "9": ["###", "#.#", "###", "..#", "###"],
+    "-": ["...", "...", "###", "...", "..."],
+    "+": ["...", ".#.", "###", ".#.", "..."],
+    "e": ["...", ".#.", "###", "#..", ".##"],
+    ".": ["...", "...", "...", "...", ".#."],
+    ":": ["...", ".#.", "...", ".#.", "..."],
+    " ": ["...", "...", "...", "...", "..."],
+}
+GLYPHS = {
+    char: np.array([[c == "#" for c in row] for row in rows])
+    for char, rows in FONT.items()
+}
+GLYPH_WIDTH, GLYPH_HEIGHT = 3, 5
+
+MINUTE_MS = 60_000
+TIME_STEPS = [
+    MINUTE_MS * minutes
+    for minutes in (1, 5, 15, 30, 60, 180, 360, 720, 1440, 2880, 10080, 43200)
+]
+DAY_MS = 1440 * MINUTE_MS
+
+# values are clipped to this magnitude, so the span of the value axis is finite
+VALUE_LIMIT = 1e300
+# characters of a fixed point value label, longer ones are in scientific notation
+LABEL_LENGTH = 16
+
+# samples along the line per pixel of its length
+SAMPLING = 2
+# samples generated at once
+CHUNK = 16384
+
+
+def _text_size(text: str, scale: int) -> Tuple[int, int]:
+    return len(text) * (GLYPH_WIDTH + 1) * scale - scale, GLYPH_HEIGHT * scale
+
+
+def _draw_text(
+    image: np.ndarray, x: int, y: int, text: str, scale: int, color: Sequence[int]
+) -> None:
+    """Draw text with its top left corner at (x, y), clipped to the image"""
+    for i, char in enumerate(text):
+        glyph = np.kron(GLYPHS[char], np.ones((scale, scale), dtype=bool))
+        left = x + i * (GLYPH_WIDTH + 1) * scale
+        top, bottom = max(y, 0), min(y + glyph.shape[0], image.shape[0])
+        right = min(left + glyph.shape[1], image.shape[1])
+        if left < 0 or top >= bottom or left >= right:
+            continue
+        region = image[top:bottom, left:right]
+        region[glyph[top - y : bottom - y, : right - left]] = color
+
+
+def _value_ticks(low: float, high: float, count: int) -> np.ndarray:
+    raw = (high - low) / max(count, 1)
+    magnitude = 10.0 ** math.floor(math.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 5, 10) if m * magnitude >= raw)
+
+    return np.arange(math.ceil(low / step) * step, high + step * 1e-9, step)
+
+
+def _format_value(value: float, ticks: np.ndarray) -> str:
+    step = ticks[1] - ticks[0] if len(ticks) > 1 else 1
+    if abs(value) < step / 2:
+        return "0"
+
+    decimals = max(0, -math.floor(math.log10(step))) if step > 0 else 0
+    text = f"{value:.{decimals}f}"
+    if len(text) > LABEL_LENGTH:
+        # digits of the step relative to the largest tick
+        largest = max(abs(ticks[0]), abs(ticks[-1]))
+        digits = math.floor(math.log10(largest)) - math.floor(math.log10(step))
+        text = f"{value:.{min(max(digits, 0), 15)}e}"
+
+    return text
+
+
+def _time_ticks(start: int, end: int, count: int) -> Tuple[np.ndarray, int]:
+    step = next(
+        (step for step in TIME_STEPS if (end - start) / step <= count), TIME_STEPS[-1]
+    )
+
+    return np.arange(-(-start // step) * step, end + 1, step, dtype=np.int64), step
+
+
+def _format_time(timestamp: int, step: int) -> str:
+    moment = datetime.fromtimestamp(timestamp / 1000, timezone.utc)
+    if step >= DAY_MS or timestamp % DAY_MS == 0:
+        return moment.strftime("%m-%d")
+
+    return moment.strftime("%H:%M")
+
+
+def _values(y: Sequence) -> np.ndarray:
+    """Values as floats, infinite ones are gaps"""
+    values = np.asarray(y, dtype=np.float64)
+    clipped = np.clip(values, -VALUE_LIMIT, VALUE_LIMIT)
+
+    return np.where(np.isinf(values), np.nan, clipped)
+
+
+def _coverage(
+    height: int, width: int, px: np.ndarray, py: np.ndarray, line_width: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Antialiased polyline as flat pixel indices and their opacity.
+
+    Points sampled along the segments are splatted to neighbouring pixels with
+    bilinear weights proportional to their length. Segments with a missing end
+    are gaps. Samples are generated in chunks to bound memory.
+    """
+    finite = np.isfinite(px) & np.isfinite(py)
+    valid = finite[:-1] & finite[1:]
+    x0, y0 = px[:-1][valid], py[:-1][valid]
+    dx, dy = px[1:][valid] - x0, py[1:][valid] - y0
+    length = np.hypot(dx, dy)
+    counts = np.ceil(length * SAMPLING).astype(np.int64) + 1
+    weights = np.maximum(length, 1) / counts * line_width
+
+    accumulated = np.zeros(height * width, dtype=np.float32)
+    ends = np.cumsum(counts)
+    bounds = np.searchsorted(ends, np.arange(0, ends[-1] if len(ends) else 0, CHUNK))
+    for first, last in zip(bounds, [*bounds[1:], len(counts)]):
+        n = counts[first:last]
+        segment = np.repeat(np.arange(first, last), n)
+        offsets = np.arange(len(segment)) - np.repeat(np.cumsum(n) - n, n)
+        t = offsets / np.maximum(counts - 1, 1)[segment]
+
+        xs = x0[segment] + dx[segment] * t
+        ys = y0[segment] + dy[segment] * t
+        ix, iy = np.floor(xs).astype(np.int64), np.floor(ys).astype(np.int64)
+        fx, fy = xs - ix, ys - iy
+        for x, y, w in (
+            (ix, iy, (1 - fx) * (1 - fy)),
+            (ix + 1, iy, fx * (1 - fy)),
+            (ix, iy + 1, (1 - fx) * fy),
+            (ix + 1, iy + 1, fx * fy),
+        ):
+            inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            np.add.at(
+                accumulated,
+                (y * width + x)[inside],
+                (w * weights[segment])[inside],
+            )
+
+    pixels = np.flatnonzero(accumulated)
+
+    return pixels, np.minimum(accumulated[pixels], 1)
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """PNG of an RGB image.
+
+    Rows are stored with the "Up" filter: graphs are mostly repeated rows, so
+    the differences are zeros and compress better.
+    """
+    height, width, _ = image.shape
+    rows = image.reshape(height, width * 3)
+    raw = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 0] = 2
+    raw[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=raw[1:, 1:])
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+            chunk(b"IDAT", zlib.compress(raw, 6)),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+def render(
+    width: int,
+    height: int,
+    lines: List[Tuple[Sequence, Sequence, Union[str, None]]],
+) -> bytes:
+    """Render lines to PNG, x are timestamps (datetime64 or milliseconds).
+
+    Labels of lines are ignored. Safe to call from worker threads.
+    """
+    scale = max(1, min(width // 640, height // 480) + 1)
+    series = [
+        (
+            np.asarray(x).astype("datetime64[ms]").astype(np.int64),
+            _values(y),
+        )
+        for x, y, _ in lines
+    ]
+    xs = np.concatenate([x for x, _ in series] or [np.empty(0, dtype=np.int64)])
+    ys = np.concatenate([y for _, y in series] or [np.empty(0)])
+    ys = ys[np.isfinite(ys)]
+
+    x_low, x_high = (int(xs.min()), int(xs.max())) if len(xs) else (0, DAY_MS)
+    if x_low == x_high:
+        x_low, x_high = x_low - MINUTE_MS, x_high + MINUTE_MS
+    y_low, y_high = (float(ys.min()), float(ys.max())) if len(ys) else (0.0, 1.0)
+    padding = (y_high - y_low) * 0.05 or max(abs(y_high) * 0.05, 1.0)
+    y_low, y_high = y_low - padding, y_high + padding
+
+    # plot area, the left margin fits the longest value label
+    _, text_height = _text_size("0", scale)
+    y_ticks = _value_ticks(y_low, y_high, max(height // (text_height * 8), 2))
+    y_labels = [_format_value(value, y_ticks) for value in y_ticks]
+    label_width = max(_text_size(label, scale)[0] for label in y_labels)
+    left = label_width + 8 * scale
+    right = width - 10 * scale
+    top = 10 * scale
+    bottom = height - text_height - 10 * scale
+    plot_width, plot_height = right - left, bottom - top
+
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = BACKGROUND
+
+    def to_px(x: np.ndarray) -> np.ndarray:
+        return left + (x - x_low) / (x_high - x_low) * plot_width
+
+    def to_py(y: np.ndarray) -> np.ndarray:
+        return bottom - (y - y_low) / (y_high - y_low) * plot_height
+
+    for value, label in zip(y_ticks, y_labels):
+        y = int(round(to_py(value)))
+        image[y, left:right] = GRID
+        image[y, left - 3 * scale : left] = FOREGROUND
+        label_size = _text_size(label, scale)
+        _draw_text(
+            image,
+            left - 5 * scale - label_size[0],
+            y - label_size[1] // 2,
+            label,
+            scale,
+            FOREGROUND,
+        )
+
+    x_ticks, step = _time_ticks(x_low, x_high, max(plot_width // (text_height * 12), 2))
+    for timestamp in x_ticks:
+        x = int(round(to_px(timestamp)))
+        image[top:bottom, x] = GRID
+        image[bottom : bottom + 3 * scale, x] = FOREGROUND
+        label = _format_time(int(timestamp), step)
+        _draw_text(
+            image,
+            x - _text_size(label, scale)[0] // 2,
+            bottom + 5 * scale,
+            label,
+            scale,
+            FOREGROUND,
+        )
+
+    image[top:bottom, left] = FOREGROUND
+    image[bottom, left:right] = FOREGROUND
+
+    pixels = image.reshape(-1, 3)
+    for (x, y), color in zip(series, COLORS * len(series)):
+        index, alpha = _coverage(height, width, to_px(x), to_py(y), 1.5 * scale)
+        alpha = alpha[:, None]
+        pixels[index] = pixels[index] * (1 - alpha) + np.array(color) * alpha
+
+    return encode_png(image)
@@ -12,73 +12,302 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime, time
-from typing import List, Union
+from datetime import datetime, time, timedelta
+from typing import Any, Dict, List, NamedTuple, Tuple, Union
 
 import app.models as models
-import pymongo
+import app.repositories.stations as stations
+import bson
 import numpy as np
 from app.database import db
+from app.repositories.storage import META_FIELD, STORAGES, TIME_FIELD
+from app.settings import config
 
-collection = db.measurements
+storage = STORAGES[config.database.storage](db[config.database.measurements])
+collection = storage.collection
 
+# used when a period has no start
+DEFAULT_PERIOD = timedelta(days=7)
 
-async def select_last() -> List[models.WeatherRecord]:
+# position of a record in history, the id is None for cursors of the time only
+Cursor = Tuple[datetime, Union[bson.ObjectId, None]]
+
+
+class Page(NamedTuple):
+    records: List[models.WeatherRecord]
+    # the page was read forward from a cursor or the start of the period
+    ascending: bool
+    # there are records beyond the page in the reading direction
+    more: bool
+
+
+class Update(NamedTuple):
+    station_id: models.PyObjectId
+    # the newest id of the written readings
+    last_id: bson.ObjectId
+    # time of the oldest and the newest written reading
+    first: datetime
+    last: datetime
+
+
+# Stored documents use short field names and omit empty values, the station is
+# referenced by id only (it is the time series `metaField`), e.g.:
+# {"_id": ..., "s": ..., "t": ..., "w": {"a": 1.2, "x": 3.4, "z": 90}, "tp": {"a": 17.7}}
+MEASURE_FIELDS = {
+    models.MeasureType.wind: "w",
+    models.MeasureType.temperature: "tp",
+    models.MeasureType.humidity: "h",
+    models.MeasureType.pressure: "p",
+    models.MeasureType.light: "l",
+    models.MeasureType.rain: "r",
+}
+VALUE_FIELDS = {
+    "avg": "a",
+    "min": "n",
+    "max": "x",
+    "azimuth": "z",
+    "direction": "d",
+}
+_MEASURE_KEYS = [(param.value, key) for param, key in MEASURE_FIELDS.items()]
+
+
+def _pack_value(value: Dict[str, Any]) -> Dict[str, Any]:
+    doc = {VALUE_FIELDS[name]: v for name, v in value.items() if v is not None}
+
+    # direction is derived from azimuth on import, so there is no need to store it
+    if "z" in doc and doc.get("d") == models.WindDirection.from_azimuth(doc["z"]):
+        del doc["d"]
+
+    return doc
+
+
+def _unpack_value(doc: Dict[str, Any]) -> Dict[str, Any]:
+    value = {name: doc.get(key) for name, key in VALUE_FIELDS.items()}
+    if value["direction"] is None:
+        value["direction"] = models.WindDirection.from_azimuth(value["azimuth"])
+
+    return value
+
+
+def pack_document(
+    id: bson.ObjectId,
+    station_id: bson.ObjectId,
+    timestamp: datetime,
+    values: Dict[str, Union[Dict[str, Any], None]],
+) -> Dict[str, Any]:
+    """Build the stored document from values of measures"""
+    doc = {
+        "_id": id,
+        META_FIELD: station_id,
+        TIME_FIELD: timestamp,
+    }
+    for name, key in _MEASURE_KEYS:
+        value = values.get(name)
+        if value is not None:
+            doc[key] = _pack_value(value)
+
+    return doc
+
+
+def to_document(record: models.WeatherRecord) -> Dict[str, Any]:
+    """Convert a weather record to the stored document"""
+    return pack_document(
+        record.id,
+        record.station.id,
+        record.timestamp,
+        record.dict(include={param.value for param in models.MeasureType}),
+    )
+
+
+def from_document(doc: Dict[str, Any], station: models.Station) -> models.WeatherRecord:
+    """Convert a stored document to the weather record"""
+    data = {
+        "_id": doc["_id"],
+        "station": station,
+        "timestamp": doc[TIME_FIELD],
+    }
+    for param, key in MEASURE_FIELDS.items():
+        value = doc.get(key)
+        data[param.value] = _unpack_value(value) if value is not None else None
+
+    return models.WeatherRecord(**data)
+
+
+async def select_last(
+    station_ids: Union[List[models.PyObjectId], None] = None
+) -> List[models.WeatherRecord]:
     """Select last weather records grouped by station"""
-    records = await collection.aggregate(
-        [
-            {"$group": {"_id": "$station._id", "record": {"$last": "$$ROOT"}}},
-            {"$sort": {"record.timestamp": pymongo.DESCENDING}},
-            {"$replaceRoot": {"newRoot": "$record"}},
-        ]
-    ).to_list(None)
-    return [models.WeatherRecord(**record) for record in records]
+    records = await storage.last(station_ids)
+    if not records:
+        return []
+
+    stations_by_id = {station.id: station for station in await stations.select()}
+    return [
+        from_document(record, stations_by_id[record[META_FIELD]])
+        for record in records
+        if record[META_FIELD] in stations_by_id
+    ]
+
+
+async def can_poll() -> bool:
+    """Whether new readings can be polled without a collection scan"""
+    return await storage.can_poll()
+
+
+async def select_updated(since: datetime) -> List[Update]:
+    """Stations with readings written after `since`, in order of reading ids"""
+    return [
+        Update(record["_id"], record["id"], record["first"], record["last"])
+        for record in await storage.updated_since(since)
+    ]
 
 
 async def get_last(station_id: models.PyObjectId) -> Union[models.WeatherRecord, None]:
     """Get last weather record for a station"""
-    record = await collection.find_one(
-        {"station._id": station_id}, sort=[("timestamp", pymongo.DESCENDING)]
-    )
-    if record:
-        return models.WeatherRecord(**record)
-    return None
+    record = await storage.last_of(station_id)
+    if record is None:
+        return None
+
+    station = await stations.get(station_id)
+    if station is None:
+        return None
+
+    return from_document(record, station)
 
 
 async def insert(record: models.WeatherRecord) -> models.WeatherRecord:
     """Add a weather record"""
-    await collection.insert_one(record.dict(by_alias=True))
+    await storage.insert(to_document(record))
 
     return record
 
 
+def time_range(period: models.Period) -> Dict[str, datetime]:
+    """Query range of time of a period, the last week by default"""
+    end = (
+        datetime.combine(period.end, time.max)
+        if not period.end is None
+        else datetime.max
+    )
+    start = (
+        datetime.combine(period.start, time.min)
+        if not period.start is None
+        else min(end, datetime.utcnow()) - DEFAULT_PERIOD
+    )
+
+    return {"$gte": start, "$lte": end}
+
+
+async def insert_many(documents: List[Dict[str, Any]]) -> None:
+    """Add stored documents in bulk"""
+    await storage.insert_many(documents)
+
+
+async def exclude_existing(
+    documents: List[Dict[str, Any]], *, by_time: bool = False
+) -> List[Dict[str, Any]]:
+    """Stored documents that are not in the database yet, found by id or,
+    if `by_time` is set, by station and time"""
+    if not documents:
+        return []
+
+    return await storage.exclude_existing(documents, by_time=by_time)
+
+
+def _fields(params: Union[List[models.MeasureType], None]) -> Union[List[str], None]:
+    return [MEASURE_FIELDS[param] for param in params] if params is not None else None
+
+
 async def select(
     station_id: models.PyObjectId,
     period: models.Period,
     *,
     samples: Union[int, None] = None,
+    params: Union[List[models.MeasureType], None] = None,
 ) -> List[models.WeatherRecord]:
-    """Select weather records for a station"""
-    query = [
-        {
-            "$match": {
-                "station._id": station_id,
-                "timestamp": {
-                    "$gte": datetime.combine(period.start, time.min)
-                    if not period.start is None
-                    else datetime.min,
-                    "$lte": datetime.combine(period.end, time.max)
-                    if not period.end is None
-                    else datetime.max,
-                },
-            }
-        },
-    ]
-    if samples:
-        query.append({"$sample": {"size": samples}})
+    """Select weather records for a station, for the last week by default.
+
+    Only the given measures are read if `params` is set, others are `None`.
+    """
+    station = await stations.get(station_id)
+    if station is None:
+        return []
+
+    records = await storage.select(
+        station_id, time_range(period), samples, _fields(params)
+    )
+
+    return [from_document(record, station) for record in records]
+
+
+async def select_page(
+    station_id: models.PyObjectId,
+    period: models.Period,
+    *,
+    limit: int,
+    after: Union[Cursor, None] = None,
+    before: Union[Cursor, None] = None,
+    params: Union[List[models.MeasureType], None] = None,
+) -> Page:
+    """Select a page of weather records for a station ordered by timestamp.
+
+    The page follows `after` or starts at the beginning of the period, otherwise
+    it is the newest records (preceding `before` if set). Records are ordered by
+    timestamp and id, as several readings may share a timestamp. The query is
+    bounded by the station index, so it does not depend on the history size.
+    Only the given measures are read if `params` is set.
+    """
+    station = await stations.get(station_id)
+    if station is None:
+        return Page([], True, False)
+
+    time_range: Dict[str, datetime] = {}
+    if period.start is not None:
+        time_range["$gte"] = datetime.combine(period.start, time.min)
+    if period.end is not None:
+        time_range["$lte"] = datetime.combine(period.end, time.max)
+
+    ascending = after is not None or (period.start is not None and before is None)
+    cursor = after if ascending else before
+    fields = _fields(params)
+
+    def position(record: Dict[str, Any]) -> Tuple[datetime, bson.ObjectId]:
+        return record[TIME_FIELD], record["_id"]
+
+    records = []
+    if cursor is not None:
+        timestamp, record_id = cursor
+        # readings at the cursor time that are not on the previous page
+        if record_id is not None and _in_range(timestamp, time_range):
+            records = [
+                record
+                for record in await storage.at(station_id, timestamp, fields)
+                if (position(record) > cursor) == ascending
+                and position(record) != cursor
+            ]
+        time_range["$gt" if ascending else "$lt"] = timestamp
+
+    following = await storage.page(station_id, time_range, ascending, limit + 1, fields)
+    # the last timestamp may have more readings than were read
+    if len(following) > limit:
+        boundary = following[-1][TIME_FIELD]
+        following = [r for r in following if r[TIME_FIELD] != boundary]
+        following += await storage.at(station_id, boundary, fields)
+    records += following
+
+    records.sort(key=position, reverse=not ascending)
+    more = len(records) > limit
+    records = sorted(records[:limit], key=position)
+
+    return Page([from_document(record, station) for record in records], ascending, more)
+
+
+def _in_range(timestamp: datetime, time_range: Dict[str, datetime]) -> bool:
+    return ("$gte" not in time_range or timestamp >= time_range["$gte"]) and (
+        "$lte" not in time_range or timestamp <= time_range["$lte"]
+    )
 
-    records = await collection.aggregate(
-        query + [{"$sort": {"timestamp": pymongo.ASCENDING}}]
-    ).to_list(None)
 
-    return [models.WeatherRecord(**record) for record in records]
+async def explain_page(station_id: models.PyObjectId, limit: int) -> Dict[str, Any]:
+    """Query plan of the newest page of a station"""
+    return await storage.explain_page(station_id, limit)
@@ -0,0 +1,57 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import date, datetime, time
+from typing import Any, Dict, List
+
+import pymongo
+from app.database import db
+from app.models import PyObjectId
+
+collection = db.sketches
+
+
+def _day(day: date) -> datetime:
+    return datetime.combine(day, time.min)
+
+
+async def increment(
+    station_id: PyObjectId,
+    field: str,
+    day: date,
+    zero: int,
+    positive: Dict[int, int],
+    negative: Dict[int, int],
+):
+    """Add bucket counts to a daily sketch"""
+    counts = {f"pos.{index}": count for index, count in positive.items()}
+    counts.update({f"neg.{index}": count for index, count in negative.items()})
+    if zero:
+        counts["z"] = zero
+
+    await collection.update_one(
+        {"s": station_id, "f": field, "d": _day(day)},
+        {"$inc": counts},
+        upsert=True,
+    )
+
+
+async def select(
+    station_id: PyObjectId, field: str, start: date, end: date
+) -> List[Dict[str, Any]]:
+    """Select daily sketches of a station"""
+    return await collection.find(
+        {"s": station_id, "f": field, "d": {"$gte": _day(start), "$lte": _day(end)}},
+        sort=[("d", pymongo.ASCENDING)],
+    ).to_list(None)
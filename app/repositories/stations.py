@@ -20,6 +20,14 @@ from app.models import PyObjectId, Station
 collection = db.stations
 
 
+def _to_document(station: Station) -> dict:
+    # GeoJSON point for the `2dsphere` index
+    return {
+        **station.dict(by_alias=True),
+        "location": {"type": "Point", "coordinates": [station.lon, station.lat]},
+    }
+
+
 async def select() -> List[Station]:
     """Select all stations"""
     stations = await collection.find({}).to_list(None)
@@ -34,6 +42,15 @@ async def get(id: PyObjectId) -> Union[Station, None]:
     return None
 
 
+async def select_many(ids: List[PyObjectId]) -> List[Station]:
+    """Select stations by ids preserving their order"""
+    stations = {
+        station["_id"]: Station(**station)
+        for station in await collection.find({"_id": {"$in": ids}}).to_list(None)
+    }
+    return [stations[id] for id in ids if id in stations]
+
+
 async def get_by_code(code: str) -> Union[Station, None]:
     """Get a station by code"""
     station = await collection.find_one({"code": code})
@@ -44,16 +61,14 @@ async def get_by_code(code: str) -> Union[Station, None]:
 
 async def insert(station: Station) -> Station:
     """Add a station"""
-    await collection.insert_one(station.dict(by_alias=True))
+    await collection.insert_one(_to_document(station))
 
     return station
 
 
 async def update(station: Station) -> Station:
     """Update a station"""
-    await collection.update_one(
-        {"_id": station.id}, {"$set": station.dict(by_alias=True)}
-    )
+    await collection.update_one({"_id": station.id}, {"$set": _to_document(station)})
 
     return station
 
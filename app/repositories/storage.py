@@ -0,0 +1,513 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Mapping, Tuple, Union
+
+import bson
+import pymongo
+from app.settings import StorageType
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+# station id and timestamp of a stored reading
+META_FIELD = "s"
+TIME_FIELD = "t"
+
+Document = Dict[str, Any]
+TimeRange = Dict[str, datetime]
+
+
+def _reading_key(doc: Document) -> Tuple[Any, datetime]:
+    """Station and time of a reading as they are stored: naive UTC in ms"""
+    timestamp = doc[TIME_FIELD]
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return doc[META_FIELD], timestamp.replace(
+        microsecond=timestamp.microsecond // 1000 * 1000
+    )
+
+
+async def _has_index(collection: AsyncIOMotorCollection, field: str) -> bool:
+    """Whether an index of the collection starts with `field`"""
+    indexes = await collection.index_information()
+    return any(index["key"][0][0] == field for index in indexes.values())
+
+
+def _projection(fields: List[str], prefix: str = "") -> Document:
+    """Include identity and timestamp of readings and the given measures only"""
+    return {
+        META_FIELD: 1,
+        **{f"{prefix}{key}": 1 for key in ("_id", TIME_FIELD, *fields)},
+    }
+
+
+class ReadingsStorage:
+    """One document per reading, a native time series collection on MongoDB 5+"""
+
+    def __init__(self, collection: AsyncIOMotorCollection) -> None:
+        self.collection = collection
+
+    async def last(self, station_ids: Union[List[Any], None] = None) -> List[Document]:
+        query = [
+            {"$group": {"_id": f"${META_FIELD}", "record": {"$last": "$$ROOT"}}},
+            {"$sort": {f"record.{TIME_FIELD}": pymongo.DESCENDING}},
+            {"$replaceRoot": {"newRoot": "$record"}},
+        ]
+        if station_ids is not None:
+            query.insert(0, {"$match": {META_FIELD: {"$in": station_ids}}})
+
+        return await self.collection.aggregate(query).to_list(None)
+
+    async def last_of(self, station_id: Any) -> Union[Document, None]:
+        return await self.collection.find_one(
+            {META_FIELD: station_id}, sort=[(TIME_FIELD, pymongo.DESCENDING)]
+        )
+
+    async def insert(self, document: Document) -> None:
+        await self.collection.insert_one(document)
+
+    async def insert_many(
+        self, documents: List[Document], *, ordered: bool = False
+    ) -> None:
+        await self.collection.insert_many(documents, ordered=ordered)
+
+    async def exclude_existing(
+        self, documents: List[Document], *, by_time: bool = False
+    ) -> List[Document]:
+        keys = [_reading_key(doc) for doc in documents]
+        timestamps = [timestamp for _, timestamp in keys]
+        query: Document = {
+            META_FIELD: {"$in": list({station_id for station_id, _ in keys})},
+            TIME_FIELD: {"$gte": min(timestamps), "$lte": max(timestamps)},
+        }
+        if by_time:
+            existing = {
+                _reading_key(doc)
+                async for doc in self.collection.find(
+                    query, {"_id": 0, META_FIELD: 1, TIME_FIELD: 1}
+                )
+            }
+            return [doc for doc, key in zip(documents, keys) if key not in existing]
+
+        query["_id"] = {"$in": [doc["_id"] for doc in documents]}
+        existing = {doc["_id"] async for doc in self.collection.find(query, {"_id": 1})}
+        return [doc for doc in documents if doc["_id"] not in existing]
+
+    async def select(
+        self,
+        station_id: Any,
+        time_range: TimeRange,
+        samples: Union[int, None],
+        fields: Union[List[str], None] = None,
+    ) -> List[Document]:
+        query: List[Document] = [
+            {"$match": {META_FIELD: station_id, TIME_FIELD: time_range}}
+        ]
+        if fields is not None:
+            query.append({"$project": _projection(fields)})
+        if samples:
+            query.append({"$sample": {"size": samples}})
+        query.append({"$sort": {TIME_FIELD: pymongo.ASCENDING}})
+
+        return await self.collection.aggregate(query).to_list(None)
+
+    def _page_cursor(
+        self,
+        station_id: Any,
+        time_range: TimeRange,
+        ascending: bool,
+        limit: int,
+        fields: Union[List[str], None] = None,
+    ):
+        query: Document = {META_FIELD: station_id}
+        if time_range:
+            query[TIME_FIELD] = time_range
+
+        return self.collection.find(
+            query,
+            _projection(fields) if fields is not None else None,
+            sort=[(TIME_FIELD, pymongo.ASCENDING if ascending else pymongo.DESCENDING)],
+            limit=limit,
+        )
+
+    async def page(
+        self,
+        station_id: Any,
+        time_range: TimeRange,
+        ascending: bool,
+        limit: int,
+        fields: Union[List[str], None] = None,
+    ) -> List[Document]:
+        return await self._page_cursor(
+            station_id, time_range, ascending, limit, fields
+        ).to_list(None)
+
+    async def at(
+        self,
+        station_id: Any,
+        timestamp: datetime,
+        fields: Union[List[str], None] = None,
+    ) -> List[Document]:
+        return await self.collection.find(
+            {META_FIELD: station_id, TIME_FIELD: timestamp},
+            _projection(fields) if fields is not None else None,
+        ).to_list(None)
+
+    async def explain_page(self, station_id: Any, limit: int) -> Document:
+        return await self._page_cursor(station_id, {}, False, limit).explain()
+
+    async def can_poll(self) -> bool:
+        """Whether updates are found by an index, it is created by `db-init`"""
+        return await _has_index(self.collection, "_id")
+
+    async def updated_since(self, since: datetime) -> List[Document]:
+        # ids are created when readings are accepted or imported
+        return await self.collection.aggregate(
+            [
+                {"$match": {"_id": {"$gt": bson.ObjectId.from_datetime(since)}}},
+                {
+                    "$group": {
+                        "_id": f"${META_FIELD}",
+                        "id": {"$max": "$_id"},
+                        "first": {"$min": f"${TIME_FIELD}"},
+                        "last": {"$max": f"${TIME_FIELD}"},
+                    }
+                },
+            ]
+        ).to_list(None)
+
+
+def _hour(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class BucketsStorage:
+    """Bucket pattern: a document per station and hour holding an array of
+    readings with running count, min, max and sum of average values, e.g.:
+
+    {"s": ..., "h": 2022-08-15T10:00, "n": 2, "r": [{"_id": ..., "t": ..., "w": {"a": 1.2}}, ...],
+     "min": {"w": 1.2}, "max": {"w": 3.4}, "sum": {"w": 4.6}, "u": 2022-08-15T10:05:01}
+
+    It is meant for MongoDB before 5.0, which has no time series collections.
+    """
+
+    BUCKET_FIELD = "h"
+    READINGS_FIELD = "r"
+    # server time of the last push
+    UPDATED_FIELD = "u"
+    BUCKET_SIZE = 1000
+
+    def __init__(self, collection: AsyncIOMotorCollection) -> None:
+        self.collection = collection
+
+    def _unwind(self) -> List[Document]:
+        return [
+            {"$unwind": f"${self.READINGS_FIELD}"},
+            {
+                "$replaceRoot": {
+                    "newRoot": {
+                        "$mergeObjects": [
+                            f"${self.READINGS_FIELD}",
+                            {META_FIELD: f"${META_FIELD}"},
+                        ]
+                    }
+                }
+            },
+        ]
+
+    def _buckets_range(self, time_range: TimeRange) -> TimeRange:
+        lower = [time_range[op] for op in ("$gte", "$gt") if op in time_range]
+        upper = [time_range[op] for op in ("$lte", "$lt") if op in time_range]
+
+        buckets_range = {}
+        if lower:
+            buckets_range["$gte"] = _hour(max(lower))
+        if upper:
+            buckets_range["$lte"] = min(upper)
+        return buckets_range
+
+    def _update(self, documents: List[Document]) -> pymongo.UpdateOne:
+        """Push readings of a station and hour to its bucket"""
+        readings = [
+            {key: value for key, value in doc.items() if key != META_FIELD}
+            for doc in documents
+        ]
+        inc: Document = {"n": len(readings)}
+        minimum: Document = {}
+        maximum: Document = {}
+        for reading in readings:
+            for key, value in reading.items():
+                if isinstance(value, Mapping) and "a" in value:
+                    inc[f"sum.{key}"] = inc.get(f"sum.{key}", 0) + value["a"]
+                    minimum[f"min.{key}"] = min(
+                        minimum.get(f"min.{key}", value["a"]), value["a"]
+                    )
+                    maximum[f"max.{key}"] = max(
+                        maximum.get(f"max.{key}", value["a"]), value["a"]
+                    )
+
+        update: Document = {
+            "$push": {self.READINGS_FIELD: {"$each": readings}},
+            "$inc": inc,
+            "$currentDate": {self.UPDATED_FIELD: True},
+        }
+        if minimum:
+            update["$min"] = minimum
+            update["$max"] = maximum
+
+        return pymongo.UpdateOne(
+            {
+                META_FIELD: documents[0][META_FIELD],
+                self.BUCKET_FIELD: _hour(documents[0][TIME_FIELD]),
+                "n": {"$lt": self.BUCKET_SIZE},
+            },
+            update,
+            upsert=True,
+        )
+
+    async def last(self, station_ids: Union[List[Any], None] = None) -> List[Document]:
+        return await self.collection.aggregate(self._last_query(station_ids)).to_list(
+            None
+        )
+
+    async def explain_last(
+        self, station_ids: Union[List[Any], None] = None
+    ) -> Document:
+        return await self.collection.database.command(
+            {
+                "explain": {
+                    "aggregate": self.collection.name,
+                    "pipeline": self._last_query(station_ids),
+                    "cursor": {},
+                },
+                "verbosity": "queryPlanner",
+            }
+        )
+
+    def _last_query(self, station_ids: Union[List[Any], None]) -> List[Document]:
+        # readings replayed late may be pushed after newer ones,
+        # so the newest one is searched in the whole last bucket,
+        # the sort is covered by the (s, h, _id) index
+        query: List[Document] = [
+            {"$sort": {META_FIELD: 1, self.BUCKET_FIELD: -1, "_id": -1}},
+            {
+                "$group": {
+                    "_id": f"${META_FIELD}",
+                    "records": {"$first": f"${self.READINGS_FIELD}"},
+                }
+            },
+            {"$unwind": "$records"},
+            {"$sort": {f"records.{TIME_FIELD}": pymongo.DESCENDING}},
+            {"$group": {"_id": "$_id", "record": {"$first": "$records"}}},
+            {
+                "$replaceRoot": {
+                    "newRoot": {"$mergeObjects": ["$record", {META_FIELD: "$_id"}]}
+                }
+            },
+            {"$sort": {TIME_FIELD: pymongo.DESCENDING}},
+        ]
+        if station_ids is not None:
+            query.insert(0, {"$match": {META_FIELD: {"$in": station_ids}}})
+
+        return query
+
+    async def last_of(self, station_id: Any) -> Union[Document, None]:
+        bucket = await self.collection.find_one(
+            {META_FIELD: station_id},
+            {self.READINGS_FIELD: 1},
+            sort=[(self.BUCKET_FIELD, pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+        )
+        if not bucket or not bucket[self.READINGS_FIELD]:
+            return None
+
+        record = max(bucket[self.READINGS_FIELD], key=lambda r: r[TIME_FIELD])
+        return {**record, META_FIELD: station_id}
+
+    async def insert(self, document: Document) -> None:
+        await self.collection.bulk_write([self._update([document])])
+
+    async def insert_many(
+        self, documents: List[Document], *, ordered: bool = False
+    ) -> None:
+        buckets: Dict[Any, List[Document]] = {}
+        for doc in documents:
+            key = (doc[META_FIELD], _hour(doc[TIME_FIELD]))
+            buckets.setdefault(key, []).append(doc)
+
+        await self.collection.bulk_write(
+            [
+                self._update(bucket[i : i + self.BUCKET_SIZE])
+                for bucket in buckets.values()
+                for i in range(0, len(bucket), self.BUCKET_SIZE)
+            ],
+            ordered=ordered,
+        )
+
+    async def exclude_existing(
+        self, documents: List[Document], *, by_time: bool = False
+    ) -> List[Document]:
+        keys = [_reading_key(doc) for doc in documents]
+        timestamps = [timestamp for _, timestamp in keys]
+        query: Document = {
+            META_FIELD: {"$in": list({station_id for station_id, _ in keys})},
+            self.BUCKET_FIELD: {
+                "$gte": _hour(min(timestamps)),
+                "$lte": max(timestamps),
+            },
+        }
+        if by_time:
+            existing = set()
+            async for bucket in self.collection.find(
+                query, {META_FIELD: 1, f"{self.READINGS_FIELD}.{TIME_FIELD}": 1}
+            ):
+                existing.update(
+                    _reading_key({**reading, META_FIELD: bucket[META_FIELD]})
+                    for reading in bucket[self.READINGS_FIELD]
+                )
+            return [doc for doc, key in zip(documents, keys) if key not in existing]
+
+        ids = [doc["_id"] for doc in documents]
+        query[f"{self.READINGS_FIELD}._id"] = {"$in": ids}
+        existing = set()
+        async for bucket in self.collection.find(
+            query, {f"{self.READINGS_FIELD}._id": 1}
+        ):
+            existing.update(reading["_id"] for reading in bucket[self.READINGS_FIELD])
+
+        return [doc for doc in documents if doc["_id"] not in existing]
+
+    async def select(
+        self,
+        station_id: Any,
+        time_range: TimeRange,
+        samples: Union[int, None],
+        fields: Union[List[str], None] = None,
+    ) -> List[Document]:
+        query: List[Document] = [
+            {
+                "$match": {
+                    META_FIELD: station_id,
+                    self.BUCKET_FIELD: self._buckets_range(time_range),
+                }
+            },
+        ]
+        if fields is not None:
+            query.append({"$project": _projection(fields, f"{self.READINGS_FIELD}.")})
+        query += [*self._unwind(), {"$match": {TIME_FIELD: time_range}}]
+        if samples:
+            query.append({"$sample": {"size": samples}})
+        query.append({"$sort": {TIME_FIELD: pymongo.ASCENDING}})
+
+        return await self.collection.aggregate(query).to_list(None)
+
+    def _page_query(
+        self, station_id: Any, time_range: TimeRange, ascending: bool, limit: int
+    ) -> List[Document]:
+        direction = pymongo.ASCENDING if ascending else pymongo.DESCENDING
+        match: Document = {META_FIELD: station_id}
+        if time_range:
+            match[self.BUCKET_FIELD] = self._buckets_range(time_range)
+
+        # every bucket has a reading at least, the first one may be out of range
+        return [
+            {"$match": match},
+            {"$sort": {self.BUCKET_FIELD: direction, "_id": direction}},
+            {"$limit": limit + 1},
+        ]
+
+    async def page(
+        self,
+        station_id: Any,
+        time_range: TimeRange,
+        ascending: bool,
+        limit: int,
+        fields: Union[List[str], None] = None,
+    ) -> List[Document]:
+        query = self._page_query(station_id, time_range, ascending, limit)
+        if fields is not None:
+            query.append({"$project": _projection(fields, f"{self.READINGS_FIELD}.")})
+        query += self._unwind()
+        if time_range:
+            query.append({"$match": {TIME_FIELD: time_range}})
+        query += [
+            {
+                "$sort": {
+                    TIME_FIELD: pymongo.ASCENDING if ascending else pymongo.DESCENDING
+                }
+            },
+            {"$limit": limit},
+        ]
+
+        return await self.collection.aggregate(query).to_list(None)
+
+    async def at(
+        self,
+        station_id: Any,
+        timestamp: datetime,
+        fields: Union[List[str], None] = None,
+    ) -> List[Document]:
+        query: List[Document] = [
+            {"$match": {META_FIELD: station_id, self.BUCKET_FIELD: _hour(timestamp)}}
+        ]
+        if fields is not None:
+            query.append({"$project": _projection(fields, f"{self.READINGS_FIELD}.")})
+        query += [*self._unwind(), {"$match": {TIME_FIELD: timestamp}}]
+
+        return await self.collection.aggregate(query).to_list(None)
+
+    async def explain_page(self, station_id: Any, limit: int) -> Document:
+        # readings are sorted within `limit + 1` buckets, only the buckets
+        # query depends on the history size
+        return await self.collection.database.command(
+            {
+                "explain": {
+                    "aggregate": self.collection.name,
+                    "pipeline": self._page_query(station_id, {}, False, limit),
+                    "cursor": {},
+                },
+                "verbosity": "queryPlanner",
+            }
+        )
+
+    async def can_poll(self) -> bool:
+        """Whether updates are found by an index, it is created by `db-init`"""
+        return await _has_index(self.collection, self.UPDATED_FIELD)
+
+    async def updated_since(self, since: datetime) -> List[Document]:
+        # buckets of any hour are updated, the readings pushed since are
+        # told by ids created when they are accepted or imported
+        reading_id = f"{self.READINGS_FIELD}._id"
+        reading_time = f"{self.READINGS_FIELD}.{TIME_FIELD}"
+        return await self.collection.aggregate(
+            [
+                {"$match": {self.UPDATED_FIELD: {"$gt": since}}},
+                {"$project": {META_FIELD: 1, reading_id: 1, reading_time: 1}},
+                {"$unwind": f"${self.READINGS_FIELD}"},
+                {"$match": {reading_id: {"$gt": bson.ObjectId.from_datetime(since)}}},
+                {
+                    "$group": {
+                        "_id": f"${META_FIELD}",
+                        "id": {"$max": f"${reading_id}"},
+                        "first": {"$min": f"${reading_time}"},
+                        "last": {"$max": f"${reading_time}"},
+                    }
+                },
+            ]
+        ).to_list(None)
+
+
+STORAGES = {
+    StorageType.readings: ReadingsStorage,
+    StorageType.buckets: BucketsStorage,
+}
@@ -0,0 +1,264 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import logging
+import os
+import shutil
+from datetime import date, datetime, time, timedelta
+from typing import Dict, NamedTuple, Tuple, Union
+
+import numpy as np
+
+import app.database as database
+import app.invalidation as invalidation
+import app.models as models
+import app.repositories.measurements as measurements
+import app.series as series
+from app.settings import config
+
+logger = logging.getLogger(__name__)
+
+Segment = Tuple[np.ndarray, np.ndarray]
+
+DAY_MS = 24 * 3600 * 1000
+# bytes of a cached segment besides its arrays
+SEGMENT_OVERHEAD = 256
+
+
+class SegmentKey(NamedTuple):
+    station_id: models.PyObjectId
+    param: models.MeasureType
+    day: date
+
+
+def _empty() -> Segment:
+    return np.empty(0, dtype=np.int64), np.empty(0)
+
+
+def downsample(segment: Segment, start: int, points: int) -> Segment:
+    """Average readings of a day starting at `start` ms into `points` time bins"""
+    timestamps, values = segment
+    if len(timestamps) <= points:
+        return segment
+
+    bins = (timestamps - start) * points // DAY_MS
+    counts = np.bincount(bins, minlength=points)
+    filled = counts > 0
+    counts = counts[filled]
+
+    return (
+        (np.bincount(bins, weights=timestamps, minlength=points)[filled] / counts)
+        .round()
+        .astype(np.int64),
+        np.bincount(bins, weights=values, minlength=points)[filled] / counts,
+    )
+
+
+class SegmentCache:
+    """Average values of a station parameter split by days.
+
+    Readings of a past day do not change, so its processed segment is cached
+    forever: in memory within the `memory` budget and, if `path` is set, on
+    disk. A period is assembled from segments of past days and a query of the
+    current day only. A day is considered past `settle` seconds after its end,
+    so readings delayed by the spool are not missed.
+    """
+
+    def __init__(self) -> None:
+        self.settings = config.segments
+        self._segments: "collections.OrderedDict[SegmentKey, Segment]" = (
+            collections.OrderedDict()
+        )
+        self._size = 0
+        self.hits = self.misses = 0
+
+    async def select(
+        self,
+        station_id: models.PyObjectId,
+        param: models.MeasureType,
+        period: models.Period,
+    ) -> Segment:
+        """Timestamps in milliseconds and average values of a parameter"""
+        time_range = measurements.time_range(period)
+        start, end = time_range["$gte"], min(time_range["$lte"], datetime.utcnow())
+        if start > end:
+            return _empty()
+
+        settled = (datetime.utcnow() - timedelta(seconds=self.settings.settle)).date()
+        if database.unmigrated:
+            # legacy readings of any day may be migrated yet
+            settled = date.min
+        days = [
+            start.date() + timedelta(days=i)
+            for i in range((end.date() - start.date()).days + 1)
+        ]
+        past = [day for day in days if day < settled]
+
+        segments = {}
+        missing = []
+        for day in past:
+            segment = await self._get(SegmentKey(station_id, param, day))
+            if segment is None:
+                missing.append(day)
+            else:
+                segments[day] = segment
+        if missing:
+            loaded = await self._load(station_id, param, missing[0], missing[-1])
+            for day in missing:
+                segments[day] = loaded[day]
+                await self._put(SegmentKey(station_id, param, day), loaded[day])
+
+        # the live part is not cached
+        live = [day for day in days if day >= settled]
+        if live:
+            segments.update(await self._load(station_id, param, live[0], live[-1]))
+
+        timestamps = np.concatenate([segments[day][0] for day in days])
+        values = np.concatenate([segments[day][1] for day in days])
+        window = (timestamps >= _to_ms(start)) & (timestamps <= _to_ms(end))
+
+        return timestamps[window], values[window]
+
+    def invalidate(self, station_id: models.PyObjectId) -> None:
+        """Drop segments of a station after its past readings are changed"""
+        for key in [key for key in self._segments if key.station_id == station_id]:
+            self._size -= _size(self._segments.pop(key))
+        if self.settings.path:
+            shutil.rmtree(
+                os.path.join(self.settings.path, str(station_id)), ignore_errors=True
+            )
+
+    def stats(self) -> Dict[str, int]:
+        """Size and hit counts of the cache"""
+        return {
+            "segments": len(self._segments),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    async def _load(
+        self,
+        station_id: models.PyObjectId,
+        param: models.MeasureType,
+        first: date,
+        last: date,
+    ) -> Dict[date, Segment]:
+        """Query days from `first` to `last` at once and split them"""
+        records = await measurements.select(
+            station_id, models.Period(start=first, end=last), params=[param]
+        )
+        timestamps, values = series.to_arrays(records, param)
+
+        segments = {}
+        for i in range((last - first).days + 1):
+            day = first + timedelta(days=i)
+            day_start = _to_ms(datetime.combine(day, time.min))
+            lo, hi = np.searchsorted(timestamps, [day_start, day_start + DAY_MS])
+            segments[day] = downsample(
+                (timestamps[lo:hi], values[lo:hi]),
+                day_start,
+                self.settings.points_per_day,
+            )
+
+        return segments
+
+    async def _get(self, key: SegmentKey) -> Union[Segment, None]:
+        segment = self._segments.get(key)
+        if segment is not None:
+            self._segments.move_to_end(key)
+            self.hits += 1
+            return segment
+
+        if self.settings.path:
+            segment = await asyncio.get_running_loop().run_in_executor(
+                None, _read, self._file(key)
+            )
+            if segment is not None:
+                self.hits += 1
+                self._remember(key, segment)
+                return segment
+
+        self.misses += 1
+        return None
+
+    async def _put(self, key: SegmentKey, segment: Segment) -> None:
+        self._remember(key, segment)
+        if self.settings.path:
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, _write, self._file(key), segment
+                )
+            except OSError:
+                logger.exception(f"Failed to write segment {key}")
+
+    def _remember(self, key: SegmentKey, segment: Segment) -> None:
+        # concurrent misses of a day load and put it more than once
+        replaced = self._segments.pop(key, None)
+        if replaced is not None:
+            self._size -= _size(replaced)
+        self._segments[key] = segment
+        self._size += _size(segment)
+        while self._size > self.settings.memory and self._segments:
+            _, evicted = self._segments.popitem(last=False)
+            self._size -= _size(evicted)
+
+    def _file(self, key: SegmentKey) -> str:
+        return os.path.join(
+            self.settings.path,
+            str(key.station_id),
+            key.param.value,
+            f"{key.day.isoformat()}.npy",
+        )
+
+
+def _to_ms(timestamp: datetime) -> int:
+    return int((np.datetime64(timestamp, "ms")).astype(np.int64))
+
+
+def _size(segment: Segment) -> int:
+    return SEGMENT_OVERHEAD + segment[0].nbytes + segment[1].nbytes
+
+
+def _read(path: str) -> Union[Segment, None]:
+    try:
+        data = np.load(path)
+    except (OSError, ValueError):
+        return None
+
+    return data[0].astype(np.int64), data[1]
+
+
+def _write(path: str, segment: Segment) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        # timestamps in milliseconds are exact in float64
+        np.save(f, np.stack([segment[0].astype(np.float64), segment[1]]))
+    os.replace(tmp, path)
+
+
+cache = SegmentCache()
+
+
+def _on_measurement(event: invalidation.Event) -> None:
+    # past days change only when old readings are imported
+    settled = datetime.utcnow() - timedelta(seconds=cache.settings.settle)
+    if event.key is not None and event.time.date() < settled.date():
+        cache.invalidate(event.key)
+
+
+invalidation.bus.subscribe(invalidation.MEASUREMENTS, _on_measurement)
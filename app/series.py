@@ -0,0 +1,224 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+import app.models as models
+
+
+def to_timestamps(records: List[models.WeatherRecord]) -> np.ndarray:
+    """Timestamps of records in milliseconds since epoch"""
+    return np.array(
+        [record.timestamp.replace(tzinfo=None) for record in records],
+        dtype="datetime64[ms]",
+    ).astype(np.int64)
+
+
+def to_arrays(
+    records: List[models.WeatherRecord], param: models.MeasureType
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Timestamps in milliseconds and average values of a parameter"""
+    records = [record for record in records if getattr(record, param.value)]
+    timestamps = to_timestamps(records)
+    values = np.array(
+        [getattr(record, param.value).avg for record in records], dtype=np.float64
+    )
+
+    return timestamps, values
+
+
+def resample(
+    series: List[Tuple[np.ndarray, np.ndarray]], points: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Resample series onto a common time grid.
+
+    Returns the grid and a matrix with a row per series. Values are linearly
+    interpolated, points outside of a series or inside a gap in its data
+    (longer than two grid steps or three typical sample intervals) are NaN.
+    """
+    timestamps = [ts for ts, _ in series if len(ts)]
+    if not timestamps:
+        return np.empty(0, dtype=np.int64), np.empty((len(series), 0))
+
+    start = min(ts[0] for ts in timestamps)
+    end = max(ts[-1] for ts in timestamps)
+    grid = np.linspace(start, end, points)
+    step = (end - start) / max(points - 1, 1)
+
+    matrix = np.full((len(series), points), np.nan)
+    for row, (ts, values) in zip(matrix, series):
+        if not len(ts):
+            continue
+
+        row[:] = np.interp(grid, ts, values, left=np.nan, right=np.nan)
+        if len(ts) > 1:
+            max_gap = max(2 * step, 3 * np.median(np.diff(ts)))
+            right = np.clip(np.searchsorted(ts, grid), 1, len(ts) - 1)
+            # points on the samples at the ends of a gap are kept
+            inside = (grid != ts[right]) & (grid != ts[right - 1])
+            row[(ts[right] - ts[right - 1] > max_gap) & inside] = np.nan
+
+    return grid.astype(np.int64), matrix
+
+
+# Binary series format, selected with `Accept: application/vnd.wind.series`.
+#
+# All integers are LEB128 varints, signed ones are zigzag encoded.
+#
+#   b"WS" | version (1 byte) | count | columns
+#   timestamps: first timestamp in ms since epoch, then deltas (signed)
+#   every column:
+#     name length | name (utf-8) | decimal digits (1 byte)
+#     presence bitmap, ceil(count / 8) bytes, least significant bit first
+#     present values multiplied by 10 ** digits and rounded, as deltas (signed)
+MEDIA_TYPE = "application/vnd.wind.series"
+MAGIC = b"WS"
+VERSION = 1
+DIGITS = 2
+COLUMN_DIGITS = {"azimuth": 0}
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def _varints(values: np.ndarray) -> bytes:
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+
+    out = np.empty(lengths.sum(), dtype=np.uint8)
+    offsets = np.cumsum(lengths) - lengths
+    rest = values.copy()
+    for i in range(int(lengths.max(initial=0))):
+        mask = lengths > i
+        more = (lengths[mask] > i + 1).astype(np.uint8) << 7
+        out[offsets[mask] + i] = (rest[mask] & np.uint64(0x7F)).astype(np.uint8) | more
+        rest >>= np.uint64(7)
+
+    return out.tobytes()
+
+
+def records_columns(records: List[models.WeatherRecord]) -> Dict[str, np.ndarray]:
+    """Numeric values of records as `<measure>.<field>` columns, NaN if missing"""
+    columns: Dict[str, np.ndarray] = {}
+    for param in models.MeasureType:
+        values = [getattr(record, param.value) for record in records]
+        fields = (
+            models.WindValue.__fields__
+            if param == models.MeasureType.wind
+            else models.MeasureValue.__fields__
+        )
+        for field in fields:
+            if field == "direction":
+                # can be derived from azimuth
+                continue
+
+            column = np.array(
+                [
+                    getattr(value, field) if value is not None else None
+                    for value in values
+                ],
+                dtype=np.float64,
+            )
+            if not np.isnan(column).all():
+                columns[f"{param.value}.{field}"] = column
+
+    return columns
+
+
+def encode(timestamps: np.ndarray, columns: Dict[str, np.ndarray]) -> bytes:
+    """Encode timestamps in ms and columns of values with NaN for missing"""
+    chunks = [
+        MAGIC,
+        bytes([VERSION]),
+        _varints(np.array([len(timestamps), len(columns)])),
+        _varints(_zigzag(np.diff(timestamps.astype(np.int64), prepend=0))),
+    ]
+    for name, values in columns.items():
+        digits = COLUMN_DIGITS.get(name.rsplit(".", 1)[-1], DIGITS)
+        present = ~np.isnan(values)
+        quantized = np.round(values[present] * 10**digits).astype(np.int64)
+        encoded_name = name.encode()
+
+        chunks += [
+            _varints(np.array([len(encoded_name)])),
+            encoded_name,
+            bytes([digits]),
+            np.packbits(present, bitorder="little").tobytes(),
+            _varints(_zigzag(np.diff(quantized, prepend=0))),
+        ]
+
+    return b"".join(chunks)
+
+
+def decode(
+    data: bytes,
+) -> Tuple[List[int], Dict[str, List[Union[float, None]]]]:
+    """Reference decoder, returns timestamps in ms and columns of values"""
+    pos = 0
+
+    def varint() -> int:
+        nonlocal pos
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                return result
+
+    def signed() -> int:
+        value = varint()
+        return (value >> 1) ^ -(value & 1)
+
+    if data[:2] != MAGIC or data[2] != VERSION:
+        raise ValueError("Unsupported series format")
+    pos = 3
+
+    count = varint()
+    columns_count = varint()
+    timestamps = []
+    timestamp = 0
+    for _ in range(count):
+        timestamp += signed()
+        timestamps.append(timestamp)
+
+    columns: Dict[str, List[Union[float, None]]] = {}
+    for _ in range(columns_count):
+        length = varint()
+        name = data[pos : pos + length].decode()
+        digits = data[pos + length]
+        pos += length + 1
+        bitmap = data[pos : pos + (count + 7) // 8]
+        pos += len(bitmap)
+
+        values: List[Union[float, None]] = []
+        quantized = 0
+        for i in range(count):
+            if bitmap[i // 8] >> (i % 8) & 1:
+                quantized += signed()
+                values.append(quantized / 10**digits)
+            else:
+                values.append(None)
+        columns[name] = values
+
+    return timestamps, columns
@@ -0,0 +1,111 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import resource
+import time
+from typing import Any, Dict, Sequence
+
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker
+
+from app.settings import ServerSettings
+
+logger = logging.getLogger(__name__)
+
+
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+
+def memory() -> str:
+    """Resident and private (not shared with other processes) memory"""
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        kb = {key: int(value.split()[0]) for key, value in fields.items()}
+        private = kb["Private_Clean"] + kb["Private_Dirty"]
+        return f"RSS {kb['Rss'] / 1024:.1f} MB, private {private / 1024:.1f} MB"
+    except (OSError, KeyError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return f"peak RSS {peak / 1024:.1f} MB"
+
+
+def warm_up(workers: int = 1):
+    """Import the application and fill lazy caches before workers are forked"""
+    import app.graphs as graphs
+    import app.ingest as ingest
+    from app.server import app
+    from app.settings import Renderer
+
+    graphs.cache.workers = workers
+    ingest.admission.workers = workers
+
+    # loads fonts and PNG backends of both renderers, graphs with a legend
+    # are drawn by matplotlib whatever renderer is configured
+    for renderer in Renderer:
+        graphs.render(640, 480, [([0, 1], [0, 1], None)], renderer)
+
+    return app
+
+
+class Application(BaseApplication):
+    """Gunicorn with Uvicorn workers, the application is loaded before fork,
+    so workers share its memory pages copy-on-write"""
+
+    def __init__(self, settings: ServerSettings, args: Sequence[str] = ()) -> None:
+        self.settings = settings
+        self.args = list(args)
+        self.started = time.monotonic()
+        super().__init__()
+
+    def load_config(self) -> None:
+        options: Dict[str, Any] = {
+            "bind": f"{self.settings.host}:{self.settings.port}",
+            "workers": self.settings.workers or os.cpu_count() or 1,
+            "worker_class": f"{__name__}.Worker",
+            "preload_app": True,
+            "backlog": self.settings.backlog,
+            "keepalive": self.settings.keepalive,
+            "timeout": self.settings.timeout,
+            "graceful_timeout": self.settings.graceful_timeout,
+            "max_requests": self.settings.max_requests,
+            "max_requests_jitter": self.settings.max_requests_jitter,
+            "accesslog": "-" if self.settings.access_log else None,
+            "forwarded_allow_ips": "*",
+            "proxy_allow_ips": "*",
+            "when_ready": self.when_ready,
+            "post_worker_init": self.post_worker_init,
+        }
+        for key, value in options.items():
+            self.cfg.set(key, value)
+
+        # gunicorn command line options override the settings
+        parsed = self.cfg.parser().parse_args(self.args)
+        for key, value in vars(parsed).items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return warm_up(self.cfg.workers)
+
+    def when_ready(self, server) -> None:
+        server.log.info(
+            f"Started in {time.monotonic() - self.started:.2f}s, "
+            f"{self.cfg.workers} workers, master {memory()}"
+        )
+
+    def post_worker_init(self, worker) -> None:
+        worker.log.info(f"Worker {worker.pid} {memory()}")
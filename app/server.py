@@ -13,16 +13,21 @@
 # limitations under the License.
 
 import fastapi
-from fastapi.responses import HTMLResponse
-from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 
 from app.api import router as api_router
+from app.compression import CompressionMiddleware
 from app.drivers import router as drivers_router
 from app.log import setup_logging
 from app.settings import config
-import app.repositories.measurements as measurements
+import app.database as database
+import app.graphs as graphs
+import app.health as health
+import app.invalidation as invalidation
+import app.sketches as sketches
+import app.status as status
+from app.spool import spool
 
 setup_logging()
 
@@ -31,25 +36,65 @@ app = fastapi.FastAPI(
     redoc_url="/redoc" if config.common.debug else None,
 )
 
-app.add_middleware(GZipMiddleware, minimum_size=1024)
+app.add_middleware(CompressionMiddleware, minimum_size=config.compression.minimum_size)
 
 app.include_router(api_router, prefix="/api")
 app.include_router(drivers_router)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
 
 
 @app.on_event("startup")
 async def on_startup() -> None:
     # verify database
-    pass
+    health.database.start()
+    database.start_migration_check()
+    invalidation.bus.start()
+    graphs.cache.start()
+    sketches.buffer.start()
+    spool.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    await graphs.cache.stop()
+    await spool.stop()
+    await sketches.buffer.stop()
+    await health.database.stop()
+    await database.stop_migration_check()
+    await invalidation.bus.stop()
+
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """The process is alive, no I/O"""
+    return {"ok": True}
+
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """The process can take traffic: cached database ping, ingest backlog and
+    graphs render pool saturation"""
+    ready, checks = health.readiness()
+
+    return JSONResponse({"ok": ready, **checks}, status_code=200 if ready else 503)
 
 
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
-async def index(request: fastapi.Request):
-    last_data = await measurements.select_last()
+async def index(
+    q: str = fastapi.Query("", max_length=100),
+    region: str = fastapi.Query(""),
+    sort: str = fastapi.Query(
+        "updated", regex="^(" + "|".join(status.SORT_KEYS) + ")$"
+    ),
+    order: str = fastapi.Query("desc", regex="^(asc|desc)$"),
+    page: int = fastapi.Query(1, ge=1),
+    size: int = fastapi.Query(config.status.page_size, ge=1, le=500),
+):
+    try:
+        bbox = status.parse_region(region) if region else None
+    except ValueError as e:
+        raise fastapi.HTTPException(400, "Invalid region") from e
 
-    return templates.TemplateResponse(
-        "index.html", {"request": request, "data": last_data}
-    )
+    query = status.Query(q.strip(), bbox, sort, order == "desc", page, size)
+    return HTMLResponse(await status.page.render(query))
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import os
+from enum import Enum
 from typing import Any, Dict, Tuple
 
 import dotenv
@@ -48,17 +49,212 @@ class CommonSettings(pydantic.BaseModel):
     debug: bool = False
 
 
+class StorageType(str, Enum):
+    # a document per reading, a native time series collection on MongoDB 5+
+    readings = "readings"
+    # a document per station and hour, for MongoDB without time series
+    buckets = "buckets"
+
+
 class DatabaseSettings(pydantic.BaseModel):
     dsn: MongoUrl = pydantic.Field(
         "mongodb://localhost:27017/", description="MongoDB connection string"
     )
     database: str = pydantic.Field("wind", description="MongoDB database name")
+    measurements: str = pydantic.Field(
+        "measurements_compact", description="Measurements collection name"
+    )
+    storage: StorageType = pydantic.Field(
+        StorageType.readings, description="Measurements storage layout"
+    )
     debug: bool = False
 
 
+class Renderer(str, Enum):
+    # NumPy rasterizer, single color lines without legends
+    raster = "raster"
+    matplotlib = "matplotlib"
+
+
+class GraphsSettings(pydantic.BaseModel):
+    renderer: Renderer = pydantic.Field(
+        Renderer.raster, description="Renderer of graphs without legends"
+    )
+    render_threads: int = pydantic.Field(
+        0, ge=0, description="Threads rendering graphs, 0 for the number of cores"
+    )
+    cache_size: int = pydantic.Field(1000, description="Cached graphs count")
+    max_age: float = pydantic.Field(
+        60, description="Seconds a cached graph may lag behind new readings"
+    )
+    warmer_top: int = pydantic.Field(
+        100, description="Most requested graphs to render in background"
+    )
+    warmer_window: float = pydantic.Field(
+        600, description="Seconds after which request counts are halved"
+    )
+    warmer_cpu: float = pydantic.Field(
+        0.25,
+        ge=0,
+        le=1,
+        description="CPU share of background rendering by all workers, 0 to disable",
+    )
+
+
+class SegmentsSettings(pydantic.BaseModel):
+    memory: int = pydantic.Field(
+        64 * 2**20, description="Bytes of day segments kept in memory"
+    )
+    path: str = pydantic.Field(
+        "", description="Directory of day segments on disk, empty to disable"
+    )
+    points_per_day: int = pydantic.Field(
+        288, gt=0, description="Averaged points of a day segment at most"
+    )
+    settle: float = pydantic.Field(
+        3600, description="Seconds after the end of a day until it is cached"
+    )
+
+
+class CompressionSettings(pydantic.BaseModel):
+    minimum_size: int = pydantic.Field(
+        1024, description="Bytes of a response body to compress at least"
+    )
+    gzip_level: int = pydantic.Field(6, ge=1, le=9, description="gzip level")
+    brotli_quality: int = pydantic.Field(
+        5, ge=0, le=11, description="Brotli quality of responses"
+    )
+    zstd_level: int = pydantic.Field(3, ge=1, le=22, description="Zstandard level")
+    cache_size: int = pydantic.Field(
+        32 * 2**20, description="Bytes of immutable responses kept compressed"
+    )
+
+
+class IngestSettings(pydantic.BaseModel):
+    rate: float = pydantic.Field(
+        0.2,
+        gt=0,
+        description="Readings per second accepted from a station by all workers",
+    )
+    burst: float = pydantic.Field(
+        2, ge=1, description="Readings a station may send at once"
+    )
+    max_inflight: int = pydantic.Field(
+        100,
+        description="Readings written at once by all workers before rejecting new ones",
+    )
+    retry_after: int = pydantic.Field(
+        5, description="Seconds to retry after a rejected reading"
+    )
+
+
+class SpoolSettings(pydantic.BaseModel):
+    enabled: bool = pydantic.Field(
+        False, description="Acknowledge readings once they are in the local spool"
+    )
+    path: str = pydantic.Field(
+        "", description="Spool directory, on a persistent volume in containers"
+    )
+    fsync_interval: float = pydantic.Field(
+        0.005, description="Seconds to collect readings for a single fsync"
+    )
+    segment_size: int = pydantic.Field(
+        16 * 2**20, description="Bytes after which a new spool file is started"
+    )
+    batch_size: int = pydantic.Field(1000, description="Readings per replay insert")
+    replay_interval: float = pydantic.Field(
+        1.0, description="Seconds between replay attempts when idle"
+    )
+
+    @pydantic.validator("path", always=True)
+    def path_is_set(cls, v: str, values: Dict[str, Any]) -> str:
+        if values.get("enabled") and not v:
+            raise ValueError("spool path is required when the spool is enabled")
+        return v
+
+
+class HealthSettings(pydantic.BaseModel):
+    interval: float = pydantic.Field(5, description="Seconds between database pings")
+    timeout: float = pydantic.Field(2, description="Seconds to wait for a ping")
+    max_spool_lag: float = pydantic.Field(
+        60, description="Seconds of spool replay lag when the server is not ready"
+    )
+    max_render_saturation: float = pydantic.Field(
+        4, description="Graphs in progress per render thread when not ready"
+    )
+
+
+class InvalidationSource(str, Enum):
+    # change streams where supported, polling otherwise
+    auto = "auto"
+    # change streams only, they require a replica set or a sharded cluster
+    change_streams = "change_streams"
+    polling = "polling"
+
+
+class InvalidationSettings(pydantic.BaseModel):
+    enabled: bool = pydantic.Field(
+        True, description="Evict caches after writes of other processes"
+    )
+    source: InvalidationSource = pydantic.Field(
+        InvalidationSource.auto, description="Source of changes"
+    )
+    poll_interval: float = pydantic.Field(
+        2, description="Seconds between polls for changes"
+    )
+    poll_overlap: float = pydantic.Field(
+        10, description="Seconds of readings polled again, e.g. replayed late"
+    )
+    retry_interval: float = pydantic.Field(
+        5, description="Seconds to reconnect after a change stream error"
+    )
+
+
+class StatusSettings(pydantic.BaseModel):
+    page_size: int = pydantic.Field(50, description="Stations per status page")
+    max_age: float = pydantic.Field(
+        60, description="Seconds before all last records are reloaded"
+    )
+    cache_size: int = pydantic.Field(256, description="Rendered status pages kept")
+
+
+class ServerSettings(pydantic.BaseModel):
+    host: str = pydantic.Field("127.0.0.1", description="Hostname to listen on")
+    port: int = pydantic.Field(8000, description="Port to listen on")
+    workers: int = pydantic.Field(
+        0, ge=0, description="Worker processes, 0 for the number of cores"
+    )
+    backlog: int = pydantic.Field(2048, description="Pending connections limit")
+    keepalive: int = pydantic.Field(
+        5, description="Seconds to keep an idle connection open"
+    )
+    timeout: int = pydantic.Field(
+        30, description="Seconds before a silent worker is restarted"
+    )
+    graceful_timeout: int = pydantic.Field(
+        30, description="Seconds to finish requests on restart"
+    )
+    max_requests: int = pydantic.Field(
+        10_000, description="Requests before a worker is restarted, 0 to disable"
+    )
+    max_requests_jitter: int = pydantic.Field(
+        1_000, description="Random addition to max_requests"
+    )
+    access_log: bool = True
+
+
 class Settings(pydantic.BaseSettings):
     common: CommonSettings = CommonSettings()
     database: DatabaseSettings = DatabaseSettings()  # type: ignore
+    graphs: GraphsSettings = GraphsSettings()
+    segments: SegmentsSettings = SegmentsSettings()
+    compression: CompressionSettings = CompressionSettings()
+    ingest: IngestSettings = IngestSettings()
+    spool: SpoolSettings = SpoolSettings()
+    health: HealthSettings = HealthSettings()
+    invalidation: InvalidationSettings = InvalidationSettings()
+    status: StatusSettings = StatusSettings()
+    server: ServerSettings = ServerSettings()
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,180 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import logging
+import math
+from datetime import date, datetime
+from typing import Any, Dict, Tuple, Union
+
+import bson
+
+import app.models as models
+import app.repositories.sketches as sketches
+
+logger = logging.getLogger(__name__)
+
+# sketched values as (measure, field), e.g. average temperature and wind gusts
+FIELDS = [(param.value, "avg") for param in models.MeasureType] + [("wind", "max")]
+FLUSH_INTERVAL = 60
+
+
+class Sketch:
+    """Quantile sketch with relative accuracy (DDSketch).
+
+    Values are counted in logarithmic buckets, so any quantile is within
+    `ALPHA` relative error and sketches are merged by adding bucket counts.
+    A day of readings takes a few dozens of buckets.
+    """
+
+    ALPHA = 0.01
+    GAMMA = (1 + ALPHA) / (1 - ALPHA)
+    LOG_GAMMA = math.log(GAMMA)
+    # smaller values are counted as zero
+    MIN_VALUE = 1e-3
+
+    def __init__(self) -> None:
+        self.positive: "collections.Counter[int]" = collections.Counter()
+        self.negative: "collections.Counter[int]" = collections.Counter()
+        self.zero = 0
+
+    @property
+    def count(self) -> int:
+        return self.zero + sum(self.positive.values()) + sum(self.negative.values())
+
+    def add(self, value: float, count: int = 1) -> None:
+        if abs(value) < self.MIN_VALUE:
+            self.zero += count
+        elif value > 0:
+            self.positive[self._index(value)] += count
+        else:
+            self.negative[self._index(-value)] += count
+
+    def merge(self, other: "Sketch") -> None:
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zero += other.zero
+
+    def quantile(self, q: float) -> Union[float, None]:
+        count = self.count
+        if count == 0:
+            return None
+
+        rank = q * (count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+
+        return self._value(max(self.positive))
+
+    @classmethod
+    def _index(cls, value: float) -> int:
+        return math.ceil(math.log(value) / cls.LOG_GAMMA)
+
+    @classmethod
+    def _value(cls, index: int) -> float:
+        return 2 * cls.GAMMA**index / (cls.GAMMA + 1)
+
+
+SketchKey = Tuple[bson.ObjectId, str, date]
+
+
+class SketchBuffer:
+    """Sketches of imported readings, periodically added to the database"""
+
+    def __init__(self) -> None:
+        self._sketches: Dict[SketchKey, Sketch] = collections.defaultdict(Sketch)
+        self._task: Union[asyncio.Task, None] = None
+
+    def add(
+        self,
+        station_id: bson.ObjectId,
+        timestamp: datetime,
+        values: Dict[str, Union[Dict[str, Any], None]],
+    ) -> None:
+        day = timestamp.date()
+        for param, field in FIELDS:
+            value = (values.get(param) or {}).get(field)
+            if value is not None:
+                self._sketches[(station_id, f"{param}.{field}", day)].add(value)
+
+    def merge(self, other: "SketchBuffer") -> None:
+        """Add sketches buffered by another process"""
+        for key, sketch in other._sketches.items():
+            self._sketches[key].merge(sketch)
+
+    async def flush(self) -> None:
+        buffered, self._sketches = self._sketches, collections.defaultdict(Sketch)
+        while buffered:
+            key, sketch = next(iter(buffered.items()))
+            station_id, field, day = key
+            try:
+                await sketches.increment(
+                    station_id,
+                    field,
+                    day,
+                    sketch.zero,
+                    sketch.positive,
+                    sketch.negative,
+                )
+            except BaseException:
+                # keep sketches that are not written for the next flush
+                for key, sketch in buffered.items():
+                    self._sketches[key].merge(sketch)
+                raise
+            del buffered[key]
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush sketches")
+
+
+async def select(
+    station_id: bson.ObjectId, field: str, start: date, end: date
+) -> Sketch:
+    """Merged sketch of a station value for days from `start` to `end`"""
+    sketch = Sketch()
+    for doc in await sketches.select(station_id, field, start, end):
+        sketch.zero += doc.get("z", 0)
+        sketch.positive.update({int(i): n for i, n in doc.get("pos", {}).items()})
+        sketch.negative.update({int(i): n for i, n in doc.get("neg", {}).items()})
+
+    return sketch
+
+
+buffer = SketchBuffer()
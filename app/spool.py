@@ -0,0 +1,314 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import fcntl
+import glob
+import logging
+import os
+import struct
+import time
+import zlib
+from typing import Any, BinaryIO, Dict, List, Tuple, Union
+
+import bson
+
+import app.repositories.measurements as measurements
+from app.settings import config
+
+logger = logging.getLogger(__name__)
+
+# payload length, crc32 of payload, unix time of append
+FRAME = struct.Struct("<IId")
+
+
+def _save_offset(path: str, offset: int) -> None:
+    with open(path + ".tmp", "w") as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _load_offset(path: str) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return 0
+
+
+def _read_frames(
+    file: BinaryIO, offset: int, limit: int
+) -> Tuple[List[Tuple[float, bytes]], int]:
+    """Read up to `limit` complete frames, returns them and the next offset"""
+    file.seek(offset)
+    frames = []
+    while len(frames) < limit:
+        header = file.read(FRAME.size)
+        if len(header) < FRAME.size:
+            break
+        length, crc, appended_at = FRAME.unpack(header)
+        payload = file.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        frames.append((appended_at, payload))
+        offset += FRAME.size + length
+
+    return frames, offset
+
+
+class Segment:
+    """Spool file with its replay offset, locked while in use"""
+
+    def __init__(self, path: str, file: BinaryIO, own: bool) -> None:
+        self.path = path
+        self.file = file
+        self.own = own
+        self.offset = _load_offset(path + ".offset")
+
+    @classmethod
+    def create(cls, directory: str) -> "Segment":
+        path = os.path.join(directory, f"{time.time_ns()}-{os.getpid()}.spool")
+        file = open(path, "a+b")
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return cls(path, file, own=True)
+
+    @classmethod
+    def acquire(cls, path: str) -> Union["Segment", None]:
+        """Open a segment left by another process, None if it is still in use"""
+        try:
+            file = open(path, "r+b")
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+        if not os.path.exists(path):
+            # replayed and removed meanwhile
+            file.close()
+            return None
+        return cls(path, file, own=False)
+
+    def size(self) -> int:
+        return os.fstat(self.file.fileno()).st_size
+
+    def remove(self) -> None:
+        for path in (self.path + ".offset", self.path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.file.close()
+
+
+class Spool:
+    """Write-ahead log of accepted readings.
+
+    Readings are appended to a local segment file and acknowledged once the
+    batch they belong to is fsync'ed, so ingest latency depends on the local
+    disk only. A background replayer inserts them into MongoDB in bulk and
+    saves the replayed offset after every insert. After a crash or a failed
+    insert, readings that may already be in the database are skipped by id,
+    so replay is idempotent. Segments left by stopped processes are replayed
+    by any running one.
+    """
+
+    def __init__(self) -> None:
+        self.settings = config.spool
+        self.appended = 0
+        self.replayed = 0
+        self.lag = 0.0
+        self._active: Union[Segment, None] = None
+        # own segments not replayed yet, the last one is active
+        self._segments: List[Segment] = []
+        self._pending: List[Tuple[bytes, asyncio.Future]] = []
+        self._flushing: Union[asyncio.Task, None] = None
+        self._lock: Union[asyncio.Lock, None] = None
+        self._wakeup: Union[asyncio.Event, None] = None
+        self._task: Union[asyncio.Task, None] = None
+        self._uncertain = True
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def append(self, document: Dict[str, Any]) -> None:
+        """Append a measurement document, returns when it is on disk"""
+        payload = bson.encode(document)
+        frame = FRAME.pack(len(payload), zlib.crc32(payload), time.time()) + payload
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((frame, future))
+        if self._flushing is None:
+            self._flushing = asyncio.create_task(self._flush())
+
+        await future
+
+    def start(self) -> None:
+        if self.settings.enabled and self._task is None:
+            os.makedirs(self.settings.path, exist_ok=True)
+            self._lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._replay())
+
+    async def stop(self) -> None:
+        if self._flushing is not None:
+            await self._flushing
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for segment in self._segments:
+            segment.file.close()
+        self._segments = []
+        self._active = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Depth and lag of the spool"""
+        depth = 0
+        paths = (
+            []
+            if not self.settings.path
+            else glob.glob(os.path.join(self.settings.path, "*.spool"))
+        )
+        for path in paths:
+            try:
+                depth += os.path.getsize(path) - _load_offset(path + ".offset")
+            except (OSError, ValueError):
+                pass
+
+        return {
+            "segments": len(paths),
+            "bytes": depth,
+            "records": self.appended - self.replayed,
+            "lag": self.lag,
+        }
+
+    async def _flush(self) -> None:
+        # group commit: collect appends for a while and fsync them at once
+        await asyncio.sleep(self.settings.fsync_interval)
+        pending, self._pending = self._pending, []
+        self._flushing = None
+
+        async with self._lock:
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._write, b"".join(frame for frame, _ in pending)
+                )
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                return
+
+        self.appended += len(pending)
+        for _, future in pending:
+            future.set_result(None)
+        self._wakeup.set()
+
+    def _write(self, data: bytes) -> None:
+        if self._active is None or self._active.size() >= self.settings.segment_size:
+            self._active = Segment.create(self.settings.path)
+            self._segments.append(self._active)
+
+        self._active.file.seek(0, os.SEEK_END)
+        self._active.file.write(data)
+        self._active.file.flush()
+        os.fsync(self._active.file.fileno())
+
+    async def _replay(self) -> None:
+        backoff = 1.0
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=self.settings.replay_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                while await self._replay_batch():
+                    pass
+                backoff = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Failed to replay spool, retry in {backoff}s")
+                self._uncertain = True
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _next_segment(self) -> Union[Segment, None]:
+        # own closed segments, then ones left by other processes, then the active one
+        for segment in self._segments:
+            if segment is not self._active:
+                return segment
+
+        for path in sorted(glob.glob(os.path.join(self.settings.path, "*.spool"))):
+            segment = Segment.acquire(path)
+            if segment is not None:
+                logger.info(f"Replaying spool segment {path}")
+                # its process might have stopped between an insert and saving
+                # the offset
+                self._uncertain = True
+                self._segments.insert(0, segment)
+                return segment
+
+        return self._active
+
+    async def _replay_batch(self) -> bool:
+        """Replay a batch of readings, returns False if there is nothing to do"""
+        segment = self._next_segment()
+        if segment is None:
+            self.lag = 0.0
+            return False
+
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            frames, offset = await loop.run_in_executor(
+                None,
+                _read_frames,
+                segment.file,
+                segment.offset,
+                self.settings.batch_size,
+            )
+
+        if not frames:
+            if segment is self._active:
+                self.lag = 0.0
+                return False
+
+            if offset < segment.size():
+                logger.warning(f"Skipping a torn record at the end of {segment.path}")
+            self._segments.remove(segment)
+            await loop.run_in_executor(None, segment.remove)
+            return True
+
+        self.lag = time.time() - frames[0][0]
+        documents = [bson.decode(payload) for _, payload in frames]
+        if self._uncertain:
+            documents = await measurements.exclude_existing(documents)
+        if documents:
+            await measurements.insert_many(documents)
+        self._uncertain = False
+
+        await loop.run_in_executor(None, _save_offset, segment.path + ".offset", offset)
+        segment.offset = offset
+        if segment.own:
+            self.replayed += len(frames)
+
+        return True
+
+
+spool = Spool()
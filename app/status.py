@@ -0,0 +1,245 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+from typing import Dict, List, NamedTuple, Set, Tuple, Union
+
+import jinja2
+from markupsafe import Markup
+
+import app.geo as geo
+import app.invalidation as invalidation
+import app.models as models
+import app.repositories.measurements as measurements
+from app.settings import config
+
+SORT_KEYS = {
+    "name": lambda record: (record.station.name.lower(),),
+    "wind": lambda record: (record.wind is None, record.wind and record.wind.avg),
+    "temperature": lambda record: (
+        record.temperature is None,
+        record.temperature and record.temperature.avg,
+    ),
+    "updated": lambda record: (record.timestamp,),
+}
+
+Region = Tuple[float, float, float, float]
+
+
+class Query(NamedTuple):
+    q: str = ""
+    region: Union[Region, None] = None
+    sort: str = "updated"
+    desc: bool = True
+    page: int = 1
+    size: int = config.status.page_size
+
+    def url(self, **changes) -> str:
+        query = self._replace(**changes)
+        params = {
+            "q": query.q,
+            "region": ",".join(map(str, query.region)) if query.region else "",
+            "sort": query.sort,
+            "order": "desc" if query.desc else "asc",
+            "page": query.page,
+            "size": query.size,
+        }
+        return "?" + urlencode({k: v for k, v in params.items() if v != ""})
+
+
+def parse_region(value: str) -> Region:
+    """Bounding box from `south,west,north,east`"""
+    south, west, north, east = (float(part) for part in value.split(","))
+    if not (
+        -90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180
+    ):
+        raise ValueError("Invalid bounding box")
+    return south, west, north, east
+
+
+class StatusPage:
+    """Status page built from cached per-station rows.
+
+    A row is rendered once for every new reading of a station. Readings of
+    this process come through `notify`, rows of stations written by other
+    processes are expired by the invalidation bus and re-read on the next
+    request. All rows are reloaded every `max_age` seconds in case some
+    changes were missed. Whole pages are kept per query until any row changes.
+    """
+
+    def __init__(
+        self,
+        max_age: float = config.status.max_age,
+        cache_size: int = config.status.cache_size,
+    ) -> None:
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self.version = 0
+        self._env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader("templates"), autoescape=True
+        )
+        self._records: Dict[models.PyObjectId, models.WeatherRecord] = {}
+        self._rows: Dict[models.PyObjectId, Markup] = {}
+        self._pages: "OrderedDict[Query, Tuple[int, str]]" = OrderedDict()
+        self._expired: Set[models.PyObjectId] = set()
+        self._lock: Union[asyncio.Lock, None] = None
+        self._loaded_at: Union[float, None] = None
+
+    def _set(self, record: models.WeatherRecord) -> bool:
+        # accepted readings are timezone aware, stored ones are naive UTC
+        if record.timestamp.tzinfo is not None:
+            timestamp = record.timestamp.astimezone(timezone.utc)
+            record = record.copy(update={"timestamp": timestamp.replace(tzinfo=None)})
+
+        station_id = record.station.id
+        current = self._records.get(station_id)
+        if current is not None and (
+            current.timestamp > record.timestamp
+            or current.timestamp == record.timestamp
+            and current.station == record.station
+        ):
+            return False
+
+        self._records[station_id] = record
+        self._rows[station_id] = Markup(
+            self._env.get_template("status_row.html").render(row=record)
+        )
+        return True
+
+    def notify(self, record: models.WeatherRecord) -> None:
+        """New reading of a station accepted by this process"""
+        if self._set(record):
+            self.version += 1
+
+    def expire(self, station_id: models.PyObjectId, timestamp: datetime) -> None:
+        """A station got a reading written by another process"""
+        current = self._records.get(station_id)
+        if current is None or current.timestamp < timestamp:
+            self._expired.add(station_id)
+
+    def invalidate(self) -> None:
+        """Reload all rows on the next request, e.g. after station changes"""
+        self._loaded_at = None
+
+    def is_fresh(self) -> bool:
+        return (
+            self._loaded_at is not None
+            and time.monotonic() - self._loaded_at < self.max_age
+        )
+
+    async def refresh(self) -> None:
+        if self.is_fresh() and not self._expired:
+            return
+
+        # created on first use to bind to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if not self.is_fresh():
+                self._expired.clear()
+                await self._reload()
+            elif self._expired:
+                station_ids = list(self._expired)
+                self._expired.clear()
+                changed = [
+                    self._set(record)
+                    for record in await measurements.select_last(station_ids)
+                ]
+                if any(changed):
+                    self.version += 1
+
+    async def _reload(self) -> None:
+        records = await measurements.select_last()
+        changed = False
+        for record in records:
+            changed |= self._set(record)
+
+        actual = {record.station.id for record in records}
+        for station_id in set(self._records) - actual:
+            del self._records[station_id]
+            del self._rows[station_id]
+            changed = True
+
+        if changed:
+            self.version += 1
+        self._loaded_at = time.monotonic()
+
+    async def _select(self, query: Query) -> List[models.WeatherRecord]:
+        records = list(self._records.values())
+        if query.q:
+            q = query.q.lower()
+            records = [
+                record
+                for record in records
+                if q in record.station.name.lower() or q in record.station.code.lower()
+            ]
+        if query.region is not None:
+            inside = {station.id for station in await geo.index.within(*query.region)}
+            records = [record for record in records if record.station.id in inside]
+
+        records.sort(key=SORT_KEYS[query.sort], reverse=query.desc)
+        return records
+
+    async def render(self, query: Query) -> str:
+        await self.refresh()
+
+        cached = self._pages.get(query)
+        if cached is not None and cached[0] == self.version:
+            self._pages.move_to_end(query)
+            return cached[1]
+
+        version = self.version
+        records = await self._select(query)
+        pages = max(1, math.ceil(len(records) / query.size))
+        page = min(query.page, pages)
+        start = (page - 1) * query.size
+        content = self._env.get_template("index.html").render(
+            rows=[
+                self._rows[r.station.id] for r in records[start : start + query.size]
+            ],
+            query=query._replace(page=page),
+            pages=pages,
+            total=len(records),
+        )
+
+        self._pages[query] = (version, content)
+        self._pages.move_to_end(query)
+        while len(self._pages) > self.cache_size:
+            self._pages.popitem(last=False)
+
+        return content
+
+
+page = StatusPage()
+
+
+def _on_station(event: invalidation.Event) -> None:
+    page.invalidate()
+
+
+def _on_measurement(event: invalidation.Event) -> None:
+    if event.key is None:
+        page.invalidate()
+    else:
+        page.expire(event.key, event.time)
+
+
+invalidation.bus.subscribe(invalidation.STATIONS, _on_station)
+invalidation.bus.subscribe(invalidation.MEASUREMENTS, _on_measurement)
@@ -12,24 +12,74 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+from typing import Dict, Tuple, Union
+
+import app.graphs as graphs
+import app.invalidation as invalidation
 import app.models as models
+import app.sketches as sketches
+import app.status as status
 import app.repositories.stations as stations
 import app.repositories.measurements as measurements
+from app.spool import spool
+
+STATIONS_TTL = 60
+
+# station lookups by code, so ingest does not wait for the database
+_stations: Dict[str, Tuple[models.Station, float]] = {}
+
+
+def normalize_wind(
+    avg: float,
+    azimuth: Union[int, None],
+    direction: Union[models.WindDirection, None],
+) -> Tuple[Union[int, None], Union[models.WindDirection, None]]:
+    """Calm wind has no direction, otherwise the direction follows the azimuth"""
+    if avg < 0.1:
+        return None, None
+
+    if not azimuth is None:
+        direction = models.WindDirection.from_azimuth(azimuth)
+
+    return azimuth, direction
+
+
+async def get_station(code: str) -> Union[models.Station, None]:
+    cached = _stations.get(code)
+    if cached is not None and time.monotonic() - cached[1] < STATIONS_TTL:
+        return cached[0]
+
+    station = await stations.get_by_code(code)
+    if station is None:
+        _stations.pop(code, None)
+    else:
+        _stations[code] = (station, time.monotonic())
+
+    return station
+
+
+def invalidate_stations() -> None:
+    _stations.clear()
+
+
+invalidation.bus.subscribe(invalidation.STATIONS, lambda event: invalidate_stations())
 
 
 async def import_data(station_code: str, record: models.AnonymousWeatherRecord):
-    station = await stations.get_by_code(station_code)
+    station = await get_station(station_code)
     if station is None:
         raise ValueError(f"Station {station_code} not found")
 
     db_record = models.WeatherRecord(station=station, **record.dict())
-    if db_record.wind.avg < 0.1:
-        db_record.wind.azimuth = None
-        db_record.wind.direction = None
-
-    if not db_record.wind.azimuth is None:
-        db_record.wind.direction = models.WindDirection.from_azimuth(
-            db_record.wind.azimuth
-        )
+    db_record.wind.azimuth, db_record.wind.direction = normalize_wind(
+        db_record.wind.avg, db_record.wind.azimuth, db_record.wind.direction
+    )
 
-    await measurements.insert(db_record)
+    if spool.running:
+        await spool.append(measurements.to_document(db_record))
+    else:
+        await measurements.insert(db_record)
+    graphs.cache.notify(station.id)
+    status.page.notify(db_record)
+    sketches.buffer.add(station.id, db_record.timestamp, db_record.dict())
@@ -3,4 +3,4 @@
 PORT=${PORT:-8000}
 
 python -m app db-init \
-    && gunicorn --bind=0.0.0.0:${PORT} --access-logfile=- --proxy-allow-from='*' -k uvicorn.workers.UvicornWorker app.server:app $@
+    && exec python -m app serve --host=0.0.0.0 --port=${PORT} "$@"
@@ -1,3 +1,4 @@
 #!/bin/sh
 
-python -m app ping
+# busybox wget, no Python interpreter is started for a check
+wget -q -T 2 -O /dev/null "http://127.0.0.1:${PORT:-8000}/healthz"
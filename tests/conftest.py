@@ -0,0 +1,74 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import json
+from typing import Any, Dict, NamedTuple
+from urllib.parse import urlencode
+
+import pytest
+
+
+class Response(NamedTuple):
+    status_code: int
+    headers: Dict[str, str]
+    content: bytes
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+def request(app, path: str, params=None, headers=None) -> Response:
+    """Call an ASGI application with a GET request"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "client": ("testclient", 50000),
+        "root_path": "",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": urlencode(params or {}).encode(),
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in {"host": "testserver", **(headers or {})}.items()
+        ],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+
+    start = next(m for m in messages if m["type"] == "http.response.start")
+    return Response(
+        start["status"],
+        {name.decode(): value.decode() for name, value in start["headers"]},
+        b"".join(
+            m.get("body", b"") for m in messages if m["type"] == "http.response.body"
+        ),
+    )
+
+
+@pytest.fixture
+def get():
+    return request
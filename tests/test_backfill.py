@@ -0,0 +1,184 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from datetime import datetime, timezone
+
+import pymongo.errors
+import pytest
+
+import app.backfill as backfill
+import app.models as models
+import app.sketches as sketches
+
+STATION = models.Station(code="IKRASN19", name="x", lat=0, lon=0)
+
+CSV = """timestamp,wind.avg,temperature.avg
+2022-08-15T10:00:00Z,1.5,20
+2022-08-15T10:01:00Z,2.5,
+2022-08-15T10:02:00Z,3.5,21
+2022-08-15T10:03:00Z,4.5,22
+"""
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / "readings.csv"
+    path.write_text(CSV)
+    return str(path)
+
+
+class Database:
+    def __init__(self):
+        self.documents = {}
+        self.fail = False
+        self.excluded = 0
+        self.sketches = sketches.SketchBuffer()
+
+    async def insert_many(self, documents):
+        if self.fail:
+            raise pymongo.errors.BulkWriteError(
+                {"writeErrors": [{"errmsg": "no space left"}] * len(documents)}
+            )
+        for doc in documents:
+            assert doc["_id"] not in self.documents
+            self.documents[doc["_id"]] = doc
+
+    async def exclude_existing(self, documents, by_time=False):
+        assert by_time, "imported readings get new ids"
+        self.excluded += len(documents)
+        existing = {(doc["s"], doc["t"]) for doc in self.documents.values()}
+        return [doc for doc in documents if (doc["s"], doc["t"]) not in existing]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = Database()
+
+    async def get_by_code(code):
+        return STATION if code == STATION.code else None
+
+    async def flush():
+        pass
+
+    monkeypatch.setattr(backfill.stations, "get_by_code", get_by_code)
+    monkeypatch.setattr(backfill.measurements, "insert_many", database.insert_many)
+    monkeypatch.setattr(
+        backfill.measurements, "exclude_existing", database.exclude_existing
+    )
+    monkeypatch.setattr(backfill.sketches.buffer, "merge", database.sketches.merge)
+    monkeypatch.setattr(backfill.sketches.buffer, "flush", flush)
+    monkeypatch.setattr(backfill.segments.cache, "invalidate", lambda id: None)
+    return database
+
+
+def run(path, **kwargs):
+    async def consume():
+        return [
+            rows
+            async for rows in backfill.backfill(
+                path,
+                station=STATION.code,
+                batch_size=2,
+                concurrency=2,
+                processes=2,
+                **kwargs,
+            )
+        ]
+
+    return asyncio.run(consume())
+
+
+def test_read_csv_lines(csv_file):
+    rows = list(backfill.read(csv_file, skip=1))
+
+    assert [row[0] for row in rows] == [3, 4, 5]
+    assert rows[0][3] == {"wind": {"avg": 2.5, "azimuth": None, "direction": None}}
+
+
+def test_read_ndjson_lines(tmp_path):
+    path = tmp_path / "readings.ndjson"
+    path.write_text(
+        '{"timestamp": "2022-08-15T10:00:00", "wind": {"avg": 1}}\n'
+        "\n"
+        '{"timestamp": "2022-08-15T10:01:00", "wind": {"avg": 2}}\n'
+    )
+
+    assert [row[0] for row in backfill.read(str(path))] == [1, 3]
+
+
+def test_error_line(tmp_path):
+    path = tmp_path / "readings.csv"
+    path.write_text("timestamp,wind.avg\n2022-08-15T10:00:00,1\nbad,2\n")
+
+    with pytest.raises(ValueError, match=r"readings.csv:3: "):
+        list(backfill.read(str(path)))
+
+
+def test_ids_in_write_order(csv_file, database):
+    started = datetime.now(timezone.utc).replace(microsecond=0)
+    run(csv_file)
+
+    assert all(id.generation_time >= started for id in database.documents)
+
+
+def test_import(csv_file, database):
+    assert run(csv_file)[-1] == 4
+    assert len(database.documents) == 4
+    # nothing is written before a fresh import
+    assert database.excluded == 0
+
+    counts = {
+        field: sketch.count
+        for (_, field, _), sketch in database.sketches._sketches.items()
+    }
+    assert counts == {"wind.avg": 4, "temperature.avg": 3}
+
+
+def test_import_stations(tmp_path, database):
+    path = tmp_path / "readings.csv"
+    path.write_text(
+        "station,timestamp,wind.avg\n"
+        "IKRASN19,2022-08-15T10:00:00Z,1\n"
+        ",2022-08-15T10:01:00Z,2\n"
+        "\n"
+        "IKRASN19,2022-08-15T10:02:00Z,3\n"
+    )
+
+    assert run(str(path))[-1] == 3
+    assert {doc["s"] for doc in database.documents.values()} == {STATION.id}
+
+    with open(path, "a") as f:
+        f.write("UNKNOWN,2022-08-15T10:03:00Z,4\n")
+    (tmp_path / "readings.csv.checkpoint").unlink()
+    with pytest.raises(ValueError, match=r"readings.csv:6: Station UNKNOWN not found"):
+        run(str(path))
+
+
+def test_resume_skips_written_readings(csv_file, database):
+    run(csv_file)
+    # interrupted before the checkpoint of the last batches was saved
+    with open(csv_file + ".checkpoint", "w") as f:
+        f.write('{"rows": 1}')
+
+    assert run(csv_file)[-1] == 4
+    assert len(database.documents) == 4
+    assert database.excluded > 0
+
+
+def test_write_error(csv_file, database):
+    database.fail = True
+
+    with pytest.raises(ValueError, match="2 readings are not written: no space left"):
+        run(csv_file)
@@ -0,0 +1,27 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from datetime import timedelta
+
+import app.benchmarks as benchmarks
+import app.repositories.measurements as measurements
+
+
+def test_sample_records_are_distinct():
+    records = benchmarks.sample_records(100, timedelta(minutes=5))
+    documents = [measurements.to_document(record) for record in records]
+
+    assert len({doc["_id"] for doc in documents}) == 100
+    assert len({doc["t"] for doc in documents}) == 100
@@ -0,0 +1,88 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from datetime import datetime
+
+import bson
+import fastapi
+import numpy as np
+import pytest
+
+import app.api.user as user
+import app.models as models
+import app.series as series
+
+STATIONS = [
+    models.Station(code="a", name="A", lat=0, lon=0),
+    models.Station(code="b", name="B", lat=1, lon=1),
+]
+START = int(np.datetime64(datetime(2022, 8, 15), "ms").astype(np.int64))
+MINUTE = 60_000
+
+
+@pytest.fixture
+def client(monkeypatch, get):
+    async def select_many(ids):
+        return [station for station in STATIONS if station.id in ids]
+
+    async def select(station_id, param, period):
+        if station_id == STATIONS[0].id:
+            return np.arange(START, START + 10 * MINUTE, MINUTE), np.arange(10.0)
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    monkeypatch.setattr(user.stations, "select_many", select_many)
+    monkeypatch.setattr(user.segments.cache, "select", select)
+
+    app = fastapi.FastAPI()
+    app.include_router(user.router, prefix="/api")
+    return lambda *args, **kwargs: get(app, *args, **kwargs)
+
+
+def compare(client, ids, **headers):
+    return client(
+        "/api/weather/compare",
+        {"stations": ",".join(map(str, ids)), "param": "wind", "points": 4},
+        headers,
+    )
+
+
+def test_compare_json(client):
+    response = compare(client, [station.id for station in STATIONS])
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [station["_id"] for station in body["stations"]] == [
+        str(station.id) for station in STATIONS
+    ]
+    assert len(body["timestamps"]) == 4
+    assert body["values"][0] == [0.0, 3.0, 6.0, 9.0]
+    assert body["values"][1] == [None] * 4
+    assert response.headers["vary"] == "Accept"
+
+
+def test_compare_series(client):
+    response = compare(client, [STATIONS[0].id], accept=series.MEDIA_TYPE)
+
+    assert response.status_code == 200
+    timestamps, columns = series.decode(response.content)
+    assert timestamps[0] == START
+    assert list(columns) == [str(STATIONS[0].id)]
+
+
+def test_compare_errors(client):
+    assert compare(client, ["nope"]).status_code == 400
+    assert compare(client, [bson.ObjectId()]).status_code == 404
+    too_many = [bson.ObjectId() for _ in range(user.MAX_COMPARED_STATIONS + 1)]
+    assert compare(client, too_many).status_code == 400
@@ -0,0 +1,75 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from app.compression import BodyCache, CompressedBody
+from app.settings import CompressionSettings
+
+
+def body(size=100):
+    return CompressedBody(b"x" * size, "image/png")
+
+
+def make_cache(cache_size=10_000):
+    cache = BodyCache()
+    cache.settings = CompressionSettings(cache_size=cache_size)
+    return cache
+
+
+def test_evict_tag():
+    cache = make_cache()
+    cache.put("a/1", body(), tags=["a"])
+    cache.put("a/2", body(), tags=["a", "all"])
+    cache.put("b/1", body(), tags=["b", "all"])
+    cache.put("c", body())
+
+    cache.evict("a")
+
+    assert cache.get("a/1") is None and cache.get("a/2") is None
+    assert cache.get("b/1") is not None and cache.get("c") is not None
+    assert cache._size == 200
+
+    cache.evict("all")
+    assert cache.get("b/1") is None
+    assert cache._tags == {}
+
+
+def test_put_replaces_tags():
+    cache = make_cache()
+    cache.put("key", body(), tags=["a"])
+    cache.put("key", body(50), tags=["b"])
+
+    cache.evict("a")
+
+    assert cache.get("key") is not None
+    assert cache._size == 50
+    cache.evict("b")
+    assert cache.get("key") is None
+    assert cache._size == 0
+
+
+def test_lru_eviction_untags():
+    cache = make_cache(cache_size=250)
+    cache.put("a", body(), tags=["station"])
+    cache.put("b", body())
+    cache.get("a")
+    cache.put("c", body())
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+    cache.put("d", body(), tags=["other"])
+    cache.put("e", body())
+    assert cache.get("a") is None
+    assert "station" not in cache._tags
@@ -0,0 +1,89 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import bson
+import pydantic
+import pytest
+
+import app.geo as geo
+import app.models as models
+
+
+def station(code: str, lat: float, lon: float) -> models.Station:
+    return models.Station(_id=bson.ObjectId(), code=code, name=code, lat=lat, lon=lon)
+
+
+STATIONS = [
+    station("moscow", 55.75, 37.62),
+    station("tver", 56.86, 35.90),
+    station("kazan", 55.79, 49.12),
+    station("anadyr", 64.73, 177.51),
+    station("nome", 64.50, -165.41),
+]
+
+
+@pytest.fixture
+def index(monkeypatch):
+    async def select():
+        return STATIONS
+
+    monkeypatch.setattr(geo.stations, "select", select)
+    return geo.StationIndex()
+
+
+def test_first_query_loads_stations(index):
+    found = asyncio.run(index.nearby(55.75, 37.62, 1))
+
+    assert [s.code for s, _ in found] == ["moscow"]
+
+
+def test_nearby_sorted_by_distance(index):
+    found = asyncio.run(index.nearby(56.0, 37.0, 3))
+
+    assert [s.code for s, _ in found] == ["moscow", "tver", "kazan"]
+    assert found[0][1] == pytest.approx(51, abs=5)
+    assert [d for _, d in found] == sorted(d for _, d in found)
+
+
+def test_nearby_limit_above_size(index):
+    assert len(asyncio.run(index.nearby(0, 0, 100))) == len(STATIONS)
+
+
+def test_within(index):
+    found = asyncio.run(index.within(55, 35, 57, 40))
+
+    assert {s.code for s in found} == {"moscow", "tver"}
+
+
+def test_within_across_antimeridian(index):
+    found = asyncio.run(index.within(60, 170, 70, -160))
+
+    assert {s.code for s in found} == {"anadyr", "nome"}
+
+
+def test_invalidate(index):
+    asyncio.run(index.refresh())
+    assert index.is_fresh()
+
+    index.invalidate()
+
+    assert not index.is_fresh()
+
+
+@pytest.mark.parametrize("lat, lon", [(91, 0), (-91, 0), (0, 181), (0, -181)])
+def test_station_coordinates_bounds(lat, lon):
+    with pytest.raises(pydantic.ValidationError):
+        models.StationIn(code="x", name="x", lat=lat, lon=lon)
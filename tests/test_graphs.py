@@ -0,0 +1,111 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+import bson
+import pytest
+
+import app.graphs as graphs
+import app.invalidation as invalidation
+from app.settings import Renderer
+
+KEY = graphs.GraphKey(bson.ObjectId(), "w", 640, 480, Renderer.raster)
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(graphs, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    renders = []
+
+    async def render_station(key, period):
+        renders.append(key)
+        return b"png%d" % len(renders)
+
+    monkeypatch.setattr(graphs, "render_station", render_station)
+    return renders
+
+
+def test_graph_expires_without_deliveries(monkeypatch, clock, renders):
+    cache = graphs.GraphCache()
+    asyncio.run(cache.get(KEY))
+
+    clock.now += cache.settings.max_age + 1
+    assert asyncio.run(cache.get(KEY)) == b"png1"
+
+    topic = invalidation.bus._topics[invalidation.MEASUREMENTS]
+    monkeypatch.setattr(topic, "source", invalidation.EXPIRY)
+    assert asyncio.run(cache.get(KEY)) == b"png2"
+
+
+def test_outdated_graph_expires_after_max_age(clock, renders):
+    cache = graphs.GraphCache()
+    asyncio.run(cache.get(KEY))
+
+    clock.now += 1
+    cache.notify(KEY.station_id)
+    assert asyncio.run(cache.get(KEY)) == b"png1"
+
+    clock.now += cache.settings.max_age
+    assert asyncio.run(cache.get(KEY)) == b"png2"
+
+
+def test_requests_decay():
+    cache = graphs.GraphCache()
+    other = KEY._replace(param="t")
+    cache._requests.update({KEY: 5, other: 1})
+
+    cache._decay()
+
+    assert cache._requests == {KEY: 2}
+
+
+def test_stale_graphs(clock, renders):
+    cache = graphs.GraphCache()
+    cache.settings = cache.settings.copy(update={"warmer_top": 2})
+    keys = [KEY._replace(width=width) for width in (100, 200, 300)]
+    for count, key in enumerate(keys, start=1):
+        cache._requests[key] = count
+    asyncio.run(cache.get(keys[2]))
+    assert cache._stale() == [keys[1]]
+
+    clock.now += 1
+    cache.notify(KEY.station_id)
+    clock.now += cache.settings.max_age / 2
+    assert cache._stale() == [keys[2], keys[1]]
+
+
+def test_pause_keeps_cpu_share_of_all_workers():
+    cache = graphs.GraphCache()
+    cache.settings = cache.settings.copy(update={"warmer_cpu": 0.25})
+
+    assert cache._pause(1) == pytest.approx(3)
+
+    cache.workers = 4
+    assert cache._pause(1) == pytest.approx(15)
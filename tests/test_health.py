@@ -0,0 +1,158 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import time
+import types
+
+import pytest
+
+import app.graphs as graphs
+import app.health as health
+import app.ingest as ingest
+import app.invalidation as invalidation
+import app.server as server
+from app.settings import config
+from app.spool import spool
+
+
+@pytest.fixture
+def ready(monkeypatch):
+    """State of a server that can take traffic"""
+    monkeypatch.setattr(health.database, "ok", True)
+    monkeypatch.setattr(health.database, "checked_at", time.monotonic())
+    monkeypatch.setattr(ingest.admission, "inflight", 0)
+    monkeypatch.setattr(ingest.admission, "workers", 1)
+    monkeypatch.setattr(spool, "_task", None)
+    monkeypatch.setattr(graphs.pool, "pending", 0)
+    monkeypatch.setattr(config.invalidation, "enabled", True)
+    for topic in invalidation.bus._topics.values():
+        monkeypatch.setattr(topic, "source", "polling")
+    return monkeypatch
+
+
+def test_ready(ready):
+    ok, checks = health.readiness()
+
+    assert ok
+    assert all(check["ok"] for check in checks.values())
+    assert checks["invalidation"]["degraded"] == []
+
+
+def test_stale_database_ping(ready):
+    ready.setattr(
+        health.database,
+        "checked_at",
+        time.monotonic() - 3 * config.health.interval - 1,
+    )
+
+    ok, checks = health.readiness()
+
+    assert not ok
+    assert not checks["database"]["ok"]
+    assert checks["database"]["age"] > 3 * config.health.interval
+
+
+def test_failed_database_ping(ready, monkeypatch):
+    class Admin:
+        async def command(self, command):
+            raise ConnectionError("refused")
+
+    monkeypatch.setattr(health, "client", types.SimpleNamespace(admin=Admin()))
+
+    asyncio.run(health.database.check())
+
+    ok, checks = health.readiness()
+    assert not ok
+    assert checks["database"]["error"] == "ConnectionError('refused')"
+
+
+def test_ingest_at_max_inflight(ready):
+    ready.setattr(ingest.admission, "inflight", config.ingest.max_inflight - 1)
+    assert health.readiness()[0]
+
+    ready.setattr(ingest.admission, "inflight", config.ingest.max_inflight)
+    ok, checks = health.readiness()
+
+    assert not ok
+    assert not checks["ingest"]["ok"]
+
+
+def test_spool_lag(ready):
+    ready.setattr(spool, "_task", object())
+    ready.setattr(spool, "lag", config.health.max_spool_lag)
+    assert health.readiness()[0]
+
+    ready.setattr(spool, "lag", config.health.max_spool_lag + 1)
+    ok, checks = health.readiness()
+
+    assert not ok
+    assert checks["ingest"]["spool"]["lag"] == config.health.max_spool_lag + 1
+
+
+def test_render_saturation(ready):
+    limit = int(config.health.max_render_saturation * graphs.pool.threads)
+    ready.setattr(graphs.pool, "pending", limit)
+    assert health.readiness()[0]
+
+    ready.setattr(graphs.pool, "pending", limit + 1)
+    ok, checks = health.readiness()
+
+    assert not ok
+    assert checks["render"]["saturation"] > config.health.max_render_saturation
+
+
+def test_invalidation_not_running(ready):
+    topic = invalidation.bus._topics[invalidation.STATIONS]
+    ready.setattr(topic, "source", None)
+
+    assert not health.readiness()[0]
+
+    ready.setattr(config.invalidation, "enabled", False)
+    assert health.readiness()[0]
+
+
+def test_invalidation_degraded_is_ready(ready):
+    topic = invalidation.bus._topics[invalidation.MEASUREMENTS]
+    ready.setattr(topic, "source", invalidation.EXPIRY)
+
+    ok, checks = health.readiness()
+
+    assert ok
+    assert checks["invalidation"]["degraded"] == [invalidation.MEASUREMENTS]
+
+
+def test_healthz_without_dependencies(get, ready):
+    ready.setattr(health.database, "ok", False)
+
+    response = get(server.app, "/healthz")
+
+    assert response.status_code == 200
+    assert response.json() == {"ok": True}
+
+
+def test_readyz(get, ready):
+    response = get(server.app, "/readyz")
+    assert response.status_code == 200
+    assert response.json()["ok"]
+
+    ready.setattr(ingest.admission, "inflight", config.ingest.max_inflight)
+    response = get(server.app, "/readyz")
+    assert response.status_code == 503
+    assert not response.json()["ok"]
+    assert not response.json()["ingest"]["ok"]
+
+    ready.setattr(ingest.admission, "inflight", 0)
+    assert get(server.app, "/readyz").status_code == 200
@@ -0,0 +1,209 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+import bson
+import fastapi
+import pytest
+
+import app.api.user as user
+import app.models as models
+import app.repositories.measurements as measurements
+
+STATION = models.Station(code="x", name="x", lat=0, lon=0)
+START = datetime(2022, 8, 15)
+
+OPERATORS = {
+    "$gt": lambda a, b: a > b,
+    "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b,
+    "$lte": lambda a, b: a <= b,
+}
+
+
+class MemoryStorage:
+    """Readings ordered by time only, like the (s, t) index"""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def page(self, station_id, time_range, ascending, limit, fields=None):
+        found = [
+            doc
+            for doc in self.documents
+            if all(OPERATORS[op](doc["t"], v) for op, v in time_range.items())
+        ]
+        found.sort(key=lambda doc: doc["t"], reverse=not ascending)
+        return found[:limit]
+
+    async def at(self, station_id, timestamp, fields=None):
+        return [doc for doc in self.documents if doc["t"] == timestamp]
+
+
+@pytest.fixture
+def documents(monkeypatch):
+    random.seed(1)
+    # runs of equal timestamps longer than a page
+    times = [
+        START + timedelta(minutes=random.choice([0, 1, 1, 2, 5])) for _ in range(60)
+    ]
+    docs = [
+        {"_id": bson.ObjectId(), "s": STATION.id, "t": t, "w": {"a": 1.0}}
+        for t in times
+    ]
+    random.shuffle(docs)
+
+    async def get(station_id):
+        return STATION
+
+    monkeypatch.setattr(measurements, "storage", MemoryStorage(docs))
+    monkeypatch.setattr(measurements.stations, "get", get)
+    return sorted(docs, key=lambda doc: (doc["t"], doc["_id"]))
+
+
+def walk(limit, ascending):
+    period = models.Period(start=START.date() if ascending else None, end=None)
+    pages = []
+    cursor = None
+    while True:
+        page = asyncio.run(
+            measurements.select_page(
+                STATION.id,
+                period,
+                limit=limit,
+                after=cursor if ascending else None,
+                before=None if ascending else cursor,
+            )
+        )
+        pages.append(page)
+        if not page.more:
+            return pages
+        record = page.records[-1] if ascending else page.records[0]
+        cursor = (record.timestamp, record.id)
+
+
+@pytest.mark.parametrize("limit", [1, 3, 7, 100])
+@pytest.mark.parametrize("ascending", [True, False])
+def test_pages_cover_equal_timestamps(documents, limit, ascending):
+    pages = walk(limit, ascending)
+    if not ascending:
+        pages.reverse()
+    ids = [record.id for page in pages for record in page.records]
+
+    assert ids == [doc["_id"] for doc in documents]
+    assert all(len(page.records) <= limit for page in pages)
+
+
+def test_time_only_cursor(documents):
+    page = asyncio.run(
+        measurements.select_page(
+            STATION.id,
+            models.Period(start=None, end=None),
+            limit=100,
+            after=(START, None),
+        )
+    )
+
+    assert [r.id for r in page.records] == [
+        doc["_id"] for doc in documents if doc["t"] > START
+    ]
+
+
+def test_cursor_roundtrip():
+    record = models.WeatherRecord(
+        station=STATION,
+        timestamp=datetime(2022, 8, 15, 10, 59, 8, 123000),
+        wind=None,
+        temperature=None,
+        humidity=None,
+        pressure=None,
+        light=None,
+        rain=None,
+    )
+
+    assert user._decode_cursor(user._encode_cursor(record)) == (
+        record.timestamp,
+        record.id,
+    )
+
+
+@pytest.mark.parametrize("cursor", ["", "AAAA", "not base64!"])
+def test_invalid_cursor(cursor):
+    with pytest.raises(fastapi.HTTPException):
+        user._decode_cursor(cursor)
+
+
+def links(page, after=None, before=None):
+    request = fastapi.Request(
+        {
+            "type": "http",
+            "scheme": "http",
+            "server": ("test", 80),
+            "path": "/history",
+            "query_string": b"type=history",
+            "headers": [],
+        }
+    )
+    header = user._page_links(request, page, after, before).get("Link", "")
+    return [part.split("rel=")[1].strip('"') for part in header.split(", ") if part]
+
+
+@pytest.mark.parametrize(
+    "ascending, more, after, before, expected",
+    [
+        # the newest page
+        (False, True, None, None, ["prev"]),
+        (False, False, None, None, []),
+        # preceding a cursor
+        (False, True, None, (START, None), ["prev", "next"]),
+        (False, False, None, (START, None), ["next"]),
+        # from the start of the period
+        (True, True, None, None, ["next"]),
+        # following a cursor
+        (True, True, (START, None), None, ["prev", "next"]),
+        (True, False, (START, None), None, ["prev"]),
+    ],
+)
+def test_page_links(ascending, more, after, before, expected):
+    record = models.WeatherRecord(
+        station=STATION,
+        timestamp=START,
+        wind=None,
+        temperature=None,
+        humidity=None,
+        pressure=None,
+        light=None,
+        rain=None,
+    )
+    page = measurements.Page([record], ascending, more)
+
+    assert links(page, after, before) == expected
+
+
+def test_no_links_for_empty_page():
+    assert links(measurements.Page([], True, False), (START, None)) == []
+
+
+def test_final_pages(monkeypatch):
+    page = measurements.Page([], ascending=True, more=False)
+    period = models.Period(start=START.date(), end=START.date())
+
+    assert user._is_final(page, period, None)
+
+    # legacy readings of any day may be migrated yet
+    monkeypatch.setattr(user.database, "unmigrated", True)
+    assert not user._is_final(page, period, None)
@@ -0,0 +1,164 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+
+import fastapi
+import pytest
+
+import app.drivers.pws as pws
+import app.ingest as ingest
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def admission(workers=1, **settings):
+    admission = ingest.Admission()
+    admission.settings = admission.settings.copy(update=settings)
+    admission.workers = workers
+    return admission
+
+
+def test_token_refill(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ingest, "time", clock)
+    bucket = ingest.TokenBucket(2)
+
+    assert bucket.take(0.5, 2) == 0
+    assert bucket.take(0.5, 2) == 0
+    assert bucket.take(0.5, 2) == pytest.approx(2)
+
+    clock.now += 1
+    assert bucket.take(0.5, 2) == pytest.approx(1)
+
+    clock.now += 10
+    bucket.refill(0.5, 2)
+    assert bucket.tokens == 2
+
+
+def test_limits_are_split_between_workers():
+    limits = admission(workers=4, rate=0.2, burst=2, max_inflight=10)
+
+    assert limits.rate == pytest.approx(0.05)
+    assert limits.burst == 1
+    assert limits.max_inflight == 3
+
+
+def test_coalesced_to_newest_reading():
+    written = []
+
+    def write(value):
+        async def write():
+            written.append(value)
+
+        return write
+
+    async def submit():
+        limits = admission(rate=20, burst=1)
+        results = [await limits.submit("station", write(value)) for value in "abc"]
+        await asyncio.gather(*limits._tasks)
+        return results
+
+    assert asyncio.run(submit()) == [True, False, False]
+    assert written == ["a", "c"]
+
+
+def test_overloaded():
+    limits = admission(max_inflight=1, retry_after=7)
+    limits.inflight = 1
+
+    with pytest.raises(ingest.Overloaded) as e:
+        asyncio.run(limits.submit("station", None))
+
+    assert e.value.retry_after == 7
+
+
+PARAMS = {
+    "ID": "station",
+    "PASSWORD": "secret",
+    **dict.fromkeys(
+        [
+            "intemp",
+            "outtemp",
+            "dewpoint",
+            "windchill",
+            "inhumi",
+            "outhumi",
+            "windspeed",
+            "windgust",
+            "winddir",
+            "absbaro",
+            "relbaro",
+            "rainrate",
+            "dailyrain",
+            "weeklyrain",
+            "monthlyrain",
+            "yearlyrain",
+            "light",
+            "UV",
+        ],
+        "1.0",
+    ),
+    "dateutc": "2022-8-15 10:59:8",
+    "softwaretype": "HP2000 V2.5.1",
+    "action": "updateraw",
+    "rtfreq": "5",
+    "realtime": "1",
+}
+
+
+@pytest.fixture
+def send(monkeypatch, get):
+    written = []
+
+    async def import_data(code, record):
+        written.append(record.timestamp)
+
+    monkeypatch.setattr(pws, "import_data", import_data)
+    app = fastapi.FastAPI()
+    app.include_router(pws.router)
+
+    def send(limits, **params):
+        monkeypatch.setattr(ingest, "admission", limits)
+        return get(app, pws.router.prefix, {**PARAMS, **params})
+
+    send.written = written
+    return send
+
+
+def test_endpoint_coalesces_with_202(send):
+    limits = admission(rate=0.01, burst=1)
+
+    assert send(limits).status_code == 201
+    assert send(limits, dateutc="2022-8-15 11:00:0").status_code == 202
+    assert len(send.written) == 1
+    assert list(limits._pending) == ["station"]
+
+
+def test_endpoint_rejects_with_503(send):
+    limits = admission(max_inflight=1, retry_after=7)
+    limits.inflight = 1
+
+    response = send(limits)
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "7"
+    assert send.written == []
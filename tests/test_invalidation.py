@@ -0,0 +1,162 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import bson
+import pytest
+
+import app.invalidation as invalidation
+import app.repositories.measurements as measurements
+from app.settings import InvalidationSettings
+
+START = datetime(2022, 8, 15, 10)
+
+
+def test_reading_time_of_inserted_reading():
+    assert invalidation._reading_time({"fullDocument": {"s": 1, "t": START}}) == START
+
+
+def test_reading_time_of_pushed_readings():
+    change = {
+        "fullDocument": {"s": 1, "h": START},
+        "updateDescription": {
+            "updatedFields": {
+                "n": 3,
+                "r.1": {"_id": 1, "t": START + timedelta(minutes=5)},
+                "r.2": {"_id": 2, "t": START + timedelta(minutes=2)},
+            }
+        },
+    }
+
+    assert invalidation._reading_time(change) == START + timedelta(minutes=5)
+
+
+def test_reading_time_of_new_bucket():
+    change = {
+        "fullDocument": {"s": 1, "h": START},
+        "updateDescription": {
+            "updatedFields": {"r": [{"_id": 1, "t": START + timedelta(minutes=1)}]}
+        },
+    }
+
+    assert invalidation._reading_time(change) == START + timedelta(minutes=1)
+    assert invalidation._reading_time({"fullDocument": {"s": 1, "h": START}}) == START
+    assert invalidation._reading_time({}) is None
+
+
+def test_written_at():
+    wall_time = datetime(2022, 8, 15, 13, tzinfo=timezone(timedelta(hours=3)))
+
+    assert invalidation._written_at({"wallTime": wall_time}) == START
+    assert invalidation._written_at({"clusterTime": bson.Timestamp(START, 1)}) == START
+
+
+def test_publish_isolates_handlers():
+    bus = invalidation.InvalidationBus()
+    received = []
+
+    def failing(event):
+        raise RuntimeError("broken cache")
+
+    bus.subscribe(invalidation.MEASUREMENTS, failing)
+    bus.subscribe(invalidation.MEASUREMENTS, received.append)
+    event = invalidation.Event(invalidation.MEASUREMENTS, 1, datetime.utcnow())
+
+    bus.publish(event, written_at=datetime.utcnow() - timedelta(seconds=30))
+
+    assert received == [event]
+    stats = bus.stats()[invalidation.MEASUREMENTS]
+    assert stats["events"] == 1
+    assert 29 < stats["lag"] < 31
+
+
+@pytest.fixture
+def polled(monkeypatch):
+    """Events of polls returning the given updates, one list per poll"""
+
+    def run(*polls):
+        bus = invalidation.InvalidationBus()
+        bus.settings = InvalidationSettings(poll_interval=0, poll_overlap=10)
+        events = []
+        bus.subscribe(invalidation.MEASUREMENTS, events.append)
+        calls = []
+
+        async def can_poll():
+            return True
+
+        async def select_updated(since):
+            if len(calls) == len(polls):
+                raise asyncio.CancelledError
+            calls.append(since)
+            return polls[len(calls) - 1]
+
+        monkeypatch.setattr(measurements, "select_updated", select_updated)
+        monkeypatch.setattr(measurements, "can_poll", can_poll)
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(bus._poll_measurements())
+        return events, calls
+
+    return run
+
+
+def test_poll_skips_delivered_readings(polled):
+    station_id = bson.ObjectId()
+    first_id, second_id = bson.ObjectId(), bson.ObjectId()
+    first = measurements.Update(station_id, first_id, START, START)
+    second = measurements.Update(
+        station_id, second_id, START, START + timedelta(minutes=1)
+    )
+
+    events, calls = polled([first], [first], [second])
+
+    assert [event.time for event in events] == [
+        START,
+        START + timedelta(minutes=1),
+        START,
+    ]
+    assert all(event.key == station_id for event in events)
+    # polls overlap to catch readings written after their id was created
+    overlapped = datetime.utcnow() - timedelta(seconds=9)
+    assert all(since < overlapped for since in calls[1:])
+
+
+def test_poll_delivers_imported_readings(polled):
+    # readings of a past day written now are polled by their new ids
+    old = datetime.utcnow() - timedelta(days=30)
+    update = measurements.Update(bson.ObjectId(), bson.ObjectId(), old, old)
+
+    events, _ = polled([update])
+
+    assert [event.time for event in events] == [old]
+
+
+def test_no_polling_without_index(monkeypatch):
+    async def can_poll():
+        return False
+
+    async def select_updated(since):
+        raise AssertionError("measurements are scanned")
+
+    monkeypatch.setattr(measurements, "can_poll", can_poll)
+    monkeypatch.setattr(measurements, "select_updated", select_updated)
+    bus = invalidation.InvalidationBus()
+    bus.settings = InvalidationSettings(poll_interval=0)
+
+    asyncio.run(bus._poll_measurements())
+
+    assert bus.stats()[invalidation.MEASUREMENTS]["source"] == invalidation.EXPIRY
+    assert bus.degraded == [invalidation.MEASUREMENTS]
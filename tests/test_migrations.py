@@ -0,0 +1,159 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+from datetime import datetime, timedelta
+
+import bson
+import pymongo.errors
+import pytest
+
+import app.database as database
+import app.migrations as migrations
+import app.models as models
+
+STATION = models.Station(code="x", name="x", lat=0, lon=0)
+START = datetime(2022, 8, 15)
+
+
+def _key(id):
+    # checkpoint ids are documents
+    return repr(id) if isinstance(id, dict) else id
+
+
+class Cursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def __aiter__(self):
+        for doc in self.documents:
+            yield doc
+
+
+class Collection:
+    def __init__(self, documents=()):
+        self.documents = {doc["_id"]: doc for doc in documents}
+
+    async def distinct(self, key):
+        return list({doc["station"]["_id"] for doc in self.documents.values()})
+
+    def find(self, query, sort=None, batch_size=None):
+        since = query["timestamp"]["$gt"]
+        return Cursor(
+            sorted(
+                (
+                    doc
+                    for doc in self.documents.values()
+                    if doc["station"]["_id"] == query["station._id"]
+                    and doc["timestamp"] > since
+                ),
+                key=lambda doc: doc["timestamp"],
+            )
+        )
+
+    async def find_one(self, query, projection=None):
+        return self.documents.get(_key(query["_id"]))
+
+    async def replace_one(self, query, document, upsert=False):
+        self.documents[_key(query["_id"])] = document
+
+
+class Database:
+    def __init__(self, legacy):
+        self.collections = {"measurements": Collection(legacy), "target": Collection()}
+        self.migrations = Collection()
+
+    async def list_collection_names(self):
+        return list(self.collections)
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+
+class Storage:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def exclude_existing(self, documents):
+        return [doc for doc in documents if doc["_id"] not in self.collection.documents]
+
+    async def insert_many(self, documents, ordered=True):
+        self.collection.documents.update({doc["_id"]: doc for doc in documents})
+
+
+@pytest.fixture
+def db(monkeypatch):
+    legacy = [
+        {
+            "_id": bson.ObjectId(),
+            "station": STATION.dict(by_alias=True),
+            "timestamp": START + timedelta(minutes=i),
+            **{param.value: None for param in models.MeasureType},
+            "wind": {"avg": 1.0},
+        }
+        for i in range(5)
+    ]
+    db = Database(legacy)
+    monkeypatch.setattr(migrations, "db", db)
+    monkeypatch.setattr(
+        migrations, "STORAGES", {migrations.config.database.storage: Storage}
+    )
+    return db
+
+
+def test_migration_invalidates_segments(db, monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(migrations.segments.cache, "invalidate", invalidated.append)
+
+    async def migrate():
+        return [
+            count
+            async for _, count in migrations.compact_measurements(
+                "measurements", "target", batch_size=2
+            )
+        ]
+
+    assert asyncio.run(migrate()) == [2, 2, 1]
+    assert len(db["target"].documents) == 5
+    assert invalidated == [STATION.id]
+
+
+def test_migration_check(monkeypatch):
+    states = [True, pymongo.errors.AutoReconnect("down"), False]
+
+    async def has_unmigrated(collections):
+        state = states.pop(0)
+        if isinstance(state, Exception):
+            raise state
+        assert database.unmigrated
+        return state
+
+    async def list_collection_names():
+        return []
+
+    monkeypatch.setattr(database, "_has_unmigrated", has_unmigrated)
+    monkeypatch.setattr(database.db, "list_collection_names", list_collection_names)
+    monkeypatch.setattr(database, "unmigrated", False)
+
+    async def check():
+        database.start_migration_check(interval=0)
+        assert database.unmigrated
+        await database._migration_check
+        await database.stop_migration_check()
+
+    asyncio.run(check())
+
+    assert not states
+    assert not database.unmigrated
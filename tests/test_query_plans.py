@@ -0,0 +1,127 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import uuid
+from typing import NamedTuple, Tuple
+
+import bson
+import pymongo
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app.database import create_measurements
+from app.repositories.storage import BucketsStorage, ReadingsStorage
+from app.settings import StorageType, config
+
+
+def stages(plan):
+    """Stages of a query plan from the root to the leaves"""
+    yield plan
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from stages(child)
+
+
+class Database(NamedTuple):
+    name: str
+    version: Tuple[int, ...]
+
+
+@pytest.fixture(scope="module")
+def database():
+    client = pymongo.MongoClient(
+        config.database.dsn, serverSelectionTimeoutMS=500, connect=True
+    )
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip("MongoDB is not available")
+
+    name = f"test_{uuid.uuid4().hex}"
+    yield Database(name, client.server_info()["versionArray"])
+    client.drop_database(name)
+
+
+def winning_plans(explained):
+    """Winning plans of an explained find or aggregate"""
+    if "winningPlan" in explained:
+        yield explained["winningPlan"]
+    for value in explained.values():
+        if isinstance(value, dict):
+            yield from winning_plans(value)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    yield from winning_plans(item)
+
+
+def explain(database, create, query):
+    async def run():
+        client = AsyncIOMotorClient(config.database.dsn)
+        name = f"measurements_{uuid.uuid4().hex}"
+        await create(client[database.name], name)
+        try:
+            return await query(client[database.name][name])
+        finally:
+            client.close()
+
+    return asyncio.run(run())
+
+
+def test_readings_page_uses_station_time_index(database):
+    async def create(db, name):
+        # as db-init creates it, time series are not supported before 5.0
+        await create_measurements(
+            name,
+            timeseries=database.version[0] >= 5,
+            storage=StorageType.readings,
+            database=db,
+        )
+
+    plan = explain(
+        database,
+        create,
+        lambda c: ReadingsStorage(c).explain_page(bson.ObjectId(), 100),
+    )
+    winning = [stage for plan in winning_plans(plan) for stage in stages(plan)]
+
+    scans = [stage for stage in winning if "keyPattern" in stage]
+    # time series keep the index on their buckets, by meta field and time bounds
+    assert scans and list(scans[0]["keyPattern"])[:2] in (
+        ["s", "t"],
+        ["meta", "control.max.t"],
+    )
+    assert not any(stage["stage"] == "COLLSCAN" for stage in winning)
+    # the index gives the order, no sort in memory
+    assert not any(stage["stage"] == "SORT" for stage in winning)
+
+
+def test_buckets_last_uses_station_hour_id_index(database):
+    async def create(db, name):
+        collection = db[name]
+        await collection.create_index([("s", 1), ("h", -1), ("_id", -1)])
+        await collection.insert_many(
+            [{"s": bson.ObjectId(), "h": 0, "r": []} for _ in range(10)]
+        )
+
+    plan = explain(database, create, lambda c: BucketsStorage(c).explain_last())
+    winning = [stage for plan in winning_plans(plan) for stage in stages(plan)]
+
+    scans = [stage for stage in winning if "keyPattern" in stage]
+    assert scans and list(scans[0]["keyPattern"]) == ["s", "h", "_id"]
+    # buckets are not sorted in memory, only the readings of the last ones
+    assert not any(stage["stage"] == "SORT" for stage in winning)
@@ -0,0 +1,125 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+import app.raster as raster
+
+TIMESTAMPS = np.arange(
+    np.datetime64("2022-08-15T00:00"), np.datetime64("2022-08-15T12:00"), 10
+).astype("datetime64[ms]")
+
+
+def decode_png(png):
+    """RGB image of a PNG, chunks are checked by their CRC"""
+    assert png[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks = []
+    offset = 8
+    while offset < len(png):
+        (length,) = struct.unpack(">I", png[offset : offset + 4])
+        kind = png[offset + 4 : offset + 8]
+        data = png[offset + 8 : offset + 8 + length]
+        (crc,) = struct.unpack(">I", png[offset + 8 + length : offset + 12 + length])
+        assert crc == zlib.crc32(kind + data)
+        chunks.append((kind, data))
+        offset += 12 + length
+
+    assert [kind for kind, _ in chunks] == [b"IHDR", b"IDAT", b"IEND"]
+    width, height, depth, color, *_ = struct.unpack(">IIBBBBB", chunks[0][1])
+    assert (depth, color) == (8, 2)
+
+    raw = np.frombuffer(zlib.decompress(chunks[1][1]), dtype=np.uint8)
+    raw = raw.reshape(height, width * 3 + 1)
+    image = np.empty((height, width * 3), dtype=np.uint8)
+    for y, (kind, *row) in enumerate(raw):
+        row = np.array(row, dtype=np.uint8)
+        if kind == 2 and y > 0:
+            row += image[y - 1]
+        else:
+            assert kind in (0, 2)
+        image[y] = row
+
+    return image.reshape(height, width, 3)
+
+
+def colored(image):
+    """Pixels of the lines, the axes and the grid are gray"""
+    return int(np.count_nonzero(image.max(axis=2) - image.min(axis=2) > 16))
+
+
+def test_encode_png():
+    image = np.random.default_rng(1).integers(0, 256, (7, 5, 3), dtype=np.uint8)
+
+    assert (decode_png(raster.encode_png(image)) == image).all()
+
+
+@pytest.mark.parametrize(
+    "lines",
+    [
+        [],
+        [(TIMESTAMPS[:0], [], None)],
+        [(TIMESTAMPS[:1], [3.0], None)],
+        [(TIMESTAMPS, np.full(len(TIMESTAMPS), np.nan), None)],
+    ],
+    ids=["no lines", "empty", "single point", "all NaN"],
+)
+def test_render_without_lines(lines):
+    image = decode_png(raster.render(640, 480, lines))
+
+    assert image.shape == (480, 640, 3)
+    assert colored(image) == 0
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        np.full(len(TIMESTAMPS), 5.0),
+        np.zeros(len(TIMESTAMPS)),
+        np.where(np.arange(len(TIMESTAMPS)) % 2, 1e308, -1e308),
+        np.full(len(TIMESTAMPS), 1e308),
+        np.linspace(0, 1e-300, len(TIMESTAMPS)),
+        np.where(np.arange(len(TIMESTAMPS)) % 7, 1.0, np.inf),
+    ],
+    ids=["constant", "zero", "extreme", "extreme constant", "tiny", "infinite"],
+)
+def test_render_values(values):
+    image = decode_png(raster.render(640, 480, [(TIMESTAMPS, values, None)]))
+
+    assert image.shape == (480, 640, 3)
+    assert colored(image) > 100
+
+
+def test_render_scales_with_size():
+    image = decode_png(raster.render(1920, 1080, [(TIMESTAMPS, TIMESTAMPS, None)]))
+
+    assert image.shape == (1080, 1920, 3)
+
+
+@pytest.mark.parametrize(
+    "low, high, labels",
+    [
+        (-3, 17, ["-2", "0", "2", "4", "6", "8", "10", "12", "14", "16"]),
+        (0.9, 3.1, ["1.0", "1.5", "2.0", "2.5", "3.0"]),
+        (-1.05e300, 1.05e300, ["-1.0e+300", "-5.0e+299", "0", "5.0e+299", "1.0e+300"]),
+    ],
+)
+def test_value_labels(low, high, labels):
+    ticks = raster._value_ticks(low, high, 10)
+
+    assert [raster._format_value(value, ticks) for value in ticks] == labels
@@ -0,0 +1,172 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+from datetime import date, datetime, timedelta
+
+import bson
+import numpy as np
+
+import app.invalidation as invalidation
+import app.models as models
+import app.segments as segments
+from app.segments import (
+    DAY_MS,
+    SegmentCache,
+    SegmentKey,
+    _size,
+    _to_ms,
+    downsample,
+)
+from app.settings import SegmentsSettings
+
+
+def make_cache(**settings):
+    cache = SegmentCache()
+    cache.settings = SegmentsSettings(**settings)
+    return cache
+
+
+def segment(n, start=0):
+    return np.arange(start, start + n, dtype=np.int64), np.arange(n, dtype=np.float64)
+
+
+def key(day=1, station_id=None):
+    return SegmentKey(
+        station_id or bson.ObjectId(), models.MeasureType.wind, date(2022, 1, day)
+    )
+
+
+def test_downsample_keeps_short_days():
+    short = segment(3)
+    assert downsample(short, 0, 3) is short
+
+
+def test_downsample_averages_bins():
+    timestamps = np.array([0, 1000, DAY_MS // 2, DAY_MS // 2 + 2000], dtype=np.int64)
+    values = np.array([1.0, 3.0, 10.0, 20.0])
+
+    result_timestamps, result_values = downsample((timestamps, values), 0, 2)
+
+    assert result_timestamps.dtype == np.int64
+    np.testing.assert_array_equal(result_timestamps, [500, DAY_MS // 2 + 1000])
+    np.testing.assert_array_equal(result_values, [2.0, 15.0])
+
+
+def test_downsample_skips_empty_bins():
+    timestamps = np.array([0, 1, 2, DAY_MS - 1], dtype=np.int64)
+
+    result_timestamps, _ = downsample((timestamps, np.ones(4)), 0, 3)
+
+    assert len(result_timestamps) == 2
+
+
+def test_remember_replaced_segment():
+    cache = make_cache()
+    cached = key()
+
+    # concurrent misses put the same day twice
+    cache._remember(cached, segment(10))
+    cache._remember(cached, segment(10))
+
+    assert cache.stats()["segments"] == 1
+    assert cache.stats()["bytes"] == _size(segment(10))
+
+
+def test_remember_evicts_least_recent():
+    size = _size(segment(10))
+    cache = make_cache(memory=2 * size)
+    keys = [key(day) for day in (1, 2, 3)]
+
+    for cached in keys:
+        cache._remember(cached, segment(10))
+
+    assert list(cache._segments) == keys[1:]
+    assert cache.stats()["bytes"] == 2 * size
+
+
+def test_invalidate_station():
+    cache = make_cache()
+    station_id = bson.ObjectId()
+    cache._remember(key(1, station_id), segment(10))
+    cache._remember(key(2, station_id), segment(10))
+    cache._remember(key(3), segment(5))
+
+    cache.invalidate(station_id)
+
+    assert cache.stats()["segments"] == 1
+    assert cache.stats()["bytes"] == _size(segment(5))
+
+
+def loader(loads):
+    async def load(station_id, param, first, last):
+        loads.append((first, last))
+        days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        return {
+            day: segment(2, _to_ms(datetime.combine(day, datetime.min.time())))
+            for day in days
+        }
+
+    return load
+
+
+PERIOD = models.Period(start=date(2022, 1, 1), end=date(2022, 1, 3))
+
+
+def test_select_caches_past_days():
+    cache = make_cache(settle=0)
+    loads = []
+    cache._load = loader(loads)
+    station_id = bson.ObjectId()
+
+    first = asyncio.run(cache.select(station_id, models.MeasureType.wind, PERIOD))
+    second = asyncio.run(cache.select(station_id, models.MeasureType.wind, PERIOD))
+
+    assert loads == [(date(2022, 1, 1), date(2022, 1, 3))]
+    assert len(first[0]) == 6
+    np.testing.assert_array_equal(first[0], second[0])
+    assert cache.stats()["hits"] == 3
+
+
+def test_select_does_not_cache_before_migration(monkeypatch):
+    monkeypatch.setattr(segments.database, "unmigrated", True)
+    cache = make_cache(settle=0)
+    loads = []
+    cache._load = loader(loads)
+    station_id = bson.ObjectId()
+
+    asyncio.run(cache.select(station_id, models.MeasureType.wind, PERIOD))
+    asyncio.run(cache.select(station_id, models.MeasureType.wind, PERIOD))
+
+    assert len(loads) == 2
+    assert cache.stats()["segments"] == 0
+
+
+def test_imported_past_readings_invalidate_station(monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(segments.cache, "invalidate", invalidated.append)
+    station_id = bson.ObjectId()
+    now = datetime.utcnow()
+
+    segments._on_measurement(
+        invalidation.Event(invalidation.MEASUREMENTS, station_id, now)
+    )
+    segments._on_measurement(
+        invalidation.Event(
+            invalidation.MEASUREMENTS, station_id, now - timedelta(days=3)
+        )
+    )
+
+    assert invalidated == [station_id]
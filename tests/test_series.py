@@ -0,0 +1,157 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import app.models as models
+import app.series as series
+
+
+def roundtrip(timestamps, columns):
+    decoded_timestamps, decoded = series.decode(series.encode(timestamps, columns))
+    return np.array(decoded_timestamps, dtype=np.int64), {
+        name: np.array([np.nan if v is None else v for v in values])
+        for name, values in decoded.items()
+    }
+
+
+def test_roundtrip():
+    timestamps = np.arange(1_660_000_000_000, 1_660_000_600_000, 60_000)
+    columns = {
+        "wind.avg": np.linspace(0, 12.34, len(timestamps)),
+        "wind.azimuth": np.arange(len(timestamps), dtype=np.float64) * 36,
+    }
+
+    decoded_timestamps, decoded = roundtrip(timestamps, columns)
+
+    np.testing.assert_array_equal(decoded_timestamps, timestamps)
+    np.testing.assert_allclose(decoded["wind.avg"], columns["wind.avg"], atol=0.005)
+    np.testing.assert_array_equal(decoded["wind.azimuth"], columns["wind.azimuth"])
+
+
+def test_negative_deltas():
+    timestamps = np.array([1_000_000, 999_000, 2_000_000, 0, 2**40])
+    columns = {"temperature.avg": np.array([12.5, -30.25, 40.0, -0.01, 0.0])}
+
+    decoded_timestamps, decoded = roundtrip(timestamps, columns)
+
+    np.testing.assert_array_equal(decoded_timestamps, timestamps)
+    np.testing.assert_allclose(decoded["temperature.avg"], columns["temperature.avg"])
+
+
+def test_nan_runs():
+    timestamps = np.arange(20) * 1000
+    values = np.arange(20, dtype=np.float64)
+    values[0:3] = np.nan
+    values[8:17] = np.nan
+    values[19] = np.nan
+
+    _, decoded = roundtrip(timestamps, {"pressure.avg": values})
+
+    np.testing.assert_array_equal(decoded["pressure.avg"], values)
+
+
+def test_empty():
+    decoded_timestamps, decoded = roundtrip(
+        np.empty(0, dtype=np.int64), {"wind.avg": np.empty(0)}
+    )
+
+    assert len(decoded_timestamps) == 0
+    assert len(decoded["wind.avg"]) == 0
+
+
+def test_no_columns():
+    timestamps = np.array([5, 10])
+
+    decoded_timestamps, decoded = roundtrip(timestamps, {})
+
+    np.testing.assert_array_equal(decoded_timestamps, timestamps)
+    assert decoded == {}
+
+
+def test_all_nan_column():
+    timestamps = np.arange(9) * 1000
+    columns = {"rain.avg": np.full(9, np.nan), "wind.avg": np.ones(9)}
+
+    _, decoded = roundtrip(timestamps, columns)
+
+    assert np.isnan(decoded["rain.avg"]).all()
+    np.testing.assert_array_equal(decoded["wind.avg"], columns["wind.avg"])
+
+
+def test_unsupported_version():
+    data = bytearray(series.encode(np.array([1]), {}))
+    data[2] = series.VERSION + 1
+
+    with pytest.raises(ValueError):
+        series.decode(bytes(data))
+
+
+def test_records_columns_skip_missing_measures():
+    start = datetime(2022, 8, 15)
+    records = [
+        models.WeatherRecord(
+            station=models.Station(code="x", name="x", lat=0, lon=0),
+            timestamp=start + timedelta(minutes=i),
+            wind=models.WindValue(avg=i, azimuth=90) if i else None,
+            temperature=None,
+            humidity=None,
+            pressure=None,
+            light=None,
+            rain=None,
+        )
+        for i in range(3)
+    ]
+
+    columns = series.records_columns(records)
+
+    assert set(columns) == {"wind.avg", "wind.azimuth"}
+    np.testing.assert_array_equal(columns["wind.avg"], [np.nan, 1, 2])
+
+
+def test_resample_interpolates_onto_common_grid():
+    first = (np.array([0, 10, 20], dtype=np.int64), np.array([0.0, 10.0, 20.0]))
+    second = (np.array([10, 20, 30], dtype=np.int64), np.array([1.0, 1.0, 1.0]))
+
+    grid, matrix = series.resample([first, second], 4)
+
+    np.testing.assert_array_equal(grid, [0, 10, 20, 30])
+    np.testing.assert_array_equal(matrix[0], [0.0, 10.0, 20.0, np.nan])
+    np.testing.assert_array_equal(matrix[1], [np.nan, 1.0, 1.0, 1.0])
+
+
+def test_resample_gaps_are_nan():
+    timestamps = np.array([0, 1, 2, 3, 100, 101], dtype=np.int64)
+
+    grid, matrix = series.resample([(timestamps, np.ones(6))], 102)
+
+    assert grid.dtype == np.int64
+    assert not np.isnan(matrix[0][:4]).any()
+    assert np.isnan(matrix[0][10:90]).all()
+    assert not np.isnan(matrix[0][100:]).any()
+
+
+def test_resample_empty_series():
+    empty = (np.empty(0, dtype=np.int64), np.empty(0))
+
+    grid, matrix = series.resample([empty, empty], 10)
+    assert len(grid) == 0 and matrix.shape == (2, 0)
+
+    grid, matrix = series.resample([(np.array([5]), np.array([1.0])), empty], 3)
+    np.testing.assert_array_equal(grid, [5, 5, 5])
+    np.testing.assert_array_equal(matrix[0], [1.0, 1.0, 1.0])
+    assert np.isnan(matrix[1]).all()
@@ -0,0 +1,59 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import app.graphs as graphs
+import app.ingest as ingest
+import app.serve as serve
+from app.settings import Renderer, config
+
+
+def test_gunicorn_args_override_settings():
+    settings = config.server.copy(update={"workers": 3, "timeout": 30})
+
+    application = serve.Application(settings, ["--log-level=debug", "--timeout", "90"])
+
+    assert application.cfg.loglevel == "debug"
+    assert application.cfg.timeout == 90
+    assert application.cfg.workers == 3
+    assert application.cfg.preload_app
+
+
+def test_warm_up_loads_all_renderers(monkeypatch):
+    renderers = []
+    monkeypatch.setattr(
+        graphs, "render", lambda *args: renderers.append(args[-1]) or b""
+    )
+
+    serve.warm_up()
+
+    assert set(renderers) == set(Renderer)
+
+
+def test_warm_up_splits_limits_between_workers(monkeypatch):
+    monkeypatch.setattr(graphs, "render", lambda *args: b"")
+    monkeypatch.setattr(graphs.cache, "workers", 1)
+    monkeypatch.setattr(ingest.admission, "workers", 1)
+
+    serve.warm_up(4)
+
+    assert graphs.cache.workers == 4
+    assert ingest.admission.workers == 4
+
+
+def test_load_passes_workers(monkeypatch):
+    settings = config.server.copy(update={"workers": 3})
+    application = serve.Application(settings, ["--workers", "5"])
+    monkeypatch.setattr(serve, "warm_up", lambda workers: workers)
+
+    assert application.load() == 5
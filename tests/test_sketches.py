@@ -0,0 +1,122 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+from datetime import datetime
+
+import bson
+import numpy as np
+import pytest
+
+import app.sketches as sketches_module
+from app.sketches import Sketch, SketchBuffer
+
+QUANTILES = [0.0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1.0]
+
+
+def sketch_of(values):
+    sketch = Sketch()
+    for value in values:
+        sketch.add(float(value))
+    return sketch
+
+
+def assert_accurate(sketch, values):
+    for q in QUANTILES:
+        # the sketch returns the value of rank floor(q * (n - 1))
+        exact = np.quantile(values, q, method="lower")
+        estimate = sketch.quantile(q)
+        assert abs(estimate - exact) <= Sketch.ALPHA * abs(exact) + Sketch.MIN_VALUE
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        np.random.default_rng(1).lognormal(0, 2, 10000),
+        np.random.default_rng(2).normal(0, 15, 10000),
+        -np.random.default_rng(3).exponential(5, 1000),
+        np.concatenate([np.zeros(100), np.random.default_rng(4).uniform(-1, 1, 500)]),
+        np.array([42.0]),
+    ],
+)
+def test_quantiles_within_relative_accuracy(values):
+    assert_accurate(sketch_of(values), values)
+
+
+def test_merge_equals_sketch_of_union():
+    rng = np.random.default_rng(5)
+    first, second = rng.normal(10, 5, 3000), rng.normal(-3, 2, 2000)
+
+    merged = sketch_of(first)
+    merged.merge(sketch_of(second))
+
+    values = np.concatenate([first, second])
+    assert merged.count == len(values)
+    assert_accurate(merged, values)
+
+
+def test_empty_sketch():
+    assert Sketch().quantile(0.5) is None
+
+
+def buffer_of(n):
+    buffer = SketchBuffer()
+    station_id = bson.ObjectId()
+    for day in range(1, n + 1):
+        buffer.add(station_id, datetime(2022, 1, day), {"temperature": {"avg": day}})
+    return buffer
+
+
+def test_flush_keeps_unwritten_sketches(monkeypatch):
+    written, failures = [], [1]
+
+    async def increment(station_id, field, day, zero, positive, negative):
+        if written and failures:
+            failures.pop()
+            raise RuntimeError("connection lost")
+        written.append(day)
+
+    monkeypatch.setattr(sketches_module.sketches, "increment", increment)
+    buffer = buffer_of(3)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(buffer.flush())
+
+    assert len(written) == 1
+    assert len(buffer._sketches) == 2
+    assert all(sketch.count == 1 for sketch in buffer._sketches.values())
+
+    asyncio.run(buffer.flush())
+
+    assert sorted(written) == [datetime(2022, 1, day).date() for day in (1, 2, 3)]
+    assert not buffer._sketches
+
+
+def test_flush_merges_into_new_readings(monkeypatch):
+    buffer = buffer_of(1)
+    (station_id, field, day), _ = next(iter(buffer._sketches.items()))
+
+    async def increment(*args):
+        # a reading arrives while the sketch is being written
+        buffer.add(station_id, datetime(2022, 1, 1), {"temperature": {"avg": 2}})
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(sketches_module.sketches, "increment", increment)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(buffer.flush())
+
+    assert list(buffer._sketches) == [(station_id, field, day)]
+    assert buffer._sketches[(station_id, field, day)].count == 2
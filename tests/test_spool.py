@@ -0,0 +1,106 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import os
+import zlib
+
+import bson
+import pydantic
+import pytest
+
+import app.spool as spool_module
+from app.settings import SpoolSettings
+from app.spool import FRAME, Segment, Spool, _read_frames
+
+
+def frame(document):
+    payload = bson.encode(document)
+    return FRAME.pack(len(payload), zlib.crc32(payload), 0.0) + payload
+
+
+@pytest.fixture
+def database(monkeypatch):
+    documents = {}
+
+    async def exclude_existing(batch):
+        return [document for document in batch if document["_id"] not in documents]
+
+    async def insert_many(batch):
+        for document in batch:
+            assert document["_id"] not in documents, "duplicate reading"
+            documents[document["_id"]] = document
+
+    monkeypatch.setattr(spool_module.measurements, "exclude_existing", exclude_existing)
+    monkeypatch.setattr(spool_module.measurements, "insert_many", insert_many)
+    return documents
+
+
+def make_spool(path):
+    spool = Spool()
+    spool.settings = SpoolSettings(enabled=True, path=str(path))
+    return spool
+
+
+def test_path_required_when_enabled():
+    with pytest.raises(pydantic.ValidationError):
+        SpoolSettings(enabled=True)
+    assert not SpoolSettings().enabled
+
+
+def test_read_frames_stops_at_torn_record(tmp_path):
+    documents = [{"_id": i} for i in range(3)]
+    data = b"".join(frame(document) for document in documents)
+    path = tmp_path / "segment.spool"
+    path.write_bytes(data + frame({"_id": 3})[:-2])
+
+    with open(path, "rb") as f:
+        frames, offset = _read_frames(f, 0, 10)
+        assert [bson.decode(payload) for _, payload in frames] == documents
+        assert offset == len(data)
+
+        frames, offset = _read_frames(f, 0, 2)
+        assert len(frames) == 2
+        assert _read_frames(f, offset, 10)[0][0][1] == bson.encode(documents[2])
+
+
+def test_foreign_segment_is_deduplicated(tmp_path, database):
+    # a stopped process inserted the readings but did not save the offset
+    documents = [{"_id": bson.ObjectId()} for _ in range(3)]
+    path = tmp_path / "1-1.spool"
+    path.write_bytes(b"".join(frame(document) for document in documents))
+    database.update({document["_id"]: document for document in documents[:2]})
+
+    spool = make_spool(tmp_path)
+    spool._uncertain = False
+    spool._lock = asyncio.Lock()
+
+    async def replay():
+        while await spool._replay_batch():
+            pass
+
+    asyncio.run(replay())
+
+    assert len(database) == 3
+    assert not os.path.exists(path)
+
+
+def test_locked_segment_is_not_acquired(tmp_path):
+    segment = Segment.create(str(tmp_path))
+    try:
+        assert Segment.acquire(segment.path) is None
+    finally:
+        segment.remove()
+    assert Segment.acquire(segment.path) is None
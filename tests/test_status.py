@@ -0,0 +1,163 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
+
+import pytest
+
+import app.models as models
+import app.status as status
+
+START = datetime(2022, 8, 15)
+
+
+def record(name, minutes=0, wind=None, temperature=None):
+    return models.WeatherRecord(
+        station=models.Station(code=name.lower(), name=name, lat=0, lon=0),
+        timestamp=START + timedelta(minutes=minutes),
+        wind=None if wind is None else models.WindValue(avg=wind),
+        temperature=(
+            None if temperature is None else models.MeasureValue(avg=temperature)
+        ),
+        humidity=None,
+        pressure=None,
+        light=None,
+        rain=None,
+    )
+
+
+def loaded_page(records):
+    page = status.StatusPage(max_age=60, cache_size=10)
+    for r in records:
+        page.notify(r)
+    page._loaded_at = time.monotonic()
+    return page
+
+
+def test_query_url():
+    query = status.Query(q="river", region=(1.5, 2.0, 3.0, 4.0), size=20)
+
+    assert parse_qs(query.url(page=3)[1:]) == {
+        "q": ["river"],
+        "region": ["1.5,2.0,3.0,4.0"],
+        "sort": ["updated"],
+        "order": ["desc"],
+        "page": ["3"],
+        "size": ["20"],
+    }
+    assert status.Query(sort="name", desc=False, size=50).url() == (
+        "?sort=name&order=asc&page=1&size=50"
+    )
+
+
+def test_parse_region():
+    assert status.parse_region("-10,170,10.5,-170") == (-10, 170, 10.5, -170)
+
+
+@pytest.mark.parametrize(
+    "value", ["1,2,3", "a,b,c,d", "10,0,-10,0", "0,0,91,0", "0,-181,0,0"]
+)
+def test_parse_region_invalid(value):
+    with pytest.raises(ValueError):
+        status.parse_region(value)
+
+
+@pytest.mark.parametrize("sort", ["wind", "temperature"])
+@pytest.mark.parametrize("desc", [False, True])
+def test_sort_keys_put_missing_values_last(sort, desc):
+    records = [
+        record("a", wind=3, temperature=-5),
+        record("b"),
+        record("c", wind=0, temperature=0),
+        record("d", wind=10, temperature=20),
+    ]
+    page = loaded_page(records)
+
+    selected = asyncio.run(page._select(status.Query(sort=sort, desc=desc)))
+    names = [r.station.name for r in selected]
+
+    # missing values go after present ones when ascending, first otherwise
+    expected = ["c", "a", "d"] if sort == "wind" else ["a", "c", "d"]
+    if desc:
+        assert names == ["b"] + expected[::-1]
+    else:
+        assert names == expected + ["b"]
+
+
+def test_sort_by_name_and_update_time():
+    page = loaded_page([record("b", 2), record("A", 1), record("c", 3)])
+
+    by_name = asyncio.run(page._select(status.Query(sort="name", desc=False)))
+    by_time = asyncio.run(page._select(status.Query()))
+
+    assert [r.station.name for r in by_name] == ["A", "b", "c"]
+    assert [r.station.name for r in by_time] == ["c", "b", "A"]
+
+
+def test_page_is_clamped_to_last():
+    page = loaded_page([record(f"s{i}", i) for i in range(5)])
+
+    last = asyncio.run(page.render(status.Query(page=3, size=2)))
+    beyond = asyncio.run(page.render(status.Query(page=99, size=2)))
+
+    assert beyond == last
+    assert "s0" in last and "s1" not in last
+
+
+def test_empty_page():
+    page = loaded_page([])
+
+    content = asyncio.run(page.render(status.Query(page=5)))
+
+    assert "1 / 1" in content
+
+
+def test_expire_newer_readings_only():
+    known, other = record("a", 5), record("b", 5)
+    page = loaded_page([known, other])
+
+    page.expire(known.station.id, known.timestamp)
+    page.expire(other.station.id, other.timestamp - timedelta(minutes=1))
+    assert not page._expired
+
+    unknown = record("c")
+    page.expire(known.station.id, known.timestamp + timedelta(minutes=1))
+    page.expire(unknown.station.id, START)
+    assert page._expired == {known.station.id, unknown.station.id}
+
+
+def test_refresh_reloads_expired_rows(monkeypatch):
+    old, newer = record("a", 0, wind=1), record("a", 10, wind=7)
+    newer = newer.copy(update={"station": old.station})
+    page = loaded_page([old])
+    selected = []
+
+    async def select_last(station_ids=None):
+        selected.append(station_ids)
+        return [newer]
+
+    monkeypatch.setattr(status.measurements, "select_last", select_last)
+    version = page.version
+
+    page.expire(old.station.id, newer.timestamp)
+    asyncio.run(page.refresh())
+
+    assert selected == [[old.station.id]]
+    assert page._records[old.station.id].wind.avg == 7
+    assert page.version == version + 1
+    assert not page._expired
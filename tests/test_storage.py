@@ -0,0 +1,190 @@
+# Copyright 2022 Aleksandr Soloshenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import bson
+import pymongo
+from bson.raw_bson import RawBSONDocument
+
+from app.repositories.storage import BucketsStorage, ReadingsStorage, _hour
+
+
+class Collection:
+    def __init__(self):
+        self.requests = []
+
+    async def bulk_write(self, requests, ordered=True):
+        self.requests.extend(requests)
+
+
+def reading(station_id, timestamp, wind=None):
+    document = {"_id": bson.ObjectId(), "s": station_id, "t": timestamp}
+    if wind is not None:
+        document["w"] = {"a": wind}
+    return document
+
+
+def test_hour():
+    assert _hour(datetime(2022, 8, 15, 10, 42, 7, 5)) == datetime(2022, 8, 15, 10)
+
+
+def test_buckets_range():
+    storage = BucketsStorage(Collection())
+    start, end = datetime(2022, 8, 15, 10, 30), datetime(2022, 8, 15, 12, 15)
+
+    # the bucket of the start hour holds readings after the start
+    assert storage._buckets_range({"$gte": start, "$lt": end}) == {
+        "$gte": datetime(2022, 8, 15, 10),
+        "$lte": end,
+    }
+    assert storage._buckets_range(
+        {"$gt": start - timedelta(hours=1), "$gte": start}
+    ) == {"$gte": datetime(2022, 8, 15, 10)}
+    assert storage._buckets_range({}) == {}
+
+
+def test_update_aggregates_averages():
+    storage = BucketsStorage(Collection())
+    station_id = bson.ObjectId()
+    timestamp = datetime(2022, 8, 15, 10, 5)
+    documents = [
+        reading(station_id, timestamp, 3.0),
+        reading(station_id, timestamp + timedelta(minutes=5), 1.0),
+        reading(station_id, timestamp + timedelta(minutes=10)),
+    ]
+
+    assert storage._update(documents) == pymongo.UpdateOne(
+        {
+            "s": station_id,
+            "h": datetime(2022, 8, 15, 10),
+            "n": {"$lt": BucketsStorage.BUCKET_SIZE},
+        },
+        {
+            "$push": {
+                "r": {
+                    "$each": [
+                        {k: v for k, v in doc.items() if k != "s"} for doc in documents
+                    ]
+                }
+            },
+            "$inc": {"n": 3, "sum.w": 4.0},
+            "$currentDate": {"u": True},
+            "$min": {"min.w": 1.0},
+            "$max": {"max.w": 3.0},
+        },
+        upsert=True,
+    )
+
+
+def test_update_of_encoded_readings():
+    storage = BucketsStorage(Collection())
+    station_id = bson.ObjectId()
+    documents = [
+        RawBSONDocument(bson.encode(reading(station_id, datetime(2022, 8, 15), wind)))
+        for wind in (3.0, 1.0)
+    ]
+
+    document = storage._update(documents)._doc
+
+    assert document["$inc"] == {"n": 2, "sum.w": 4.0}
+    assert document["$min"] == {"min.w": 1.0}
+    assert document["$max"] == {"max.w": 3.0}
+
+
+def test_update_without_averages():
+    storage = BucketsStorage(Collection())
+    document = storage._update([reading(bson.ObjectId(), datetime(2022, 8, 15))])._doc
+
+    assert document["$inc"] == {"n": 1}
+    assert "$min" not in document and "$max" not in document
+
+
+def test_insert_many_splits_buckets():
+    collection = Collection()
+    storage = BucketsStorage(collection)
+    station_id = bson.ObjectId()
+    start = datetime(2022, 8, 15, 10)
+    documents = [
+        reading(station_id, start + timedelta(seconds=i))
+        for i in range(BucketsStorage.BUCKET_SIZE + 1)
+    ] + [reading(station_id, start + timedelta(hours=1))]
+
+    asyncio.run(storage.insert_many(documents))
+
+    assert [r._doc["$inc"]["n"] for r in collection.requests] == [
+        BucketsStorage.BUCKET_SIZE,
+        1,
+        1,
+    ]
+    assert [r._filter["h"] for r in collection.requests] == [
+        start,
+        start,
+        start + timedelta(hours=1),
+    ]
+
+
+class Cursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.documents:
+            yield doc
+
+
+def test_exclude_existing_by_time():
+    station_id = bson.ObjectId()
+    stored = datetime(2022, 8, 15, 10, 0, 1, 500000)
+    collection = Collection()
+    # stored times are naive UTC in milliseconds
+    collection.find = lambda query, projection: Cursor([{"s": station_id, "t": stored}])
+    storage = ReadingsStorage(collection)
+    documents = [
+        reading(
+            station_id,
+            datetime(2022, 8, 15, 13, 0, 1, 500123, timezone(timedelta(hours=3))),
+        ),
+        reading(station_id, stored + timedelta(milliseconds=1)),
+        reading(bson.ObjectId(), stored),
+    ]
+
+    remaining = asyncio.run(storage.exclude_existing(documents, by_time=True))
+
+    assert remaining == documents[1:]
+
+
+def test_can_poll():
+    collection = Collection()
+
+    async def index_information():
+        return indexes
+
+    collection.index_information = index_information
+    indexes = {
+        "_id_": {"key": [("_id", 1)]},
+        "s_1_t_-1": {"key": [("s", 1), ("t", -1)]},
+    }
+
+    assert asyncio.run(ReadingsStorage(collection).can_poll())
+    assert not asyncio.run(BucketsStorage(collection).can_poll())
+
+    indexes = {"s_1_t_-1": {"key": [("s", 1), ("t", -1)]}, "u_-1": {"key": [("u", -1)]}}
+    assert not asyncio.run(ReadingsStorage(collection).can_poll())
+    assert asyncio.run(BucketsStorage(collection).can_poll())